@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午10:50
+# @File    : a1111.py
+# @Software: PyCharm
+"""
+Parser of the A1111 / Forge ``parameters`` text.
+
+    <prompt, any number of lines>
+    Negative prompt: <negative prompt, any number of lines>
+    Steps: 28, Sampler: Euler a, CFG scale: 7, Lora hashes: "a: 1f2e, b: 3c4d"
+
+Lines are classified in one pass and the settings line is tokenized in one
+pass, so the cost is linear in the input, which is cut at
+``MAX_PARAMETERS_SIZE`` on top of that.
+"""
+
+import re
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+MAX_PARAMETERS_SIZE = 256 * 1024
+NEGATIVE_PREFIX = "Negative prompt:"
+SETTINGS_PREFIX = "Steps:"
+
+_ESCAPE = re.compile(r"\\(.)")
+# Keys A1111, Forge and their common extensions write on the settings line,
+# a last line without ``Steps:`` only counts as settings when all its keys
+# are among them
+KNOWN_KEYS = frozenset(
+    (
+        "Steps",
+        "Sampler",
+        "Schedule type",
+        "CFG scale",
+        "Distilled CFG Scale",
+        "Seed",
+        "Size",
+        "Model hash",
+        "Model",
+        "VAE hash",
+        "VAE",
+        "Denoising strength",
+        "Clip skip",
+        "ENSD",
+        "Eta",
+        "RNG",
+        "NGMS",
+        "Variation seed",
+        "Variation seed strength",
+        "Seed resize from",
+        "Face restoration",
+        "Token merging ratio",
+        "Lora hashes",
+        "TI hashes",
+        "Emphasis",
+        "Version",
+        "Template",
+        "Negative Template",
+    )
+)
+KNOWN_PREFIXES = ("Hires ", "ADetailer ", "ControlNet", "Schedule ", "Mask ")
+
+
+def _quoted_value(line: str, start: int) -> Optional[Tuple[str, int]]:
+    """
+    The ``"..."`` value at ``start`` unescaped, and where it ends. None when
+    the quote is never closed.
+    """
+    search = start + 1
+    while True:
+        end = line.find('"', search)
+        if end < 0:
+            return None
+        # A quote after an odd run of backslashes is escaped
+        run = end
+        while run > search and line[run - 1] == "\\":
+            run -= 1
+        if (end - run) % 2 == 0:
+            return _ESCAPE.sub(r"\1", line[start + 1 : end]), end + 1
+        search = end + 1
+
+
+def parse_settings(line: str) -> Dict[str, str]:
+    """
+    ``Key: value, Key: "quoted, value"`` pairs in order. A piece without a
+    key belongs to the value before it, as in ``Sampler: DPM++ 2M, Karras``.
+    """
+    # Values are kept as their pieces, joined once at the end
+    pieces: Dict[str, List[str]] = {}
+    last = None
+    size = len(line)
+    index = 0
+    # Found positions are reused until passed, so the line is scanned once
+    colon = comma = -1
+    while index < size:
+        while index < size and line[index] in " \t":
+            index += 1
+        if index >= size:
+            break
+        if colon < index:
+            colon = line.find(":", index)
+            if colon < 0:
+                colon = size
+        if comma < index:
+            comma = line.find(",", index)
+            if comma < 0:
+                comma = size
+        # No key before the next comma, or none left at all
+        if colon > comma or colon == size:
+            fragment = line[index:comma].strip()
+            if last is not None and fragment:
+                pieces[last].append(fragment)
+            index = comma + 1
+            continue
+        key = line[index:colon].strip()
+        start = colon + 1
+        while start < size and line[start] == " ":
+            start += 1
+        quoted = _quoted_value(line, start) if line[start : start + 1] == '"' else None
+        if quoted is not None:
+            value, end = quoted
+            if comma < end:
+                comma = line.find(",", end)
+                if comma < 0:
+                    comma = size
+        else:
+            value = line[start:comma].strip()
+        if key:
+            pieces[key] = [value]
+            last = key
+        index = comma + 1
+    return {key: ", ".join(value) for key, value in pieces.items()}
+
+
+def _number(value: Optional[str], kind=float):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class A1111Parameters(BaseModel):
+    prompt: str = ""
+    negative_prompt: str = ""
+    settings: Dict[str, str] = {}
+
+    def __bool__(self):
+        return bool(self.prompt or self.negative_prompt or self.settings)
+
+    @property
+    def steps(self) -> Optional[int]:
+        return _number(self.settings.get("Steps"), int)
+
+    @property
+    def sampler(self) -> Optional[str]:
+        return self.settings.get("Sampler")
+
+    @property
+    def scheduler(self) -> Optional[str]:
+        return self.settings.get("Schedule type")
+
+    @property
+    def cfg_scale(self) -> Optional[float]:
+        return _number(self.settings.get("CFG scale"))
+
+    @property
+    def seed(self) -> Optional[int]:
+        return _number(self.settings.get("Seed"), int)
+
+    @property
+    def size(self) -> Optional[Tuple[int, int]]:
+        width, _, height = self.settings.get("Size", "").partition("x")
+        width, height = _number(width, int), _number(height, int)
+        if width is None or height is None:
+            return None
+        return width, height
+
+    @property
+    def model(self) -> Optional[str]:
+        return self.settings.get("Model") or self.settings.get("Model hash")
+
+    @property
+    def hires(self) -> Dict[str, str]:
+        return {
+            key: value
+            for key, value in self.settings.items()
+            if key.startswith("Hires") or key == "Denoising strength"
+        }
+
+    @property
+    def adetailer(self) -> Dict[str, str]:
+        return {
+            key: value
+            for key, value in self.settings.items()
+            if key.startswith("ADetailer")
+        }
+
+
+def is_known_key(key: str) -> bool:
+    return key in KNOWN_KEYS or key.startswith(KNOWN_PREFIXES)
+
+
+def _join(lines) -> str:
+    # Blank lines are dropped, the prompt reads the same without them
+    return "\n".join(line for line in lines if line.strip()).strip()
+
+
+def parse_parameters(text: str) -> A1111Parameters:
+    """
+    Split ``parameters`` into prompt, negative prompt and settings.
+
+    The settings line is the last one starting with ``Steps:``; without one,
+    a last line of at least three ``key: value`` pairs whose keys are all
+    known A1111 keys, so weighted prompts like ``(smile:1.2)`` stay prompts.
+    Lines after it, like the ``Template:`` some extensions add, are read as
+    settings too.
+    """
+    lines = text[:MAX_PARAMETERS_SIZE].splitlines()
+    negative_at = settings_at = None
+    for index, line in enumerate(lines):
+        if negative_at is None and line.startswith(NEGATIVE_PREFIX):
+            negative_at = index
+        if line.startswith(SETTINGS_PREFIX):
+            settings_at = index
+    settings: Dict[str, str] = {}
+    if settings_at is None and lines:
+        last = parse_settings(lines[-1])
+        if len(last) >= 3 and all(is_known_key(key) for key in last):
+            settings_at = len(lines) - 1
+    if settings_at is not None:
+        if negative_at is not None and negative_at >= settings_at:
+            negative_at = None
+        for line in lines[settings_at:]:
+            settings.update(parse_settings(line))
+    else:
+        settings_at = len(lines)
+    if negative_at is None:
+        return A1111Parameters(prompt=_join(lines[:settings_at]), settings=settings)
+    negative = lines[negative_at:settings_at]
+    negative[0] = negative[0][len(NEGATIVE_PREFIX) :]
+    return A1111Parameters(
+        prompt=_join(lines[:negative_at]),
+        negative_prompt=_join(negative),
+        settings=settings,
+    )
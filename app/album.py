@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午8:00
+# @File    : album.py
+# @Software: PyCharm
+import asyncio
+from typing import Dict, Hashable, List, Optional
+
+from telebot import types
+
+
+class _Album(object):
+    def __init__(self, message: types.Message):
+        self.messages = [message]
+        self.last_seen = asyncio.get_running_loop().time()
+        self.full = asyncio.Event()
+
+
+class AlbumCollector(object):
+    """
+    Gather the messages of one media group.
+
+    Telegram delivers an album as separate updates sharing ``media_group_id``.
+    The first one waits until no sibling arrived for ``window`` seconds, or
+    ``max_size`` were seen, and gets the whole album; the siblings get None and
+    are expected to leave the answer to it.
+    """
+
+    def __init__(self, window: float = 1.0, max_size: int = 10):
+        self.window = window
+        self.max_size = max_size
+        self._albums: Dict[Hashable, _Album] = {}
+
+    async def collect(self, message: types.Message) -> Optional[List[types.Message]]:
+        key = (message.chat.id, message.media_group_id)
+        album = self._albums.get(key)
+        if album is not None:
+            album.messages.append(message)
+            album.last_seen = asyncio.get_running_loop().time()
+            if len(album.messages) >= self.max_size:
+                album.full.set()
+            return None
+        album = self._albums[key] = _Album(message)
+        loop = asyncio.get_running_loop()
+        try:
+            while not album.full.is_set():
+                delay = album.last_seen + self.window - loop.time()
+                if delay <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(album.full.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            del self._albums[key]
+        return sorted(album.messages, key=lambda m: m.message_id)
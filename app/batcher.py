@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午3:10
+# @File    : batcher.py
+# @Software: PyCharm
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from app.utils import BatchUnsupported, TaggerBackend
+
+
+class _Pending(object):
+    __slots__ = ("file", "future")
+
+    def __init__(self, file, future: asyncio.Future):
+        self.file = file
+        self.future = future
+
+
+class TagBatcher(object):
+    """
+    Micro-batching front of a :class:`TaggerBackend`.
+
+    Uploads are held for up to ``max_delay`` seconds or until ``max_batch``
+    images are waiting, then sent as one batch request. Servers without a
+    batch endpoint get the same images as parallel single uploads instead.
+    Exposes the same ``upload`` signature as the SDK so callers do not care
+    which one they hold.
+    """
+
+    def __init__(self, sdk: TaggerBackend, max_batch: int = 8, max_delay: float = 0.02):
+        self.sdk = sdk
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        # Only requests with identical parameters can share a batch
+        self._pending: Dict[Tuple, List[_Pending]] = {}
+        self._timers: Dict[Tuple, asyncio.TimerHandle] = {}
+        self._tasks = set()
+
+    async def upload(
+        self, file, token, general_threshold=0.35, character_threshold=0.85
+    ):
+        loop = asyncio.get_running_loop()
+        params = (token, general_threshold, character_threshold)
+        future = loop.create_future()
+        queue = self._pending.setdefault(params, [])
+        queue.append(_Pending(file, future))
+        if len(queue) >= self.max_batch:
+            self._flush(params)
+        elif params not in self._timers:
+            self._timers[params] = loop.call_later(self.max_delay, self._flush, params)
+        return await future
+
+    def _flush(self, params: Tuple):
+        timer = self._timers.pop(params, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(params, None)
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._dispatch(params, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, params: Tuple, batch: List[_Pending]):
+        try:
+            await self._send(params, batch)
+        except asyncio.CancelledError:
+            for item in batch:
+                if not item.future.done():
+                    item.future.cancel()
+            raise
+        except Exception as e:
+            # Nobody awaits this task, the callers get the error
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+
+    async def _send(self, params: Tuple, batch: List[_Pending]):
+        token, general_threshold, character_threshold = params
+        kwargs = dict(
+            token=token,
+            general_threshold=general_threshold,
+            character_threshold=character_threshold,
+        )
+        results: Optional[list] = None
+        if len(batch) > 1 and self.sdk.batch_supported:
+            try:
+                results = await self.sdk.upload_batch(
+                    [item.file for item in batch], **kwargs
+                )
+            except BatchUnsupported:
+                results = None
+            except Exception as e:
+                # Each image gets its own upload and its own retries, one bad
+                # image or a flaky batch endpoint fails no more than itself
+                logger.warning(f"Batch of {len(batch)} failed {e!r}, upload singly")
+                results = None
+        if results is None:
+            results = await asyncio.gather(
+                *[self.sdk.upload(item.file, **kwargs) for item in batch],
+                return_exceptions=True,
+            )
+        for item, result in zip(batch, results):
+            if item.future.done():
+                continue
+            if isinstance(result, BaseException):
+                item.future.set_exception(result)
+            else:
+                item.future.set_result(result)
+
+    async def close(self):
+        for params in list(self._pending):
+            self._flush(params)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.sdk.close()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午2:50
+# @File    : cache.py
+# @Software: PyCharm
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import elara
+from loguru import logger
+from pydantic import BaseModel
+
+from app.event import TaggerResult
+
+
+class TagCacheEntry(BaseModel):
+    result: TaggerResult
+    read_message: List[str] = []
+
+
+class CacheStats(BaseModel):
+    memory_hits: int = 0
+    persist_hits: int = 0
+    misses: int = 0
+    # Misses answered through a perceptual near-duplicate instead
+    near_hits: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.memory_hits + self.persist_hits + self.misses
+        if not total:
+            return 0.0
+        return (self.memory_hits + self.persist_hits) / total
+
+
+class MemoryLRU(object):
+    """
+    Small LRU with a per-entry TTL, lives in front of the persistent store
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expire_at, value = item
+        if expire_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TagCache(object):
+    """
+    Two level cache of tagging results.
+
+    Keys are namespaced: ``uid:<file_unique_id>`` points at a content digest,
+    ``sha:<digest>`` holds the :class:`TagCacheEntry`. A Telegram file seen
+    before is answered without downloading it, and the same bytes re-uploaded
+    under another file id are answered without inference.
+    """
+
+    def __init__(
+        self,
+        persist_path: Optional[str],
+        memory_size: int = 1024,
+        memory_ttl: float = 3600,
+        persist_size: int = 100000,
+        persist_ttl: float = 30 * 86400,
+        persist_cull: int = 20,
+        commit_interval: int = 32,
+    ):
+        self.memory = MemoryLRU(max_size=memory_size, ttl=memory_ttl)
+        self.stats = CacheStats()
+        self.commit_interval = commit_interval
+        self._dirty = 0
+        # Elara is not thread safe, every access to it goes through this lock
+        self._store_lock = threading.Lock()
+        self._store = None
+        if persist_path:
+            directory = os.path.dirname(persist_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._store = elara.exe_cache(
+                persist_path,
+                cache_param={
+                    "max_age": persist_ttl,
+                    "max_size": persist_size,
+                    "cull_freq": persist_cull,
+                },
+            )
+
+    def _store_get(self, key):
+        with self._store_lock:
+            return self._store.get(key)
+
+    def _store_set(self, key, value):
+        with self._store_lock:
+            self._store.set(key, value)
+
+    def _store_commit(self):
+        with self._store_lock:
+            self._store.commit()
+
+    async def _lookup(self, key: str):
+        value = self.memory.get(key)
+        if value is not None:
+            return value, True
+        if self._store is None:
+            return None, False
+        value = await asyncio.to_thread(self._store_get, key)
+        if value is not None:
+            self.memory.set(key, value)
+        return value, False
+
+    async def _put(self, key: str, value):
+        self.memory.set(key, value)
+        if self._store is None:
+            return
+        await asyncio.to_thread(self._store_set, key, value)
+        self._dirty += 1
+        if self._dirty >= self.commit_interval:
+            await self.commit()
+
+    def _account(self, entry, from_memory: bool):
+        if entry is None:
+            self.stats.misses += 1
+        elif from_memory:
+            self.stats.memory_hits += 1
+        else:
+            self.stats.persist_hits += 1
+
+    async def get_by_file(self, file_unique_id: str) -> Optional[TagCacheEntry]:
+        digest, from_memory = await self._lookup(f"uid:{file_unique_id}")
+        if digest is None:
+            return None
+        entry = await self.get_by_digest(digest, count=False)
+        if entry is not None:
+            self._account(entry, from_memory)
+        return entry
+
+    async def get_by_digest(
+        self, digest: str, count: bool = True
+    ) -> Optional[TagCacheEntry]:
+        raw, from_memory = await self._lookup(f"sha:{digest}")
+        entry = None
+        if raw is not None:
+            try:
+                entry = TagCacheEntry.model_validate(raw)
+            except Exception as e:
+                logger.debug(f"Drop broken cache entry {digest} {e}")
+        if count:
+            self._account(entry, from_memory)
+        return entry
+
+    async def put(self, digest: str, entry: TagCacheEntry, file_unique_id=None):
+        await self._put(f"sha:{digest}", entry.model_dump())
+        if file_unique_id:
+            await self.link(file_unique_id, digest)
+
+    async def link(self, file_unique_id: str, digest: str):
+        await self._put(f"uid:{file_unique_id}", digest)
+
+    async def commit(self):
+        if self._store is None or not self._dirty:
+            return
+        self._dirty = 0
+        try:
+            await asyncio.to_thread(self._store_commit)
+        except Exception as e:
+            logger.error(f"Tag cache commit failed {e}")
+
+    async def close(self):
+        await self.commit()
+        logger.info(
+            f"Tag cache closed, hit rate {self.stats.hit_rate:.2%} {self.stats}"
+        )
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/19 上午1:00
+# @File    : catchup.py
+# @Software: PyCharm
+"""
+Answer the updates that piled up while the bot was down.
+
+Instead of skipping them, pending updates are fetched once at startup.
+Requests older than ``max_age`` are dropped, and an image asked for several
+times in one chat is answered once. What is left is replayed at a bounded
+parallelism behind live traffic.
+"""
+
+import asyncio
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+from app.metrics import stage
+
+_backlog: ContextVar[bool] = ContextVar("backlog", default=False)
+
+
+def in_backlog() -> bool:
+    """
+    Whether the current handler runs for a caught up update
+    """
+    return _backlog.get()
+
+
+def file_key(message: types.Message) -> Optional[str]:
+    # The image a message asks to tag, itself or the one a command replies to
+    candidates = [message]
+    if (message.text or "").startswith("/") and message.reply_to_message:
+        candidates.append(message.reply_to_message)
+    for item in candidates:
+        if item.photo:
+            return item.photo[-1].file_unique_id
+        if item.document:
+            return item.document.file_unique_id
+    return None
+
+
+class BacklogCatchup(object):
+    """
+    :param max_age: seconds after which a request is not answered anymore
+    :param parallelism: backlog updates handled at once, albums count as one
+    :param ready: checked before each update, the backlog waits while it is
+        false, e.g. while the tagger is down
+    """
+
+    def __init__(
+        self,
+        bot: AsyncTeleBot,
+        max_age: float = 600,
+        parallelism: int = 2,
+        limit: int = 100,
+        ready: Optional[Callable[[], bool]] = None,
+    ):
+        self.bot = bot
+        self.max_age = max_age
+        self.parallelism = parallelism
+        self.limit = limit
+        self.ready = ready
+        # First update id not fetched yet, where polling goes on from
+        self.offset: Optional[int] = None
+        self.fetched = 0
+        self.expired = 0
+        self.duplicates = 0
+        self.done = 0
+        self.failed = 0
+        self._units: Deque[List[types.Update]] = deque()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        return sum(len(unit) for unit in self._units)
+
+    async def fetch(self, allowed_updates=None) -> int:
+        """
+        Take the pending updates off Telegram and keep those worth answering.
+
+        :return: updates left to answer
+        """
+        updates: List[types.Update] = []
+        while True:
+            batch = await self.bot.get_updates(
+                offset=self.offset,
+                limit=self.limit,
+                timeout=0,
+                allowed_updates=allowed_updates,
+            )
+            if batch:
+                updates.extend(batch)
+                self.offset = batch[-1].update_id + 1
+            # A short batch means the backlog ends here, what comes next is live
+            if len(batch) < self.limit:
+                break
+        if self.offset is not None:
+            # Confirm what was fetched, so a webhook does not deliver it again
+            await self.bot.get_updates(offset=self.offset, limit=1, timeout=0)
+        self.fetched = len(updates)
+        self._units = deque(self.select(updates, time.time()))
+        left = self.pending
+        logger.info(
+            f"Backlog of {self.fetched} updates, {self.expired} too old, "
+            f"{self.duplicates} duplicates, {left} to answer"
+        )
+        return left
+
+    def expired_at(self, update: types.Update, now: float) -> bool:
+        message = update.message
+        return message is not None and message.date < now - self.max_age
+
+    def select(
+        self, updates: List[types.Update], now: float
+    ) -> List[List[types.Update]]:
+        """
+        Fresh updates in arrival order, the members of an album grouped into
+        one unit. Of the requests for one image in one chat only the latest is
+        kept.
+        """
+        seen: Set[Tuple[int, str]] = set()
+        kept: List[types.Update] = []
+        for update in reversed(updates):
+            if self.expired_at(update, now):
+                self.expired += 1
+                continue
+            message = update.message
+            # Album members are kept whole, the reply covers the album
+            if message is not None and not message.media_group_id:
+                key = file_key(message)
+                if key is not None:
+                    if (message.chat.id, key) in seen:
+                        self.duplicates += 1
+                        continue
+                    seen.add((message.chat.id, key))
+            kept.append(update)
+        units: List[List[types.Update]] = []
+        albums: Dict[Tuple[int, str], List[types.Update]] = {}
+        for update in reversed(kept):
+            message = update.message
+            if message is None or not message.media_group_id:
+                units.append([update])
+                continue
+            group = (message.chat.id, message.media_group_id)
+            if group not in albums:
+                albums[group] = []
+                units.append(albums[group])
+            albums[group].append(update)
+        return units
+
+    def start(self):
+        if self._units:
+            self._task = asyncio.create_task(self._run())
+
+    async def _process(self, unit: List[types.Update], slots: asyncio.Semaphore):
+        try:
+            if self.expired_at(unit[0], time.time()):
+                # Aged out while waiting behind the rest of the backlog
+                self.expired += len(unit)
+            else:
+                with stage("backlog_update", content_type="update"):
+                    await self.bot.process_new_updates(unit)
+                self.done += len(unit)
+        except Exception as e:
+            self.failed += len(unit)
+            logger.exception(e)
+        finally:
+            slots.release()
+
+    async def _run(self):
+        _backlog.set(True)
+        started = time.perf_counter()
+        total = self.pending
+        slots = asyncio.Semaphore(self.parallelism)
+        tasks = []
+        while self._units:
+            await slots.acquire()
+            while self.ready is not None and not self.ready():
+                await asyncio.sleep(1)
+            tasks.append(
+                asyncio.create_task(self._process(self._units.popleft(), slots))
+            )
+        await asyncio.gather(*tasks)
+        logger.success(
+            f"Caught up on {total} updates in {time.perf_counter() - started:.1f}s"
+        )
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -2,15 +2,18 @@
 # @Time    : 2023/11/18 上午12:18
 # @File    : controller.py
 # @Software: PyCharm
-import json
-from io import BytesIO
-
-import json_repair
+import asyncio
+import os
+import re
+import time
+from contextlib import nullcontext
+from functools import lru_cache, partial
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
 import telegramify_markdown
-from PIL import Image
+from autometrics import autometrics
 from loguru import logger
-from novelai_python.tool.image_metadata import ImageMetadata, ImageVerifier
-from novelai_python.tool.random_prompt import RandomPromptGenerator
 from telebot import formatting
 from telebot import types
 from telebot import util
@@ -19,261 +22,765 @@ from telebot.asyncio_helper import ApiTelegramException
 from telebot.asyncio_storage import StateMemoryStorage
 from telegramify_markdown import ContentTypes
 
-from app.event import pipeline_tag
+from app.album import AlbumCollector
+from app.cache import CacheStats, TagCache, TagCacheEntry
+from app.catchup import BacklogCatchup, in_backlog
+from app.event import TaggerResult, build_tagger_sdk, pipeline_tag
+from app.executor import ImageExecutor, default_workers
+from app.health import TaggerHealth
+from app.jobqueue import JobQueue, QueuedJob
+from app.fetch import (
+    FileTooLarge,
+    ImageBuffer,
+    is_image_document,
+    select_photo,
+    stream_download,
+)
+from app.metrics import (
+    MetricsServer,
+    bind_job,
+    content_type_of,
+    current_trace,
+    observe,
+    stage,
+    watch,
+)
+from app.phash import PerceptualIndex, phash
+from app.preprocess import downscale_for_tagger
+from app.profiler import SlowJobProfiler, annotate, describe_file
+from app.reader import cite, code, read_image_message_timed
+from app.scheduler import FairScheduler, QueueFull
+from app.sender import OutboundSender
+from app.utils import SingleFlight, generate_uuid
+from app.webhook import WebhookServer
+from app.workers import WorkerSupervisor, file_from_payload, file_payload
 from app_conf import settings
 from setting.telegrambot import BotSetting
+from setting.wdtagger import TaggerSetting
 
 StepCache = StateMemoryStorage()
 
-prompt_generator = RandomPromptGenerator(nsfw_enabled=False)
-
-
-def cite(
-    content: str,
-):
-    return f">{content}\n"
-
-
-def code(
-    content: str,
-    language: str,
-):
-    return f"```{language}\n{content}\n```"
-
-
-def extract_between_multiple_markers(input_list, start_markers, end_markers):
-    extracting = False
-    extracted_elements = []
-    for item in input_list:
-        # Check if the item contains any start marker
-        if any(start_marker in item for start_marker in start_markers):
-            extracting = True
-            # continue  # Skip appending the marker itself
-        if end_markers:
-            if any(end_marker in item for end_marker in end_markers):
-                break
-        if extracting:
-            extracted_elements.append(item)
-    return extracted_elements
-
-
-async def read_a111(file: BytesIO):
-    try:
-        file.seek(0)
-        with Image.open(file) as img:
-            parameter = img.info.get("parameters", None)
-            if not parameter:
-                raise Exception("Empty Parameter")
-            if not isinstance(parameter, str):
-                parameter = str(parameter)
-            parameters = parameter.split(",")
-            prompt = extract_between_multiple_markers(
-                parameters, [""], ["Negative prompt:", "Steps:"]
-            )
-            negative_prompt = extract_between_multiple_markers(
-                parameters, ["Negative prompt:"], ["Steps:"]
-            )
-            info = extract_between_multiple_markers(parameters, ["Steps:"], None)
-            prompt = ",".join(prompt)
-            negative_prompt = ",".join(negative_prompt)
-            info = ",".join(info)
-            message = f"{negative_prompt}\n{info}"
-            while "\n\n" in message:
-                message = message.replace("\n\n", "\n")
-            while "\n\n" in prompt:
-                prompt = prompt.replace("\n\n", "\n")
-    except Exception as e:
-        logger.debug(f"Error {e}")
-        return []
+BOT_COMMANDS = [
+    types.BotCommand("tag", "Tag Image"),
+    types.BotCommand("scene", "Generate Scene Prompt"),
+    types.BotCommand("scene_composition", "Generate Scene Composition Prompt"),
+    types.BotCommand("nsfw", "Generate NSFW Prompt"),
+    types.BotCommand("sfw", "Generate SFW Prompt"),
+]
+
+
+@lru_cache(maxsize=None)
+def prompt_generator():
+    # novelai_python takes most of a second to import, pay it on first use
+    from novelai_python.tool.random_prompt import RandomPromptGenerator
+
+    return RandomPromptGenerator(nsfw_enabled=False)
+
+
+def render_tag_message(entry: TagCacheEntry) -> str:
+    infer = entry.result
+    read_message = entry.read_message
+    infer_message = [
+        formatting.mbold("🥛 Tags", escape=False),
+    ]
+    if read_message:
+        infer_message.append(cite(content=infer.anime_tags))
+    else:
+        infer_message.append(code(content=infer.anime_tags, language="txt"))
+    if infer.characters:
+        infer_message.append(formatting.mbold("🥛 Characters", escape=False))
+        infer_message.append(code(content=",".join(infer.characters), language="txt"))
+    if not read_message:
+        infer_message.append(formatting.mbold("🥛 No Metadata", escape=False))
     else:
-        return [
-            formatting.mbold("📦 Prompt", escape=False),
-            code(content=prompt, language="txt"),
-            formatting.mbold("📦 Negative Prompt", escape=False),
-            cite(content=negative_prompt),
-        ]
-
-
-async def read_comfyui(file: BytesIO):
-    try:
-        file.seek(0)
-        with Image.open(file) as img:
-            parameter = img.info.get("prompt")
-        if not parameter:
-            raise Exception("Empty Parameter")
-        decoded_object = json_repair.loads(parameter)
-        return [
-            formatting.mbold("📦 Comfyui", escape=False),
-            code(
-                content=json.dumps(decoded_object, indent=2, ensure_ascii=False),
-                language="json",
-            ),
-        ]
-    except Exception as e:
-        logger.debug(f"Error {e}")
-    return []
-
-
-async def read_novelai(file: BytesIO):
+        infer_message.extend(read_message)
+    return "\n".join(infer_message)
+
+
+DEGRADED_MESSAGE = "🥛 Tagger is not available right now, please try again later"
+
+
+def render_album_message(prompts: List[str]) -> str:
     message = []
-    try:
-        file.seek(0)
-        with Image.open(file) as img:
-            meta_data = ImageMetadata.load_image(img)
-        rq_type = meta_data.Comment.request_type
-        mode = ""
-        if rq_type == "PromptGenerateRequest":
-            mode += "Text2Image"
-        elif rq_type == "Img2ImgRequest":
-            mode += "Img2Img"
-        if meta_data.Comment.reference_strength:
-            mode += "+VibeTransfer"
-        if not meta_data.Comment.prompt:
-            return []
-    except Exception as e:
-        logger.debug(f"Empty metadata {e}")
-        return []
-
-    message.append(formatting.mbold("📦 NovelAI", escape=False))
-    message.append(f"📦 Mode: {mode}")
-    if meta_data.Comment.prompt:
-        message.append(code(content=meta_data.Comment.prompt, language="txt"))
-    if meta_data.Comment.negative_prompt:
+    for index, prompt in enumerate(prompts, start=1):
         message.append(
-            code(
-                content=meta_data.Comment.negative_prompt,
-                language="txt",
-            )
-        )
-    if meta_data.used_model:
-        model_tag = str(meta_data.used_model.value).replace("-", "_")
-        message.append(
-            formatting.mbold(f"📦 Model #{model_tag}", escape=False),
-        )
-    if meta_data.Source:
-        source_tag = meta_data.Source.lower().replace(" ", "_")
-        message.append(
-            formatting.mbold(f"📦 Source #{source_tag}", escape=False),
-        )
-    try:
-        file.seek(0)
-        with Image.open(file) as img:
-            is_novelai, has_latent = ImageVerifier().verify(img)
-    except Exception:
-        logger.debug("Not NovelAI")
-    else:
-        if is_novelai:
-            message.append(formatting.mbold("🧊 Signed by NovelAI", escape=False))
-        if has_latent:
-            message.append(formatting.mbold("🧊 Find Latent Space", escape=False))
-    message.append(
-        code(
-            content=meta_data.Comment.model_dump_json(indent=2),
-            language="json",
+            formatting.mbold(f"🖼 Image {index}/{len(prompts)}", escape=False)
         )
+        message.append(prompt)
+    return "\n".join(message)
+
+
+def worker_path(path: Optional[str], worker: Optional[int]) -> Optional[str]:
+    # The cache files are not safe to share between processes, every worker
+    # process keeps its own
+    if not path or worker is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.worker{worker}{ext}"
+
+
+def remove_stale_worker_files(path: Optional[str], processes: int):
+    # Files of workers that no longer run would never be read or cleaned again
+    if not path:
+        return
+    root, ext = os.path.splitext(path)
+    pattern = re.compile(re.escape(os.path.basename(root)) + r"\.worker(\d+)")
+    directory = os.path.dirname(path) or "."
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if not match or int(match.group(1)) < processes:
+            continue
+        if not name[match.end() :].startswith(ext):
+            continue
+        logger.info(f"Removing {name}, worker {match.group(1)} no longer runs")
+        os.remove(os.path.join(directory, name))
+
+
+def build_phash_index(worker: Optional[int] = None) -> Optional[PerceptualIndex]:
+    # Near-duplicates are answered from tag cache entries
+    if not settings.cache.enable or not settings.cache.near_duplicate:
+        return None
+    return PerceptualIndex(
+        path=worker_path(settings.cache.phash_path, worker),
+        radius=settings.cache.phash_radius,
+        # Entries point into the tag cache, so they share its limits
+        max_size=settings.cache.persist_size,
+        ttl=settings.cache.persist_ttl,
+    )
+
+
+def build_tag_cache(worker: Optional[int] = None) -> Optional[TagCache]:
+    if not settings.cache.enable:
+        return None
+    return TagCache(
+        persist_path=worker_path(settings.cache.persist_path, worker),
+        memory_size=settings.cache.memory_size,
+        memory_ttl=settings.cache.memory_ttl,
+        persist_size=settings.cache.persist_size,
+        persist_ttl=settings.cache.persist_ttl,
+        persist_cull=settings.cache.persist_cull,
+        commit_interval=settings.cache.commit_interval,
+    )
+
+
+def build_profiler() -> Optional[SlowJobProfiler]:
+    if not settings.profiler.enable:
+        return None
+    return SlowJobProfiler(
+        directory=settings.profiler.directory,
+        threshold=settings.profiler.threshold,
+        keep=settings.profiler.keep,
+        sample_interval=settings.profiler.sample_interval,
+        max_overhead=settings.profiler.max_overhead,
+        window=settings.profiler.window,
+        lag_interval=settings.profiler.lag_interval,
+        cooldown=settings.profiler.cooldown,
+    )
+
+
+def build_job_queue() -> Optional[JobQueue]:
+    if not settings.workers.processes:
+        return None
+    return JobQueue(
+        path=settings.workers.queue_path,
+        lease=settings.workers.lease,
+        max_attempts=settings.workers.max_attempts,
+        max_pending=settings.queue.max_pending,
+        chat_pending=settings.queue.chat_pending,
+        chat_concurrency=settings.queue.chat_concurrency,
     )
-    return message
 
 
 class BotRunner(object):
-    def __init__(self):
+    """
+    The whole bot in one process, or with ``[workers] processes`` set, either
+    the ingest process that queues jobs (``worker`` is None) or worker process
+    ``worker`` that runs them
+    """
+
+    def __init__(self, worker: Optional[int] = None):
+        self.worker = worker
+        self.job_queue = build_job_queue()
+        # The ingest process answers nothing from the cache, workers fill it
+        self.ingest = self.job_queue is not None and worker is None
+        processes = settings.workers.processes
+        # Processes sending at once share the global send rate
+        rate_share = 1 / (processes + 1) if self.job_queue is not None else 1
+        self.supervisor = (
+            WorkerSupervisor(processes, level="DEBUG" if settings.app.debug else "INFO")
+            if self.ingest
+            else None
+        )
         self.bot = AsyncTeleBot(BotSetting.token, state_storage=StepCache)
+        self.tagger_sdk = build_tagger_sdk()
+        self.tagger_health = TaggerHealth(
+            urls=TaggerSetting.endpoints if TaggerSetting.wd_backend == "http" else [],
+            timeout=settings.startup.probe_timeout,
+            interval=settings.startup.probe_interval,
+        )
+        if worker is None:
+            for path in (settings.cache.persist_path, settings.cache.phash_path):
+                remove_stale_worker_files(path, processes)
+        self.tag_cache = None if self.ingest else build_tag_cache(worker)
+        self.phash_index = None if self.ingest else build_phash_index(worker)
+        self.profiler = build_profiler()
+        self.inflight = SingleFlight()
+        self.sender = OutboundSender(
+            global_rate=settings.sender.global_rate * rate_share,
+            private_rate=settings.sender.private_rate,
+            private_burst=settings.sender.private_burst,
+            group_rate=settings.sender.group_rate,
+            group_burst=settings.sender.group_burst,
+            max_retries=settings.sender.max_retries,
+            backoff=settings.sender.backoff,
+        )
+        self.albums = AlbumCollector(
+            window=settings.album.window, max_size=settings.album.max_size
+        )
+        self.scheduler = FairScheduler(
+            workers=settings.queue.workers,
+            max_pending=settings.queue.max_pending,
+            chat_pending=settings.queue.chat_pending,
+            chat_concurrency=settings.queue.chat_concurrency,
+        )
+        # Tagging calls at once, album items count one each while their
+        # album holds a single queue slot
+        self.tag_slots = asyncio.Semaphore(settings.queue.workers)
+        image_workers = default_workers(settings.executor.workers)
+        if worker is not None and settings.executor.workers < 0:
+            # The cores are shared by the worker processes
+            image_workers = max(1, image_workers // processes)
+        self.image_executor = ImageExecutor(
+            max_workers=image_workers,
+            timeout=settings.executor.timeout,
+        )
+        self.read_message = partial(
+            read_image_message_timed, comfyui_graph=settings.reader.comfyui_graph
+        )
+        self.downscale = None
+        if settings.preprocess.enable:
+            self.downscale = partial(
+                downscale_for_tagger,
+                max_side=settings.preprocess.max_side,
+                image_format=settings.preprocess.format.upper(),
+                quality=settings.preprocess.quality,
+            )
+        watch("queue_pending", lambda: self.scheduler.pending)
+        watch("jobs_running", lambda: self.scheduler.active)
+        watch("inflight_calls", lambda: len(self.inflight))
+        if self.tag_cache is not None:
+            # Running totals, the hit rate over a window is their rate()
+            for name in CacheStats.model_fields:
+                watch(
+                    f"cache_{name}",
+                    lambda name=name: getattr(self.tag_cache.stats, name),
+                )
+            watch("cache_hit_rate", lambda: self.tag_cache.stats.hit_rate)
+        if self.phash_index is not None:
+            watch("phash_index_size", lambda: len(self.phash_index))
+        if self.profiler is not None:
+            watch("event_loop_lag", lambda: self.profiler.lag)
+        if self.ingest:
+            for state in ("queued", "leased", "failed"):
+                watch(
+                    f"jobs_{state}",
+                    lambda state=state: self.job_queue.counts().get(state, 0),
+                )
 
-    async def download(self, file):
+    def profile(self, trace_id: str, kind: str, **inputs):
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.job(trace_id, kind, **inputs)
+
+    @staticmethod
+    def pick_photo(photos):
+        return select_photo(photos, min_side=settings.download.photo_min_side)
+
+    async def download(self, file) -> Optional[ImageBuffer]:
+        """
+        :raise FileTooLarge: over ``download.max_size``
+        """
         assert hasattr(file, "file_id"), "file_id not found"
-        name = file.file_id
-        _file_info = await self.bot.get_file(file.file_id)
-        if isinstance(file, types.PhotoSize):
-            name = f"{_file_info.file_unique_id}.jpg"
-        if isinstance(file, types.Document):
-            name = f"{file.file_unique_id} {file.file_name}"
-        if not name.endswith(("jpg", "png", "webp")):
+        max_size = settings.download.max_size
+        if (getattr(file, "file_size", None) or 0) > max_size:
+            raise FileTooLarge(f"{file.file_size} bytes")
+        if isinstance(file, types.Document) and not is_image_document(file):
             return None
-        downloaded_file = await self.bot.download_file(_file_info.file_path)
-        return downloaded_file
+        with stage("get_file"):
+            _file_info = await self.bot.get_file(file.file_id)
+        with stage("download") as s:
+            try:
+                return await stream_download(
+                    token=self.bot.token,
+                    file_path=_file_info.file_path,
+                    max_size=max_size,
+                    spool_size=settings.download.spool_size,
+                    chunk_size=settings.download.chunk_size,
+                )
+            except FileTooLarge:
+                s.outcome = "too_large"
+                raise
+
+    async def infer(self, file_data: ImageBuffer) -> TaggerResult:
+        content = file_data
+        if self.downscale is not None:
+            try:
+                with stage("downscale"):
+                    resized = await self.image_executor.run(self.downscale, file_data)
+            except Exception as e:
+                logger.warning(f"Downscale failed, upload original {e!r}")
+            else:
+                content = resized or file_data
+        try:
+            with stage("wd14_upload"):
+                return await pipeline_tag(
+                    trace_id=current_trace(), content=content, sdk=self.tagger_sdk
+                )
+        except aiohttp.ClientConnectorError as e:
+            # Only a tagger that cannot be reached is down, a busy one that
+            # times out fails just this job
+            self.tagger_health.mark_down(repr(e))
+            raise
+
+    async def near_duplicate(
+        self, file_data: ImageBuffer
+    ) -> Tuple[Optional[int], Optional[TaggerResult]]:
+        """
+        pHash of the image and, when an indexed image is within the radius, its
+        stored tags
+        """
+        with stage("phash") as s:
+            value = await self.image_executor.run(phash, file_data)
+            if value is None:
+                s.outcome = "skipped"
+                return None, None
+            entry = None
+            # The closest neighbour may have left the tag cache, a farther one
+            # within the radius still counts
+            for distance, digest in self.phash_index.candidates(value):
+                entry = await self.tag_cache.get_by_digest(digest, count=False)
+                if entry is not None:
+                    break
+            s.outcome = "miss" if entry is None else "hit"
+        if entry is None:
+            return value, None
+        self.tag_cache.stats.near_hits += 1
+        logger.info(f"Near duplicate of {digest} at distance {distance}")
+        return value, entry.result
+
+    async def analyze(self, file_data: ImageBuffer) -> TagCacheEntry:
+        value, infer = None, None
+        if self.phash_index is not None:
+            value, infer = await self.near_duplicate(file_data)
+        if infer is None:
+            # Infer Tags while metadata is parsed from the original in a worker,
+            # both stream from the same buffer
+            infer, (read_message, timings) = await asyncio.gather(
+                self.infer(file_data),
+                self.image_executor.run(self.read_message, file_data),
+            )
+            if value is not None:
+                self.phash_index.add(value, file_data.digest)
+        else:
+            # A repost may have lost or changed its metadata, read its own
+            read_message, timings = await self.image_executor.run(
+                self.read_message, file_data
+            )
+        for name, seconds, outcome in timings:
+            observe(name, seconds, outcome=outcome)
+        return TagCacheEntry(result=infer, read_message=read_message)
+
+    async def analyze_buffer(self, file_data: ImageBuffer) -> TagCacheEntry:
+        """
+        Analyze and close the buffer
+        """
+        try:
+            return await self.analyze(file_data)
+        finally:
+            file_data.close()
+
+    async def cached(self, file) -> Optional[str]:
+        file_unique_id = getattr(file, "file_unique_id", None)
+        if not self.tag_cache or not file_unique_id:
+            return None
+        entry = await self.tag_cache.get_by_file(file_unique_id)
+        if entry is None:
+            return None
+        return render_tag_message(entry)
+
+    @autometrics(track_concurrency=True)
+    async def tagger(self, file, trace_id: Optional[str] = None) -> str:
+        trace_id = trace_id or generate_uuid()
+        bind_job(trace_id, content_type_of(file))
+        async with self.tag_slots:
+            with self.profile(trace_id, "tag", **describe_file(file)):
+                file_unique_id = getattr(file, "file_unique_id", None)
+                if not file_unique_id:
+                    return await self._tagger(file)
+                return await self.inflight.do(
+                    ("file", file_unique_id), self._tagger, file
+                )
 
-    async def tagger(self, file) -> str:
-        raw_file_data = await self.download(file=file)
-        if raw_file_data is None:
+    async def tag_album(self, files: list, trace_id: str) -> List[str]:
+        """
+        Tag the files of one album concurrently, with a batching tagger client
+        their uploads go out together. At most ``queue.chat_concurrency`` of
+        them run at once, and they share ``queue.workers`` with other jobs.
+        """
+        album_slots = asyncio.Semaphore(settings.queue.chat_concurrency)
+
+        async def tag_item(index: int, file) -> str:
+            async with album_slots:
+                return await self.tagger(file, f"{trace_id}#{index}")
+
+        results = await asyncio.gather(
+            *[tag_item(index, file) for index, file in enumerate(files)],
+            return_exceptions=True,
+        )
+        prompts = []
+        for result in results:
+            if isinstance(result, BaseException):
+                logger.opt(exception=result).error("Album item failed")
+                result = "🥛 Tagging failed"
+            prompts.append(result)
+        return prompts
+
+    async def _tagger(self, file) -> str:
+        file_unique_id = getattr(file, "file_unique_id", None)
+        if self.tag_cache and file_unique_id:
+            entry = await self.tag_cache.get_by_file(file_unique_id)
+            if entry is not None:
+                return render_tag_message(entry)
+        try:
+            file_data = await self.download(file=file)
+        except FileTooLarge as e:
+            logger.info(f"Skip large file {e}")
+            return "🥛 Image too large"
+        if file_data is None:
             return "🥛 Not An image"
-        if isinstance(raw_file_data, bytes):
-            file_data = BytesIO(raw_file_data)
-        else:
-            file_data = raw_file_data
-        # Infer Tags
-        infer = await pipeline_tag(trace_id="test", content=file_data)
-        infer_message = [
-            formatting.mbold("🥛 Tags", escape=False),
-        ]
-        novelai_message = await read_novelai(file=file_data)
-        comfyui_message = await read_comfyui(file=file_data)
-        a111_message = await read_a111(file=file_data)
-        # 只能选一个有内容的
-        read_message = next(
-            filter(lambda msg: msg, [novelai_message, comfyui_message, a111_message]),
-            None,
+        annotate(downloaded=file_data.size, digest=file_data.digest)
+        digest = file_data.digest
+        handed_over = False
+        try:
+            entry = None
+            if self.tag_cache:
+                entry = await self.tag_cache.get_by_digest(digest)
+            if entry is None:
+                # A new flight owns the buffer and closes it, it may outlive
+                # this caller. Joining one leaves this copy to be closed here.
+                handed_over = ("sha", digest) not in self.inflight
+                entry = await self.inflight.do(
+                    ("sha", digest), self.analyze_buffer, file_data
+                )
+                if self.tag_cache:
+                    await self.tag_cache.put(
+                        digest, entry, file_unique_id=file_unique_id
+                    )
+            elif file_unique_id:
+                await self.tag_cache.link(file_unique_id, digest)
+        finally:
+            if not handed_over:
+                file_data.close()
+        return render_tag_message(entry)
+
+    async def bootstrap(self):
+        """
+        Probe Telegram and the tagger concurrently within one time budget.
+
+        A tagger that is not up yet does not stop the bot, it starts degraded
+        and the tagger is re-probed in the background.
+        """
+        budget = settings.startup.probe_budget
+        me, _, commands = await asyncio.gather(
+            asyncio.wait_for(self.bot.get_me(), budget),
+            asyncio.wait_for(self.tagger_health.probe(), budget),
+            asyncio.wait_for(self.bot.set_my_commands(commands=BOT_COMMANDS), budget),
+            return_exceptions=True,
         )
-        if read_message:
-            infer_message.append(cite(content=infer.anime_tags))
+        if isinstance(me, BaseException):
+            logger.error(f"\n🍀TelegramBot Init Connection Failed --error {me!r}")
         else:
-            infer_message.append(code(content=infer.anime_tags, language="txt"))
-        if infer.characters:
-            infer_message.append(formatting.mbold("🥛 Characters", escape=False))
-            infer_message.append(
-                code(content=",".join(infer.characters), language="txt")
+            BotSetting.bot_id = str(me.id)
+            BotSetting.bot_username = me.username
+            BotSetting.bot_link = f"https://t.me/{me.username}"
+            logger.success(
+                f"🍀TelegramBot Init Connection Success --bot_name {me.username} --bot_id {me.id}"
+            )
+        if isinstance(commands, BaseException):
+            logger.warning(f"Set commands failed {commands!r}")
+        if not self.tagger_health.ready:
+            logger.warning("Tagger not ready, starting degraded")
+            self.tagger_health.watch()
+
+    async def catch_up(self) -> Optional[BacklogCatchup]:
+        """
+        Fetch the updates sent while the bot was down and start answering them
+        behind live traffic
+        """
+        if not settings.catchup.enable:
+            return None
+        if settings.webhook.enable and not BotSetting.webhook_url:
+            logger.warning("Backlog not caught up, the webhook is registered elsewhere")
+            return None
+        # Pending updates can only be fetched while no webhook is set
+        await self.bot.delete_webhook()
+        catchup = BacklogCatchup(
+            self.bot,
+            max_age=settings.catchup.max_age,
+            parallelism=settings.catchup.parallelism,
+            ready=lambda: self.tagger_health.ready,
+        )
+        watch("backlog_pending", lambda: catchup.pending)
+        watch("backlog_done", lambda: catchup.done)
+        watch("backlog_expired", lambda: catchup.expired)
+        watch("backlog_duplicates", lambda: catchup.duplicates)
+        await catchup.fetch(allowed_updates=util.update_types)
+        catchup.start()
+        return catchup
+
+    @staticmethod
+    def configure_api():
+        from telebot import asyncio_helper
+
+        if BotSetting.proxy_address:
+            asyncio_helper.proxy = BotSetting.proxy_address
+            logger.info("Proxy tunnels are being used!")
+        if BotSetting.api_server:
+            server = BotSetting.api_server.rstrip("/")
+            asyncio_helper.API_URL = f"{server}/bot{{0}}/{{1}}"
+            asyncio_helper.FILE_URL = f"{server}/file/bot{{0}}/{{1}}"
+            logger.info(f"Bot API server {server}")
+
+    async def reply_markdown(
+        self,
+        chat_id: int,
+        text: str,
+        reply_to_message_id: int = None,
+    ):
+        # Same trace id as the tagging job the reply answers
+        trace_id = f"{chat_id}:{reply_to_message_id}"
+        with self.profile(trace_id, "reply", text_length=len(text)):
+            with stage("telegramify", content_type="text"):
+                blocks = await telegramify_markdown.telegramify(
+                    text,
+                    max_word_count=1000,
+                )
+            annotate(blocks=[item.content_type.value for item in blocks])
+            # Blocks of one reply go out in order, other chats are not held up
+            async with self.sender.ordered(chat_id):
+                for item in blocks:
+                    try:
+                        with stage(
+                            "send_message", content_type=item.content_type.value
+                        ):
+                            await self.sender.call(
+                                chat_id,
+                                self.send_block,
+                                chat_id,
+                                item,
+                                reply_to_message_id,
+                            )
+                    except Exception as e:
+                        logger.exception(e)
+
+    async def reply_to(self, message: types.Message, **kwargs):
+        return await self.sender.call(
+            message.chat.id, self.bot.reply_to, message, **kwargs
+        )
+
+    async def send_block(self, chat_id: int, item, reply_to_message_id: int = None):
+        bot = self.bot
+        if item.content_type == ContentTypes.TEXT:
+            await bot.send_message(
+                chat_id=chat_id,
+                reply_to_message_id=reply_to_message_id,
+                text=item.content,
+                parse_mode="MarkdownV2",
+            )
+        elif item.content_type == ContentTypes.PHOTO:
+            await bot.send_photo(
+                chat_id,
+                (item.file_name, item.file_data),
+                caption=item.caption,
+                reply_to_message_id=reply_to_message_id,
+                parse_mode="MarkdownV2",
+            )
+        elif item.content_type == ContentTypes.FILE:
+            await bot.send_document(
+                chat_id,
+                (item.file_name, item.file_data),
+                caption=item.caption,
+                reply_to_message_id=reply_to_message_id,
+                parse_mode="MarkdownV2",
+            )
+
+    async def enqueue(self, message: types.Message, kind: str, files: list):
+        """
+        Queue a tagging job for the worker processes, they send the reply
+        """
+        backlog = in_backlog()
+        payload = {
+            "trace_id": f"{message.chat.id}:{message.id}",
+            "reply_to": message.id,
+            "files": [file_payload(file) for file in files],
+        }
+        try:
+            ahead = await self.job_queue.put(
+                message.chat.id, kind, payload, priority=1 if backlog else 0
+            )
+        except QueueFull as e:
+            logger.info(f"Queue full {e}")
+            return await self.reply_to(message, text="🥛 Busy, please try again later")
+        # Running jobs are leased, not queued, so anything ahead means a wait
+        if ahead > 0 and not backlog:
+            await self.reply_to(
+                message, text=f"🥛 Busy, queued at position {ahead + 1}"
+            )
+
+    async def run_job(self, worker: str, job: QueuedJob):
+        payload = job.payload
+        files = [file_from_payload(item) for item in payload["files"]]
+        try:
+            if job.kind == "album":
+                prompts = await self.tag_album(files, payload["trace_id"])
+                text = render_album_message(prompts)
+            else:
+                text = await self.tagger(files[0], payload["trace_id"])
+            await self.reply_markdown(
+                chat_id=job.chat_id,
+                reply_to_message_id=payload["reply_to"],
+                text=text,
             )
-        if not read_message:
-            infer_message.append(formatting.mbold("🥛 No Metadata", escape=False))
+        except Exception as e:
+            logger.opt(exception=e).error(
+                f"Job {job.id} failed, attempt {job.attempts}"
+            )
+            await self.job_queue.fail(worker, job.id, repr(e))
         else:
-            infer_message.extend(read_message)
-        file_data.close()
-        return "\n".join(infer_message)
+            await self.job_queue.complete(worker, job.id)
+
+    async def run_worker(self):
+        """
+        Worker process: claim jobs from the queue, tag and reply, until
+        cancelled. Unfinished jobs are handed back on the way out.
+        """
+        worker = f"{os.uname().nodename}:{os.getpid()}:{self.worker}"
+        logger.info(f"Worker {worker} started")
+        self.configure_api()
+        if not await self.tagger_health.probe():
+            logger.warning("Tagger not ready, waiting for it")
+            self.tagger_health.watch()
+        metrics_server = None
+        if settings.metrics.enable:
+            # Every process is scraped on its own port
+            metrics_server = MetricsServer(
+                host=settings.metrics.host, port=settings.metrics.port + 1 + self.worker
+            )
+            await metrics_server.start()
+        if self.profiler is not None:
+            await self.profiler.start()
+        queue = self.job_queue
+        capacity = settings.queue.workers
+        running: Dict[int, asyncio.Task] = {}
+        renew_at = 0.0
+        try:
+            while True:
+                jobs = []
+                if self.tagger_health.ready and len(running) < capacity:
+                    jobs = await queue.claim(worker, capacity - len(running))
+                for job in jobs:
+                    task = asyncio.create_task(self.run_job(worker, job))
+                    running[job.id] = task
+                    task.add_done_callback(
+                        lambda _, job_id=job.id: running.pop(job_id, None)
+                    )
+                if running and time.monotonic() >= renew_at:
+                    renew_at = time.monotonic() + queue.lease / 3
+                    await queue.renew(worker, list(running))
+                if not jobs:
+                    await asyncio.sleep(settings.workers.poll_interval)
+        finally:
+            unfinished = list(running)
+            for task in list(running.values()):
+                task.cancel()
+            await asyncio.gather(*running.values(), return_exceptions=True)
+            await queue.release(worker, unfinished)
+            queue.close()
+            if metrics_server is not None:
+                await metrics_server.stop()
+            if self.profiler is not None:
+                await self.profiler.stop()
+            await self.tagger_health.close()
+            await self.tagger_sdk.close()
+            self.image_executor.close()
+            if self.tag_cache:
+                await self.tag_cache.close()
+            if self.phash_index is not None:
+                self.phash_index.close()
+            logger.info(f"Worker {worker} stopped")
 
     async def run(self):
         logger.info("Bot Start")
         bot = self.bot
-        if BotSetting.proxy_address:
-            from telebot import asyncio_helper
-
-            asyncio_helper.proxy = BotSetting.proxy_address
-            logger.info("Proxy tunnels are being used!")
+        self.configure_api()
+        reply_markdown = self.reply_markdown
+        reply_to = self.reply_to
+
+        async def queued(message: types.Message, func, *args):
+            # Caught up updates wait behind live ones, without a position notice
+            backlog = in_backlog()
+            try:
+                future, position = self.scheduler.submit(
+                    message.chat.id, func, *args, background=backlog
+                )
+            except QueueFull as e:
+                logger.info(f"Queue full {e}")
+                await reply_to(message, text="🥛 Busy, please try again later")
+                return None
+            if position and not backlog:
+                await reply_to(message, text=f"🥛 Busy, queued at position {position}")
+            return await future
+
+        async def tag_and_reply(message: types.Message, file):
+            # Known files skip the queue, everything else waits its turn
+            prompt = await self.cached(file)
+            if prompt is None:
+                if not self.tagger_health.ready:
+                    return await reply_to(message, text=DEGRADED_MESSAGE)
+                if self.job_queue is not None:
+                    return await self.enqueue(message, "tag", [file])
+                prompt = await queued(
+                    message, self.tagger, file, f"{message.chat.id}:{message.id}"
+                )
+                if prompt is None:
+                    return
+            return await reply_markdown(
+                chat_id=message.chat.id, reply_to_message_id=message.id, text=prompt
+            )
 
-        async def reply_markdown(
-            chat_id: int,
-            text: str,
-            reply_to_message_id: int = None,
-        ):
-            blocks = await telegramify_markdown.telegramify(
-                text,
-                max_word_count=1000,
+        async def album_and_reply(messages: List[types.Message]):
+            # One job and one reply for the whole album
+            first = messages[0]
+            if not self.tagger_health.ready:
+                return await reply_to(first, text=DEGRADED_MESSAGE)
+            files = [
+                self.pick_photo(item.photo) if item.photo else item.document
+                for item in messages
+            ]
+            if self.job_queue is not None:
+                return await self.enqueue(first, "album", files)
+            prompts = await queued(
+                first, self.tag_album, files, f"{first.chat.id}:{first.id}"
+            )
+            if prompts is None:
+                return
+            return await reply_markdown(
+                chat_id=first.chat.id,
+                reply_to_message_id=first.id,
+                text=render_album_message(prompts),
             )
-            for item in blocks:
-                try:
-                    if item.content_type == ContentTypes.TEXT:
-                        await bot.send_message(
-                            chat_id=chat_id,
-                            reply_to_message_id=reply_to_message_id,
-                            text=item.content,
-                            parse_mode="MarkdownV2",
-                        )
-                    elif item.content_type == ContentTypes.PHOTO:
-                        await bot.send_photo(
-                            chat_id,
-                            (item.file_name, item.file_data),
-                            caption=item.caption,
-                            reply_to_message_id=reply_to_message_id,
-                            parse_mode="MarkdownV2",
-                        )
-                    elif item.content_type == ContentTypes.FILE:
-                        await bot.send_document(
-                            chat_id,
-                            (item.file_name, item.file_data),
-                            caption=item.caption,
-                            reply_to_message_id=reply_to_message_id,
-                            parse_mode="MarkdownV2",
-                        )
-                except Exception as e:
-                    logger.exception(e)
 
         @bot.message_handler(
             content_types=["photo", "document"], chat_types=["private"]
@@ -283,16 +790,15 @@ class BotRunner(object):
                 if message.chat.id not in settings.mode.white_group:
                     return logger.info(f"White List Out {message.chat.id}")
             logger.info(f"Report in {message.chat.id} {message.from_user.id}")
+            if message.media_group_id:
+                album = await self.albums.collect(message)
+                if album is not None:
+                    await album_and_reply(album)
+                return
             if message.photo:
-                prompt = await self.tagger(file=message.photo[-1])
-                await reply_markdown(
-                    chat_id=message.chat.id, reply_to_message_id=message.id, text=prompt
-                )
+                await tag_and_reply(message, file=self.pick_photo(message.photo))
             if message.document:
-                prompt = await self.tagger(file=message.document)
-                await reply_markdown(
-                    chat_id=message.chat.id, reply_to_message_id=message.id, text=prompt
-                )
+                await tag_and_reply(message, file=message.document)
 
         @bot.message_handler(
             commands="scene_composition", chat_types=["supergroup", "group", "private"]
@@ -301,7 +807,7 @@ class BotRunner(object):
             if settings.mode.only_white:
                 if message.chat.id not in settings.mode.white_group:
                     return logger.info(f"White List Out {message.chat.id}")
-            contents = prompt_generator.generate_scene_composition()
+            contents = prompt_generator().generate_scene_composition()
             prompt = [formatting.mbold("🥛 Scene Composition Prompt", escape=False)]
             for content in contents:
                 prompt.append(f"- `{content}`")
@@ -318,7 +824,7 @@ class BotRunner(object):
             if settings.mode.only_white:
                 if message.chat.id not in settings.mode.white_group:
                     return logger.info(f"White List Out {message.chat.id}")
-            contents = prompt_generator.generate_scene_tags()
+            contents = prompt_generator().generate_scene_tags()
             prompt = [formatting.mbold("🥛 Scene Prompt", escape=False)]
             for content in contents:
                 prompt.append(f"- `{content}`")
@@ -335,11 +841,11 @@ class BotRunner(object):
             if settings.mode.only_white:
                 if message.chat.id not in settings.mode.white_group:
                     return logger.info(f"White List Out {message.chat.id}")
-            contents = prompt_generator.generate_common_tags(nsfw=True)
+            contents = prompt_generator().generate_common_tags(nsfw=True)
             prompt = formatting.format_text(
                 formatting.mbold("🥛 NSFW Prompt"), formatting.mcode(content=contents)
             )
-            return await bot.reply_to(message, text=prompt, parse_mode="MarkdownV2")
+            return await reply_to(message, text=prompt, parse_mode="MarkdownV2")
 
         @bot.message_handler(
             commands="sfw", chat_types=["supergroup", "group", "private"]
@@ -348,11 +854,11 @@ class BotRunner(object):
             if settings.mode.only_white:
                 if message.chat.id not in settings.mode.white_group:
                     return logger.info(f"White List Out {message.chat.id}")
-            contents = prompt_generator.generate_common_tags(nsfw=False)
+            contents = prompt_generator().generate_common_tags(nsfw=False)
             prompt = formatting.format_text(
                 formatting.mbold("🥛 SFW Prompt"), formatting.mcode(content=contents)
             )
-            return await bot.reply_to(message, text=prompt, parse_mode="MarkdownV2")
+            return await reply_to(message, text=prompt, parse_mode="MarkdownV2")
 
         @bot.message_handler(commands="tag", chat_types=["supergroup", "group"])
         async def tag(message: types.Message):
@@ -361,7 +867,7 @@ class BotRunner(object):
                     return logger.info(f"White List Out {message.chat.id}")
 
             if not message.reply_to_message:
-                return await bot.reply_to(
+                return await reply_to(
                     message,
                     text=f"🍡 Please reply a photo with this command, chat id:({message.chat.id})",
                 )
@@ -370,33 +876,77 @@ class BotRunner(object):
             reply_message_ph = reply_message.photo
             reply_message_doc = reply_message.document
             if reply_message_ph:
-                prompt = await self.tagger(file=reply_message_ph[-1])
-                return await reply_markdown(
-                    chat_id=message.chat.id, reply_to_message_id=message.id, text=prompt
+                return await tag_and_reply(
+                    message, file=self.pick_photo(reply_message_ph)
                 )
             if reply_message_doc:
-                prompt = await self.tagger(file=reply_message_doc)
-                return await reply_markdown(
-                    chat_id=message.chat.id, reply_to_message_id=message.id, text=prompt
-                )
-            return await bot.reply_to(message, text="🥛 Not image")
-
-        await bot.set_my_commands(
-            commands=[
-                types.BotCommand("tag", "Tag Image"),
-                types.BotCommand("scene", "Generate Scene Prompt"),
-                types.BotCommand(
-                    "scene_composition", "Generate Scene Composition Prompt"
-                ),
-                types.BotCommand("nsfw", "Generate NSFW Prompt"),
-                types.BotCommand("sfw", "Generate SFW Prompt"),
-            ],
-        )
-        try:
-            await bot.polling(
-                non_stop=True, allowed_updates=util.update_types, skip_pending=True
+                return await tag_and_reply(message, file=reply_message_doc)
+            return await reply_to(message, text="🥛 Not image")
+
+        await self.bootstrap()
+        metrics_server = None
+        if settings.metrics.enable:
+            metrics_server = MetricsServer(
+                host=settings.metrics.host, port=settings.metrics.port
             )
+            await metrics_server.start()
+        if self.profiler is not None:
+            await self.profiler.start()
+        catchup = None
+        if self.supervisor is not None:
+            await self.supervisor.start()
+        try:
+            catchup = await self.catch_up()
+        except Exception as e:
+            # Live traffic matters more than the backlog
+            logger.opt(exception=e).error("Backlog catch up failed, skipping it")
+        try:
+            if settings.webhook.enable:
+                server = WebhookServer(
+                    bot,
+                    path=settings.webhook.path,
+                    host=settings.webhook.host,
+                    port=settings.webhook.port,
+                    secret_token=BotSetting.webhook_secret,
+                    queue_size=settings.webhook.queue_size,
+                    workers=settings.webhook.workers,
+                )
+                watch("webhook_queue", server.queue.qsize)
+                await server.serve(
+                    url=BotSetting.webhook_url,
+                    allowed_updates=util.update_types,
+                    drop_pending_updates=catchup is None,
+                )
+            else:
+                # A webhook left behind by an earlier run blocks getUpdates
+                await bot.delete_webhook()
+                if catchup is not None:
+                    # Go on after the fetched backlog
+                    bot.offset = catchup.offset
+                await bot.polling(
+                    non_stop=True,
+                    allowed_updates=util.update_types,
+                    skip_pending=catchup is None,
+                )
         except ApiTelegramException as e:
             logger.opt(exception=e).exception("ApiTelegramException")
         except Exception as e:
             logger.exception(e)
+        finally:
+            if catchup is not None:
+                await catchup.close()
+            if self.supervisor is not None:
+                await self.supervisor.stop()
+                self.job_queue.close()
+            if metrics_server is not None:
+                await metrics_server.stop()
+            if self.profiler is not None:
+                await self.profiler.stop()
+            await self.scheduler.close()
+            await self.tagger_health.close()
+            await self.tagger_sdk.close()
+            self.image_executor.close()
+            if self.tag_cache:
+                await self.tag_cache.close()
+            if self.phash_index is not None:
+                self.phash_index.close()
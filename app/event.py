@@ -3,13 +3,18 @@
 # @Author  : sudoskys
 # @File    : event.py
 # @Software: PyCharm
-from io import TextIOBase
-from typing import Union, IO, Optional
+import os
+from typing import Union, Optional
 
+from autometrics import autometrics
 from loguru import logger
 from pydantic import BaseModel
 
-from app.utils import WdTaggerSDK
+from app.batcher import TagBatcher
+from app.fetch import ImageBuffer
+from app.onnx_tagger import OnnxTagger
+from app.pool import TaggerPool
+from app.utils import TaggerBackend, WdTaggerSDK
 from setting.wdtagger import TaggerSetting
 
 
@@ -18,10 +23,74 @@ class TaggerResult(BaseModel):
     characters: Optional[list] = []
 
 
-async def pipeline_tag(trace_id, content: Union[IO, TextIOBase]) -> TaggerResult:
-    content.seek(0)
-    raw_output_wd = await WdTaggerSDK(base_url=TaggerSetting.wd_api_endpoint).upload(
-        file=content.read(),
+def build_onnx_tagger() -> TagBatcher:
+    model_path = TaggerSetting.wd_model_path
+    if not model_path:
+        raise ValueError("WD_MODEL_PATH is required by the onnx backend")
+    tags_path = TaggerSetting.wd_tags_path or os.path.join(
+        os.path.dirname(model_path), "selected_tags.csv"
+    )
+    backend = OnnxTagger(
+        model_path=model_path,
+        tags_path=tags_path,
+        intra_threads=TaggerSetting.wd_intra_threads,
+        inter_threads=TaggerSetting.wd_inter_threads,
+    )
+    # Images waiting together are inferred as one batch
+    return TagBatcher(
+        backend,
+        max_batch=TaggerSetting.wd_onnx_batch_size,
+        max_delay=TaggerSetting.wd_batch_max_delay_ms / 1000,
+    )
+
+
+def build_tagger_sdk() -> Union[TaggerBackend, TagBatcher]:
+    if TaggerSetting.wd_backend == "onnx":
+        return build_onnx_tagger()
+    endpoints = TaggerSetting.endpoints
+    pooled = len(endpoints) > 1
+    sdks = [
+        WdTaggerSDK(
+            base_url=url,
+            pool_size=TaggerSetting.wd_pool_size,
+            keepalive_timeout=TaggerSetting.wd_keepalive_timeout,
+            connect_timeout=TaggerSetting.wd_connect_timeout,
+            read_timeout=TaggerSetting.wd_read_timeout,
+            # The pool retries on another node instead
+            max_retries=0 if pooled else TaggerSetting.wd_max_retries,
+            retry_backoff=TaggerSetting.wd_retry_backoff,
+            # One batch URL only fits one server
+            batch_url=None if pooled else TaggerSetting.wd_batch_endpoint,
+        )
+        for url in endpoints
+    ]
+    sdk = sdks[0]
+    if pooled:
+        sdk = TaggerPool(
+            sdks,
+            max_attempts=max(TaggerSetting.wd_max_retries + 1, len(sdks)),
+            retry_backoff=TaggerSetting.wd_retry_backoff,
+            eject_after=TaggerSetting.wd_eject_after,
+            check_interval=TaggerSetting.wd_health_interval,
+            check_timeout=TaggerSetting.wd_connect_timeout,
+        )
+    if TaggerSetting.wd_batch_size <= 1:
+        return sdk
+    return TagBatcher(
+        sdk,
+        max_batch=TaggerSetting.wd_batch_size,
+        max_delay=TaggerSetting.wd_batch_max_delay_ms / 1000,
+    )
+
+
+@autometrics
+async def pipeline_tag(
+    trace_id,
+    content: Union[ImageBuffer, bytes],
+    sdk: Union[TaggerBackend, TagBatcher],
+) -> TaggerResult:
+    raw_output_wd = await sdk.upload(
+        file=content,
         token="tag",
         general_threshold=0.35,
         character_threshold=0.75,
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午4:10
+# @File    : executor.py
+# @Software: PyCharm
+import asyncio
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Optional, Set, Union
+
+from loguru import logger
+
+from app.fetch import ImageBuffer
+
+
+class SharedView(io.RawIOBase):
+    """
+    Read-only file over a memoryview, as far as the readers use ``BytesIO``.
+    Reads copy only the bytes asked for, ``getbuffer`` copies nothing.
+    """
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        start = self._position
+        end = len(self._view) if size is None or size < 0 else start + size
+        data = bytes(self._view[start:end])
+        self._position += len(data)
+        return data
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, buffer) -> int:
+        data = self._view[self._position : self._position + len(buffer)]
+        size = len(data)
+        with memoryview(buffer) as target:
+            target.cast("B")[:size] = data
+        self._position += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(offset, 0)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def getbuffer(self) -> memoryview:
+        return self._view[:]
+
+    def getvalue(self) -> bytes:
+        return bytes(self._view)
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+def _run_shared(func: Callable, name: str, size: int):
+    # Runs inside the worker, the payload is read in place from shared memory
+    block = SharedMemory(name=name)
+    file = SharedView(block.buf[:size])
+    try:
+        return func(file)
+    finally:
+        file.close()
+        block.close()
+
+
+class _Pool(object):
+    __slots__ = ("executor", "inflight", "retired")
+
+    def __init__(self, executor: ProcessPoolExecutor):
+        self.executor = executor
+        # Callers still waiting on a job of this pool
+        self.inflight = 0
+        self.retired = False
+
+
+class ImageExecutor(object):
+    """
+    Runs CPU bound image jobs away from the event loop.
+
+    With ``max_workers`` set, jobs go to a process pool and the image bytes are
+    handed over through one shared memory block instead of being pickled into
+    the call. Without workers, jobs fall back to the default thread pool.
+
+    A job that overruns ``timeout`` retires its pool: new jobs go to a fresh
+    one, the jobs already running there still finish, and then its processes
+    are killed with the hung worker among them. A worker that dies breaks its
+    whole pool at once, as far as ``ProcessPoolExecutor`` goes it cannot be
+    isolated, so that pool is replaced right away and its jobs retried once.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 0,
+        timeout: float = 30,
+        preload=(
+            "app.reader",
+            "app.preprocess",
+            "app.phash",
+            "novelai_python.tool.image_metadata",
+        ),
+    ):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.preload = preload
+        self._pool: Optional[_Pool] = None
+        self._retired: Set[_Pool] = set()
+
+    def _get_pool(self) -> _Pool:
+        if self._pool is None:
+            # forkserver keeps workers clear of the loop, sockets and threads
+            # living in the bot process
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                # Workers fork from a server that already imported the readers
+                context.set_forkserver_preload(list(self.preload))
+            else:
+                context = multiprocessing.get_context("spawn")
+            self._pool = _Pool(
+                ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+            )
+        return self._pool
+
+    def _retire(self, pool: _Pool, reason: str):
+        # Concurrent failures of the same pool must only replace it once
+        if pool.retired:
+            return
+        logger.warning(f"Image worker pool replaced: {reason}")
+        pool.retired = True
+        self._retired.add(pool)
+        if self._pool is pool:
+            self._pool = None
+
+    def _kill(self, pool: _Pool):
+        self._retired.discard(pool)
+        for process in list(getattr(pool.executor, "_processes", {}).values()):
+            process.kill()
+        pool.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def run(self, func: Callable, data: Union[bytes, ImageBuffer]):
+        """
+        Call ``func(BytesIO(data))`` in a worker and return its result.
+
+        ``data`` may be an :class:`ImageBuffer`, its content is then copied
+        straight into shared memory without an intermediate ``bytes``.
+
+        :raise asyncio.TimeoutError: the job overran the timeout
+        """
+        if not self.max_workers:
+            if isinstance(data, ImageBuffer):
+                data = data.getvalue()
+            return await asyncio.wait_for(
+                asyncio.to_thread(func, BytesIO(data)), self.timeout
+            )
+        size = data.size if isinstance(data, ImageBuffer) else len(data)
+        block = SharedMemory(create=True, size=max(size, 1))
+        try:
+            if isinstance(data, ImageBuffer):
+                data.copy_into(block.buf)
+            else:
+                block.buf[:size] = data
+            for attempt in range(2):
+                pool = self._get_pool()
+                pool.inflight += 1
+                loop = asyncio.get_running_loop()
+                future = loop.run_in_executor(
+                    pool.executor, _run_shared, func, block.name, size
+                )
+                try:
+                    return await asyncio.wait_for(future, self.timeout)
+                except asyncio.TimeoutError:
+                    # The hung worker can only be stopped by killing it, which
+                    # waits until the other jobs of its pool are done
+                    self._retire(pool, f"job over {self.timeout}s")
+                    raise
+                except BrokenProcessPool:
+                    self._retire(pool, "worker died")
+                    if attempt:
+                        raise
+                finally:
+                    pool.inflight -= 1
+                    if pool.retired and not pool.inflight:
+                        self._kill(pool)
+        finally:
+            block.close()
+            block.unlink()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.executor.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        for pool in list(self._retired):
+            self._kill(pool)
+
+
+def default_workers(value: int) -> int:
+    """
+    ``-1`` means one worker per core, ``0`` keeps jobs in threads
+    """
+    if value < 0:
+        return os.cpu_count() or 1
+    return value
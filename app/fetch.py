@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午4:40
+# @File    : fetch.py
+# @Software: PyCharm
+import hashlib
+import tempfile
+from typing import List, Optional
+
+from telebot import asyncio_helper, types
+from telebot.asyncio_helper import ApiHTTPException
+
+IMAGE_MIME_TYPES = ("image/jpeg", "image/png", "image/webp")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+def select_photo(
+    photos: List[types.PhotoSize], min_side: int = 448
+) -> Optional[types.PhotoSize]:
+    """
+    Smallest size whose long side still covers the tagger input.
+
+    Compressed photos never carry generation metadata, so anything beyond what
+    the model resizes to is wasted download. Falls back to the largest size.
+    """
+    if not photos:
+        return None
+    ordered = sorted(photos, key=lambda p: (p.width or 0) * (p.height or 0))
+    for photo in ordered:
+        if max(photo.width or 0, photo.height or 0) >= min_side:
+            return photo
+    return ordered[-1]
+
+
+def is_image_document(document: types.Document) -> bool:
+    """
+    Decided from message fields alone, before any Bot API call
+    """
+    mime_type = (document.mime_type or "").lower()
+    if mime_type:
+        return mime_type in IMAGE_MIME_TYPES
+    return (document.file_name or "").lower().endswith(IMAGE_EXTENSIONS)
+
+
+class ImageBuffer(object):
+    """
+    A downloaded file, kept in memory up to ``spool_size`` and spilled to a
+    temporary file beyond that. The SHA-256 is computed while writing, so the
+    content never has to be read back just to be hashed.
+
+    Readers track their own offset and seek before every read, several of them
+    can share the buffer as long as they run on the event loop thread.
+    """
+
+    def __init__(self, spool_size: int = 2 * 1024 * 1024):
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    @property
+    def digest(self) -> str:
+        return self._hash.hexdigest()
+
+    def write(self, chunk: bytes):
+        self.file.seek(0, 2)
+        self.file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def getvalue(self) -> bytes:
+        return self.read_at(0, self.size)
+
+    def copy_into(self, view: memoryview, chunk_size: int = 256 * 1024):
+        offset = 0
+        while offset < self.size:
+            chunk = self.read_at(offset, chunk_size)
+            view[offset : offset + len(chunk)] = chunk
+            offset += len(chunk)
+
+    async def iter_chunks(self, chunk_size: int = 64 * 1024):
+        offset = 0
+        while offset < self.size:
+            chunk = self.read_at(offset, chunk_size)
+            offset += len(chunk)
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+async def stream_download(
+    token: str,
+    file_path: str,
+    max_size: int,
+    spool_size: int = 2 * 1024 * 1024,
+    chunk_size: int = 64 * 1024,
+) -> ImageBuffer:
+    """
+    Stream a Telegram file into an :class:`ImageBuffer`.
+
+    Same endpoint, session and proxy as ``AsyncTeleBot.download_file``, but the
+    body is never held as one ``bytes`` object.
+
+    :raise FileTooLarge: the file grows past ``max_size``
+    """
+    if asyncio_helper.FILE_URL is None:
+        url = f"https://api.telegram.org/file/bot{token}/{file_path}"
+    else:
+        url = asyncio_helper.FILE_URL.format(token, file_path)
+    session = await asyncio_helper.session_manager.get_session()
+    buffer = ImageBuffer(spool_size=spool_size)
+    try:
+        async with session.get(url, proxy=asyncio_helper.proxy) as response:
+            if response.status != 200:
+                raise ApiHTTPException("Download file", response)
+            if (response.content_length or 0) > max_size:
+                raise FileTooLarge(f"{response.content_length} bytes")
+            async for chunk in response.content.iter_chunked(chunk_size):
+                buffer.write(chunk)
+                if buffer.size > max_size:
+                    raise FileTooLarge(f"over {max_size} bytes")
+    except BaseException:
+        buffer.close()
+        raise
+    return buffer
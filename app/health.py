@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午8:20
+# @File    : health.py
+# @Software: PyCharm
+import asyncio
+from typing import List, Optional
+
+import aiohttp
+from loguru import logger
+
+
+async def probe_endpoint(
+    url: str, timeout: float, session: Optional[aiohttp.ClientSession] = None
+) -> Optional[str]:
+    """
+    HEAD ``url``, any response counts as reachable.
+
+    :return: the ``Server`` header of the answer
+    :raise Exception: the endpoint is unreachable
+    """
+    if session is None:
+        async with aiohttp.ClientSession() as session:
+            return await probe_endpoint(url, timeout, session)
+    async with session.head(
+        url, timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as response:
+        return response.headers.get("server")
+
+
+class TaggerHealth(object):
+    """
+    Whether a tagger server answers.
+
+    The tagger is ready while any of ``urls`` is reachable, an in-process
+    backend has none and is always ready. While it is down,
+    :meth:`watch` keeps re-probing in the background until one comes back, so
+    the bot can start, and keep running, through a tagger outage.
+    """
+
+    def __init__(self, urls: List[str], timeout: float = 3, interval: float = 10):
+        self.urls = urls
+        self.timeout = timeout
+        self.interval = interval
+        self.ready = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def _probe(self, url: str) -> bool:
+        try:
+            server = await probe_endpoint(url, self.timeout)
+        except Exception as e:
+            logger.warning(f"wd_api_endpoint {url} is not available {e!r}")
+            return False
+        if not self.ready:
+            if server != "uvicorn":
+                logger.warning(
+                    f"wd_api_endpoint {url} request success, but server is not uvicorn"
+                )
+            else:
+                logger.success(f"wd_api_endpoint {url} is available")
+        return True
+
+    async def probe(self) -> bool:
+        results = await asyncio.gather(*(self._probe(url) for url in self.urls))
+        self.ready = not self.urls or any(results)
+        return self.ready
+
+    def mark_down(self, reason: str):
+        if self.ready:
+            logger.warning(f"Tagger marked down: {reason}")
+        self.ready = False
+        self.watch()
+
+    def watch(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        while not self.ready:
+            await asyncio.sleep(self.interval)
+            await self.probe()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
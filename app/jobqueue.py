@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/19 上午2:00
+# @File    : jobqueue.py
+# @Software: PyCharm
+"""
+Durable job queue shared by the processes of one host, on SQLite in WAL mode.
+
+The ingest process puts jobs, worker processes claim them under a lease and
+delete them when done. A worker that dies leaves its jobs leased, and once
+the lease runs out they are handed to the next worker that claims. A job that
+keeps failing is parked as ``failed`` after ``max_attempts``.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from pydantic import BaseModel
+
+from app.scheduler import QueueFull
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, priority, id);
+CREATE INDEX IF NOT EXISTS jobs_chat ON jobs (chat_id, state);
+"""
+
+
+class QueuedJob(BaseModel):
+    id: int
+    chat_id: int
+    kind: str
+    payload: dict
+    attempts: int
+
+
+class JobQueue(object):
+    """
+    :param lease: seconds a claimed job belongs to its worker, renewed while
+        it runs
+    :param chat_concurrency: jobs of one chat leased at once, across workers
+    """
+
+    def __init__(
+        self,
+        path: str,
+        lease: float = 60,
+        max_attempts: int = 3,
+        max_pending: int = 256,
+        chat_pending: int = 16,
+        chat_concurrency: int = 2,
+        failed_ttl: float = 7 * 86400,
+    ):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self.chat_pending = chat_pending
+        self.chat_concurrency = chat_concurrency
+        self.queued = 0
+        self.recovered = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # One connection per process, used from worker threads one at a time
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # WAL stays consistent on a crash, only the last commits may be lost
+        # on a power cut
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.execute(
+            "DELETE FROM jobs WHERE state = 'failed' AND created < ?",
+            (time.time() - failed_ttl,),
+        )
+
+    def _transaction(self, func, *args):
+        with self._lock:
+            # Taking the write lock up front, readers never have to upgrade
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    def _put(self, chat_id: int, kind: str, payload: str, priority: int) -> int:
+        db = self._db
+        (pending,) = db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'queued'"
+        ).fetchone()
+        if pending >= self.max_pending:
+            raise QueueFull(f"{pending} jobs pending")
+        (chat,) = db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE chat_id = ? AND state = 'queued'",
+            (chat_id,),
+        ).fetchone()
+        if chat >= self.chat_pending:
+            raise QueueFull(f"{chat} jobs pending for chat {chat_id}")
+        db.execute(
+            "INSERT INTO jobs (chat_id, kind, payload, priority, created) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (chat_id, kind, payload, priority, time.time()),
+        )
+        self.queued = pending + 1
+        # Jobs queued ahead of this one
+        return pending
+
+    async def put(
+        self, chat_id: int, kind: str, payload: dict, priority: int = 0
+    ) -> int:
+        """
+        Queue a job, lower ``priority`` values are claimed first.
+
+        :return: jobs queued ahead of it
+        :raise QueueFull: the global or per-chat queue is at its limit
+        """
+        return await asyncio.to_thread(
+            self._transaction, self._put, chat_id, kind, json.dumps(payload), priority
+        )
+
+    def _claim(self, worker: str, limit: int) -> List[QueuedJob]:
+        db = self._db
+        now = time.time()
+        # Jobs of a dead worker go back to the queue, or are parked when they
+        # keep taking their workers down
+        recovered = db.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' "
+            "ELSE 'queued' END, worker = NULL, error = 'lease expired' "
+            "WHERE state = 'leased' AND lease_until < ?",
+            (self.max_attempts, now),
+        ).rowcount
+        self.recovered += recovered
+        rows = db.execute(
+            "SELECT id, chat_id, kind, payload, attempts FROM jobs "
+            "WHERE state = 'queued' AND chat_id NOT IN ("
+            "  SELECT chat_id FROM jobs WHERE state = 'leased' "
+            "  GROUP BY chat_id HAVING COUNT(*) >= ?"
+            ") ORDER BY priority, id LIMIT ?",
+            (self.chat_concurrency, limit * 4),
+        ).fetchall()
+        jobs: List[QueuedJob] = []
+        leased: Dict[int, int] = {}
+        for job_id, chat_id, kind, payload, attempts in rows:
+            if len(jobs) >= limit:
+                break
+            if chat_id not in leased:
+                (leased[chat_id],) = db.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE chat_id = ? AND state = 'leased'",
+                    (chat_id,),
+                ).fetchone()
+            # The subquery only saw leases from before this claim
+            if leased[chat_id] >= self.chat_concurrency:
+                continue
+            leased[chat_id] += 1
+            jobs.append(
+                QueuedJob(
+                    id=job_id,
+                    chat_id=chat_id,
+                    kind=kind,
+                    payload=json.loads(payload),
+                    attempts=attempts + 1,
+                )
+            )
+        if jobs:
+            db.executemany(
+                "UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                [(worker, now + self.lease, job.id) for job in jobs],
+            )
+        (self.queued,) = db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'queued'"
+        ).fetchone()
+        return jobs
+
+    def _claimable(self) -> bool:
+        # A plain read, idle workers polling do not take the write lock away
+        # from put
+        with self._lock:
+            queued, claimable, expired = self._db.execute(
+                "SELECT (SELECT COUNT(*) FROM jobs WHERE state = 'queued'), "
+                "EXISTS (SELECT 1 FROM jobs WHERE state = 'queued' "
+                "  AND chat_id NOT IN ("
+                "    SELECT chat_id FROM jobs WHERE state = 'leased' "
+                "    GROUP BY chat_id HAVING COUNT(*) >= ?"
+                "  )), "
+                "EXISTS (SELECT 1 FROM jobs WHERE state = 'leased' "
+                "  AND lease_until < ?)",
+                (self.chat_concurrency, time.time()),
+            ).fetchone()
+        self.queued = queued
+        return bool(claimable or expired)
+
+    def _claim_if_any(self, worker: str, limit: int) -> List[QueuedJob]:
+        if not self._claimable():
+            return []
+        return self._transaction(self._claim, worker, limit)
+
+    async def claim(self, worker: str, limit: int = 1) -> List[QueuedJob]:
+        """
+        Lease up to ``limit`` jobs to ``worker``, oldest first and at most
+        ``chat_concurrency`` per chat across all workers
+        """
+        if limit <= 0:
+            return []
+        return await asyncio.to_thread(self._claim_if_any, worker, limit)
+
+    def _renew(self, worker: str, job_ids: Tuple[int, ...]):
+        self._db.executemany(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ?",
+            [(time.time() + self.lease, job_id, worker) for job_id in job_ids],
+        )
+
+    async def renew(self, worker: str, job_ids):
+        """
+        Extend the leases of running jobs
+        """
+        if job_ids:
+            await asyncio.to_thread(
+                self._transaction, self._renew, worker, tuple(job_ids)
+            )
+
+    def _complete(self, worker: str, job_id: int):
+        self._db.execute(
+            "DELETE FROM jobs WHERE id = ? AND worker = ?", (job_id, worker)
+        )
+
+    async def complete(self, worker: str, job_id: int):
+        await asyncio.to_thread(self._transaction, self._complete, worker, job_id)
+
+    def _fail(self, worker: str, job_id: int, error: str):
+        self._db.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' "
+            "ELSE 'queued' END, worker = NULL, error = ? "
+            "WHERE id = ? AND worker = ?",
+            (self.max_attempts, error[:1000], job_id, worker),
+        )
+
+    async def fail(self, worker: str, job_id: int, error: str):
+        """
+        Give a job back for another attempt, or park it after the last one
+        """
+        await asyncio.to_thread(self._transaction, self._fail, worker, job_id, error)
+
+    def _release(self, worker: str, job_ids: Tuple[int, ...]):
+        self._db.executemany(
+            "UPDATE jobs SET state = 'queued', worker = NULL, "
+            "attempts = attempts - 1 WHERE id = ? AND worker = ?",
+            [(job_id, worker) for job_id in job_ids],
+        )
+
+    async def release(self, worker: str, job_ids):
+        """
+        Hand unfinished jobs back on shutdown, without counting the attempt
+        """
+        if job_ids:
+            await asyncio.to_thread(
+                self._transaction, self._release, worker, tuple(job_ids)
+            )
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT state, COUNT(*) FROM jobs GROUP BY state"
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
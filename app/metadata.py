@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午3:30
+# @File    : metadata.py
+# @Software: PyCharm
+"""
+Single pass metadata reader.
+
+Walks PNG chunks or WebP RIFF chunks straight from the buffer and collects every
+text field, without ever decoding pixel data. The three format readers in
+``app.controller`` consume the resulting :class:`ImageMeta`.
+"""
+
+import struct
+import zlib
+from io import BytesIO
+from typing import Dict, Optional
+
+from PIL import Image
+from loguru import logger
+from pydantic import BaseModel
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Guard against compressed text bombs, bigger than any sane workflow
+MAX_TEXT_SIZE = 16 * 1024 * 1024
+
+EXIF_IMAGE_DESCRIPTION = 0x010E
+EXIF_MAKE = 0x010F
+EXIF_MODEL = 0x0110
+EXIF_SOFTWARE = 0x0131
+EXIF_IFD_POINTER = 0x8769
+EXIF_USER_COMMENT = 0x9286
+
+
+class ImageMeta(BaseModel):
+    format: Optional[str] = None
+    width: int = 0
+    height: int = 0
+    has_alpha: bool = False
+    text: Dict[str, str] = {}
+
+    def get(self, key: str, default=None):
+        return self.text.get(key, default)
+
+
+def _inflate(data) -> bytes:
+    inflater = zlib.decompressobj()
+    out = inflater.decompress(data, MAX_TEXT_SIZE)
+    if inflater.unconsumed_tail:
+        raise ValueError("Text chunk too large")
+    return out
+
+
+def _read_png_text(chunk_type: bytes, data: memoryview):
+    raw = bytes(data)
+    keyword, _, rest = raw.partition(b"\x00")
+    key = keyword.decode("latin-1")
+    if chunk_type == b"tEXt":
+        return key, rest.decode("latin-1")
+    if chunk_type == b"zTXt":
+        # rest[0] is the compression method, always zlib
+        return key, _inflate(rest[1:]).decode("latin-1")
+    # iTXt: compression flag, method, language tag, translated keyword, text
+    compressed = rest[0]
+    rest = rest[2:]
+    _lang, _, rest = rest.partition(b"\x00")
+    _translated, _, rest = rest.partition(b"\x00")
+    if compressed:
+        rest = _inflate(rest)
+    return key, rest.decode("utf-8", errors="replace")
+
+
+def read_png(view: memoryview, meta: ImageMeta) -> ImageMeta:
+    offset = len(PNG_SIGNATURE)
+    size = len(view)
+    while offset + 8 <= size:
+        length, chunk_type = struct.unpack_from(">I4s", view, offset)
+        start = offset + 8
+        end = start + length
+        if end > size:
+            break
+        if chunk_type == b"IHDR":
+            meta.width, meta.height, _depth, color_type = struct.unpack_from(
+                ">IIBB", view, start
+            )
+            meta.has_alpha = color_type in (4, 6)
+        elif chunk_type == b"tRNS":
+            meta.has_alpha = True
+        elif chunk_type in (b"tEXt", b"zTXt", b"iTXt"):
+            try:
+                key, value = _read_png_text(chunk_type, view[start:end])
+            except Exception as e:
+                logger.debug(f"Skip broken {chunk_type} chunk {e}")
+            else:
+                meta.text[key] = value
+        elif chunk_type == b"IEND":
+            break
+        # Skip data and crc, IDAT is never touched
+        offset = end + 4
+    return meta
+
+
+def _exif_value(view, endian, field_type, count, value_offset, base):
+    # Only BYTE, ASCII and UNDEFINED carry the text we care about
+    if field_type not in (1, 2, 7):
+        return None
+    if count <= 4:
+        start = value_offset
+    else:
+        (pointer,) = struct.unpack_from(endian + "I", view, value_offset)
+        start = base + pointer
+    return bytes(view[start : start + count])
+
+
+def _decode_user_comment(raw: bytes) -> str:
+    prefix, body = raw[:8], raw[8:]
+    if prefix == b"UNICODE\x00":
+        # Writers disagree on byte order, pick the one with NULs in high bytes
+        head = body[:64]
+        if head[0::2].count(0) >= head[1::2].count(0):
+            return body.decode("utf-16-be", errors="replace")
+        return body.decode("utf-16-le", errors="replace")
+    return body.decode("utf-8", errors="replace").rstrip("\x00")
+
+
+def read_exif(data: memoryview) -> Dict[str, str]:
+    text = {}
+    if bytes(data[:6]) == b"Exif\x00\x00":
+        data = data[6:]
+    endian = "<" if bytes(data[:2]) == b"II" else ">"
+    (ifd_offset,) = struct.unpack_from(endian + "I", data, 4)
+    pending = [ifd_offset]
+    seen = set()
+    while pending:
+        ifd_offset = pending.pop()
+        if ifd_offset in seen or ifd_offset + 2 > len(data):
+            continue
+        seen.add(ifd_offset)
+        (count,) = struct.unpack_from(endian + "H", data, ifd_offset)
+        for index in range(count):
+            entry = ifd_offset + 2 + index * 12
+            if entry + 12 > len(data):
+                break
+            tag, field_type, value_count = struct.unpack_from(
+                endian + "HHI", data, entry
+            )
+            if tag == EXIF_IFD_POINTER:
+                pending.append(struct.unpack_from(endian + "I", data, entry + 8)[0])
+                continue
+            raw = _exif_value(data, endian, field_type, value_count, entry + 8, 0)
+            if raw is None:
+                continue
+            if tag == EXIF_USER_COMMENT:
+                text["parameters"] = _decode_user_comment(raw)
+            elif tag in (EXIF_IMAGE_DESCRIPTION, EXIF_MAKE, EXIF_MODEL):
+                value = raw.decode("utf-8", errors="replace").rstrip("\x00")
+                # ComfyUI stores "prompt:{...}" and "workflow:{...}" here
+                key, sep, body = value.partition(":")
+                if sep and key.lower() in ("prompt", "workflow"):
+                    text[key.lower()] = body
+                elif tag == EXIF_IMAGE_DESCRIPTION:
+                    text["Description"] = value
+            elif tag == EXIF_SOFTWARE:
+                text["Software"] = raw.decode("utf-8", errors="replace").rstrip("\x00")
+    return text
+
+
+def read_webp(view: memoryview, meta: ImageMeta) -> ImageMeta:
+    offset = 12
+    size = len(view)
+    while offset + 8 <= size:
+        chunk_type, length = struct.unpack_from("<4sI", view, offset)
+        start = offset + 8
+        end = start + length
+        if end > size:
+            break
+        if chunk_type == b"VP8X":
+            flags = view[start]
+            meta.has_alpha = bool(flags & 0x10)
+            w = int.from_bytes(view[start + 4 : start + 7], "little") + 1
+            h = int.from_bytes(view[start + 7 : start + 10], "little") + 1
+            meta.width, meta.height = w, h
+        elif chunk_type == b"VP8L" and not meta.width:
+            (bits,) = struct.unpack_from("<I", view, start + 1)
+            meta.width = (bits & 0x3FFF) + 1
+            meta.height = ((bits >> 14) & 0x3FFF) + 1
+            meta.has_alpha = bool((bits >> 28) & 1)
+        elif chunk_type == b"VP8 " and not meta.width:
+            w, h = struct.unpack_from("<HH", view, start + 6)
+            meta.width, meta.height = w & 0x3FFF, h & 0x3FFF
+        elif chunk_type == b"EXIF":
+            try:
+                meta.text.update(read_exif(view[start:end]))
+            except Exception as e:
+                logger.debug(f"Skip broken EXIF chunk {e}")
+        elif chunk_type == b"XMP ":
+            meta.text["XML:com.adobe.xmp"] = bytes(view[start:end]).decode(
+                "utf-8", errors="replace"
+            )
+        # Chunks are padded to even size
+        offset = end + (length & 1)
+    return meta
+
+
+def read_metadata(file: BytesIO) -> ImageMeta:
+    """
+    Collect text metadata of a PNG or WebP image in one pass over its bytes.
+
+    Other formats fall back to the header Pillow parses in ``Image.open``.
+    """
+    meta = ImageMeta()
+    with file.getbuffer() as view:
+        try:
+            if bytes(view[:8]) == PNG_SIGNATURE:
+                meta.format = "PNG"
+                read_png(view, meta)
+            elif bytes(view[:4]) == b"RIFF" and bytes(view[8:12]) == b"WEBP":
+                meta.format = "WEBP"
+                read_webp(view, meta)
+        except Exception as e:
+            logger.debug(f"Metadata scan stopped early {e}")
+    if meta.format is None:
+        read_with_pillow(file, meta)
+    return meta
+
+
+def read_with_pillow(file: BytesIO, meta: ImageMeta) -> ImageMeta:
+    # Image.open only parses the header, pixels stay untouched until load()
+    try:
+        file.seek(0)
+        with Image.open(file) as img:
+            meta.format = img.format
+            meta.width, meta.height = img.size
+            meta.has_alpha = "A" in img.mode or "transparency" in img.info
+            for key, value in img.info.items():
+                if isinstance(value, str):
+                    meta.text[key] = value
+            # JPEG keeps A1111 parameters in the EXIF UserComment
+            exif = img.info.get("exif")
+            if isinstance(exif, bytes):
+                for key, value in read_exif(memoryview(exif)).items():
+                    meta.text.setdefault(key, value)
+    except Exception as e:
+        logger.debug(f"Pillow could not read header {e}")
+    return meta
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午6:40
+# @File    : metrics.py
+# @Software: PyCharm
+"""
+Prometheus metrics for every stage of a tagging job.
+
+Function level call counts, latencies and concurrency come from autometrics;
+stage histograms add the ``outcome`` and ``content_type`` labels autometrics
+has no room for. Both live in the default registry served on ``/metrics``.
+"""
+
+import asyncio
+import time
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+from aiohttp import web
+from autometrics import init
+from loguru import logger
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from telebot import types
+
+from app.fetch import IMAGE_MIME_TYPES
+from app.profiler import record_stage
+
+init(tracker="prometheus", service_name="tagger-bot")
+
+STAGE_SECONDS = Histogram(
+    "tagger_bot_stage_duration_seconds",
+    "Time spent in one stage of a tagging job",
+    ["stage", "outcome", "content_type"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+STAGE_CALLS = Counter(
+    "tagger_bot_stage_calls",
+    "Stage executions",
+    ["stage", "outcome", "content_type"],
+)
+GAUGES = Gauge("tagger_bot_gauge", "Queue depths and in-flight work", ["name"])
+
+_trace_id: ContextVar[str] = ContextVar("trace_id", default="-")
+_content_type: ContextVar[str] = ContextVar("content_type", default="none")
+
+
+def bind_job(trace_id: str, content_type: str):
+    """
+    Label everything awaited from the current task, and tasks it spawns, with
+    this job
+    """
+    _trace_id.set(trace_id)
+    _content_type.set(content_type)
+
+
+def current_trace() -> str:
+    return _trace_id.get()
+
+
+def content_type_of(file) -> str:
+    if isinstance(file, types.PhotoSize):
+        return "photo"
+    if isinstance(file, types.Document):
+        mime_type = (file.mime_type or "").lower()
+        return mime_type if mime_type in IMAGE_MIME_TYPES else "document"
+    return "unknown"
+
+
+def observe(name: str, seconds: float, outcome: str = "ok", content_type=None):
+    content_type = content_type or _content_type.get()
+    STAGE_SECONDS.labels(name, outcome, content_type).observe(seconds)
+    STAGE_CALLS.labels(name, outcome, content_type).inc()
+    record_stage(name, seconds, outcome)
+
+
+class stage(object):
+    """
+    Time a block as one stage, ``outcome`` may be changed inside the block::
+
+        with stage("download") as s:
+            ...
+            s.outcome = "rejected"
+    """
+
+    def __init__(self, name: str, content_type: Optional[str] = None):
+        self.name = name
+        self.content_type = content_type
+        self.outcome = "ok"
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # An outcome set inside the block says more than the exception
+        if exc_type is not None and self.outcome == "ok":
+            if exc_type is asyncio.CancelledError:
+                self.outcome = "cancelled"
+            else:
+                self.outcome = "error"
+        observe(
+            self.name,
+            time.perf_counter() - self._start,
+            outcome=self.outcome,
+            content_type=self.content_type,
+        )
+
+
+def watch(name: str, func: Callable[[], float]):
+    """
+    Gauge read from ``func`` at scrape time
+    """
+    GAUGES.labels(name).set_function(func)
+
+
+class MetricsServer(object):
+    def __init__(self, host: str = "0.0.0.0", port: int = 9464):
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    @staticmethod
+    async def handle(request: web.Request) -> web.Response:
+        # Gauges may query the job queue, keep that off the event loop
+        body = await asyncio.to_thread(generate_latest, REGISTRY)
+        response = web.Response(body=body)
+        response.headers["Content-Type"] = CONTENT_TYPE_LATEST
+        return response
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Metrics on {self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午9:40
+# @File    : onnx_tagger.py
+# @Software: PyCharm
+"""
+Run a wd14 tagger model inside the bot with ONNX Runtime.
+
+Takes the same models as wd14-tagger-server, a ``model.onnx`` with an NHWC
+BGR input and its ``selected_tags.csv``, and answers in the server's format,
+so single host deployments can drop the HTTP round-trip and the second
+process.
+"""
+
+import asyncio
+import csv
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image
+from loguru import logger
+
+from app.preprocess import flatten
+from app.utils import TaggerBackend
+
+# Tag categories of selected_tags.csv
+GENERAL = 0
+CHARACTER = 4
+RATING = 9
+
+# Kept as they are, the others get their underscores replaced
+KAOMOJIS = {
+    "0_0",
+    "(o)_(o)",
+    "+_+",
+    "+_-",
+    "._.",
+    "<o>_<o>",
+    "<|>_<|>",
+    "=_=",
+    ">_<",
+    "3_3",
+    "6_9",
+    ">_o",
+    "@_@",
+    "^_^",
+    "o_o",
+    "u_u",
+    "x_x",
+    "|_|",
+    "||_||",
+}
+
+
+def load_tags(path: str):
+    """
+    Read ``selected_tags.csv`` once into arrays of display names and
+    categories, indexed like the model output
+    """
+    names, categories = [], []
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            name = row["name"]
+            names.append(name if name in KAOMOJIS else name.replace("_", " "))
+            categories.append(int(row["category"]))
+    return np.array(names, dtype=object), np.array(categories, dtype=np.int64)
+
+
+def prepare(data: bytes, size: int) -> np.ndarray:
+    """
+    One image as the model sees it: flattened on white, padded to a square,
+    resized to ``size`` and turned into float32 BGR
+    """
+    with Image.open(BytesIO(data)) as img:
+        img.draft("RGB", (size, size))
+        img = flatten(img)
+    side = max(img.size)
+    canvas = Image.new("RGB", (side, side), (255, 255, 255))
+    canvas.paste(img, ((side - img.width) // 2, (side - img.height) // 2))
+    canvas = canvas.resize((size, size), Image.Resampling.BICUBIC)
+    return np.asarray(canvas)
+
+
+class OnnxTagger(TaggerBackend):
+    """
+    In-process tagger on one shared ``InferenceSession``.
+
+    The session is loaded on first use. Every run goes through one inference
+    thread, so the intra-op threads are not oversubscribed. Images queued by
+    :class:`TagBatcher` are decoded in parallel, stacked and inferred as a
+    single batch.
+    """
+
+    batch_supported = True
+
+    def __init__(
+        self,
+        model_path: str,
+        tags_path: str,
+        intra_threads: int = 0,
+        inter_threads: int = 1,
+        decode_workers: int = 4,
+    ):
+        self.model_path = model_path
+        self.tags_path = tags_path
+        self.intra_threads = intra_threads or os.cpu_count() or 1
+        self.inter_threads = inter_threads
+        self._infer_pool = ThreadPoolExecutor(1, thread_name_prefix="onnx")
+        self._decode_pool = ThreadPoolExecutor(
+            decode_workers, thread_name_prefix="onnx-decode"
+        )
+        self._session = None
+        self._input_name: Optional[str] = None
+        self._size = 448
+        self._max_batch: Optional[int] = None
+        self._names: Optional[np.ndarray] = None
+        self._categories: Optional[np.ndarray] = None
+
+    def _load(self):
+        # Called in the inference thread, so only once
+        if self._session is not None:
+            return
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.intra_threads
+        options.inter_op_num_threads = self.inter_threads
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        session = onnxruntime.InferenceSession(
+            self.model_path, options, providers=["CPUExecutionProvider"]
+        )
+        model_input = session.get_inputs()[0]
+        batch, height = model_input.shape[0], model_input.shape[1]
+        self._input_name = model_input.name
+        self._size = height if isinstance(height, int) else 448
+        # A fixed batch dimension caps how many images go into one run
+        self._max_batch = batch if isinstance(batch, int) else None
+        self._names, self._categories = load_tags(self.tags_path)
+        outputs = session.get_outputs()[0].shape[-1]
+        if isinstance(outputs, int) and outputs != len(self._names):
+            raise ValueError(f"Model has {outputs} outputs but {len(self._names)} tags")
+        self._session = session
+        logger.success(
+            f"Loaded tagger model {self.model_path} ({self._size}px, "
+            f"{len(self._names)} tags, {self.intra_threads} threads)"
+        )
+
+    def _input_size(self) -> int:
+        self._load()
+        return self._size
+
+    def _infer(self, batch: np.ndarray) -> np.ndarray:
+        self._load()
+        step = self._max_batch or len(batch)
+        return np.concatenate(
+            [
+                self._session.run(None, {self._input_name: batch[i : i + step]})[0]
+                for i in range(0, len(batch), step)
+            ]
+        )
+
+    def _result(
+        self, probs: np.ndarray, general_threshold: float, character_threshold: float
+    ) -> dict:
+        names, categories = self._names, self._categories
+        general = np.flatnonzero((categories == GENERAL) & (probs > general_threshold))
+        general = general[np.argsort(-probs[general], kind="stable")]
+        character = np.flatnonzero(
+            (categories == CHARACTER) & (probs > character_threshold)
+        )
+        rating = np.flatnonzero(categories == RATING)
+        general_res = {names[i]: float(probs[i]) for i in general}
+        sorted_general_strings = (
+            ", ".join(general_res).replace("(", "\\(").replace(")", "\\)")
+        )
+        return {
+            "sorted_general_strings": sorted_general_strings,
+            "rating": {names[i]: float(probs[i]) for i in rating},
+            "character_res": {names[i]: float(probs[i]) for i in character},
+            "general_res": general_res,
+        }
+
+    async def _run(self, files: list, general_threshold, character_threshold) -> list:
+        loop = asyncio.get_running_loop()
+        # Buffers are read on the loop thread, their readers share one offset
+        payloads = [
+            file.getvalue() if hasattr(file, "getvalue") else bytes(file)
+            for file in files
+        ]
+        size = self._size
+        if self._session is None:
+            size = await loop.run_in_executor(self._infer_pool, self._input_size)
+        images = await asyncio.gather(
+            *[
+                loop.run_in_executor(self._decode_pool, prepare, data, size)
+                for data in payloads
+            ]
+        )
+        batch = np.stack(images).astype(np.float32)[..., ::-1]
+        probs = await loop.run_in_executor(
+            self._infer_pool, self._infer, np.ascontiguousarray(batch)
+        )
+        return [
+            self._result(row, general_threshold, character_threshold) for row in probs
+        ]
+
+    async def upload(
+        self, file, token, general_threshold=0.35, character_threshold=0.85
+    ) -> dict:
+        results = await self._run([file], general_threshold, character_threshold)
+        return results[0]
+
+    async def upload_batch(
+        self,
+        files: List,
+        token,
+        general_threshold=0.35,
+        character_threshold=0.85,
+    ) -> list:
+        return await self._run(files, general_threshold, character_threshold)
+
+    async def close(self):
+        self._decode_pool.shutdown(wait=False, cancel_futures=True)
+        self._infer_pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午10:10
+# @File    : phash.py
+# @Software: PyCharm
+"""
+Perceptual hashes to recognise reposts Telegram recompressed.
+
+A forwarded photo comes back with new bytes and a new file id, but its 64 bit
+pHash stays within a few bits of the original one.
+"""
+
+import os
+import time
+from array import array
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from loguru import logger
+
+from app.preprocess import flatten
+
+HASH_BITS = 64
+_SIDE = 32
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    # Orthonormal DCT-II, so a 2D transform is two matrix products
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(_SIDE)
+
+
+def phash(file: BytesIO) -> Optional[int]:
+    """
+    64 bit pHash of an image, None when it cannot be decoded.
+
+    The image is shrunk to 32x32 grey, its 8x8 lowest DCT frequencies are
+    compared with their median. Runs in image worker processes.
+    """
+    try:
+        file.seek(0)
+        with Image.open(file) as img:
+            # JPEGs decode straight at a fraction of their size
+            img.draft("RGB", (_SIDE * 4, _SIDE * 4))
+            img = flatten(img).convert("L")
+            img = img.resize((_SIDE, _SIDE), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    except Exception as e:
+        logger.debug(f"pHash skipped {e}")
+        return None
+    pixels = np.asarray(img, dtype=np.float32)
+    low = (_DCT @ pixels @ _DCT.T)[:8, :8].ravel()
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class PerceptualIndex(object):
+    """
+    Hamming distance lookup of pHashes, multi-index hashing.
+
+    A hash is cut into ``radius + 1`` chunks and every chunk is indexed in its
+    own table. Two hashes at most ``radius`` bits apart share at least one
+    chunk exactly, so a lookup only compares against the hashes found under its
+    own chunks, which stays cheap at millions of entries.
+
+    Entries point at the content digest of a :class:`TagCache` entry and
+    follow its limits: at most ``max_size`` of them, none older than ``ttl``
+    seconds. With ``path`` set they are appended to a log there, flushed with
+    every entry, loaded back on start and compacted when it outgrows them.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        radius: int = 4,
+        max_size: int = 100000,
+        ttl: float = 30 * 86400,
+    ):
+        self.radius = radius
+        self.max_size = max_size
+        self.ttl = ttl
+        chunks = radius + 1
+        widths = [
+            HASH_BITS // chunks + (1 if i < HASH_BITS % chunks else 0)
+            for i in range(chunks)
+        ]
+        self._chunks: List[Tuple[int, int]] = []
+        shift = HASH_BITS
+        for width in widths:
+            shift -= width
+            self._chunks.append((shift, (1 << width) - 1))
+        self._reset()
+        self.path = path
+        self._log = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._load(path)
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def _reset(self):
+        self._tables: List[Dict[int, array]] = [{} for _ in self._chunks]
+        self._hashes = array("Q")
+        self._added = array("d")
+        self._digests: List[str] = []
+        self._indexed: Dict[str, int] = {}
+        # Lines in the log, dropped and duplicate entries included
+        self._logged = 0
+
+    def _load(self, path: str):
+        entries: Dict[str, Tuple[int, float]] = {}
+        lines = 0
+        if os.path.exists(path):
+            now = time.time()
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        fields = line.split()
+                        value, digest = int(fields[0], 16), fields[1]
+                        # Logs written before entries carried their time
+                        added = float(fields[2]) if len(fields) > 2 else now
+                    except (ValueError, IndexError):
+                        # A torn last line from a crash
+                        continue
+                    entries.pop(digest, None)
+                    entries[digest] = (value, added)
+        self._rebuild(entries)
+        if len(self) < lines:
+            self._rewrite()
+        else:
+            self._log = open(path, "a", encoding="utf-8")
+            self._logged = lines
+        logger.info(f"Loaded {len(self)} perceptual hashes from {path}")
+
+    def _rebuild(self, entries: Dict[str, Tuple[int, float]]):
+        # Oldest first, so the newest survive the cap
+        kept = [
+            (digest, value, added)
+            for digest, (value, added) in entries.items()
+            if added >= time.time() - self.ttl
+        ][-self.max_size :]
+        self._reset()
+        for digest, value, added in kept:
+            self._insert(value, digest, added)
+
+    def _rewrite(self):
+        if self._log is not None:
+            self._log.close()
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            for index, digest in enumerate(self._digests):
+                f.write(self._line(self._hashes[index], digest, self._added[index]))
+        os.replace(temporary, self.path)
+        self._log = open(self.path, "a", encoding="utf-8")
+        self._logged = len(self)
+
+    def compact(self):
+        """
+        Drop expired entries, keep the newest ``max_size`` and rewrite the log
+        """
+        self._rebuild(
+            {
+                digest: (self._hashes[index], self._added[index])
+                for index, digest in enumerate(self._digests)
+            }
+        )
+        if self.path:
+            self._rewrite()
+
+    @staticmethod
+    def _line(value: int, digest: str, added: float) -> str:
+        return f"{value:016x} {digest} {added:.0f}\n"
+
+    def _insert(self, value: int, digest: str, added: float):
+        index = len(self._hashes)
+        self._hashes.append(value)
+        self._added.append(added)
+        self._digests.append(digest)
+        self._indexed[digest] = index
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            key = (value >> shift) & mask
+            bucket = table.get(key)
+            if bucket is None:
+                bucket = table[key] = array("I")
+            bucket.append(index)
+
+    def candidates(self, value: int) -> List[Tuple[int, str]]:
+        """
+        Live indexed hashes within ``radius``, as (distance, digest), closest
+        first
+        """
+        found: Dict[int, int] = {}
+        oldest = time.time() - self.ttl
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            for index in table.get((value >> shift) & mask, ()):
+                if index in found or self._added[index] < oldest:
+                    continue
+                distance = hamming(self._hashes[index], value)
+                if distance <= self.radius:
+                    found[index] = distance
+        ordered = sorted(found.items(), key=lambda item: (item[1], -item[0]))
+        return [(distance, self._digests[index]) for index, distance in ordered]
+
+    def add(self, value: int, digest: str):
+        if digest in self._indexed:
+            # The same bytes again, their hash is indexed already
+            return
+        added = time.time()
+        self._insert(value, digest, added)
+        if self._log is not None:
+            self._log.write(self._line(value, digest, added))
+            # Workers get killed, what is written has to survive them
+            self._log.flush()
+            self._logged += 1
+        # Some slack, so compaction stays rare
+        if len(self) > self.max_size * 1.25 or self._logged > self.max_size * 2:
+            self.compact()
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
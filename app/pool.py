@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午9:10
+# @File    : pool.py
+# @Software: PyCharm
+import asyncio
+import random
+import time
+from typing import List, Optional
+
+import aiohttp
+from loguru import logger
+
+from app.health import probe_endpoint
+from app.utils import BatchUnsupported, TaggerBackend, WdTaggerSDK
+
+
+class _Node(object):
+    def __init__(self, sdk: WdTaggerSDK):
+        self.sdk = sdk
+        self.inflight = 0
+        # Moving average of the seconds an upload took here
+        self.latency = 0.0
+        self.failures = 0
+        self.healthy = True
+
+    @property
+    def url(self) -> str:
+        return self.sdk.base_url
+
+    @property
+    def score(self) -> float:
+        # Expected wait behind what is already in flight
+        return (self.inflight + 1) * max(self.latency, 0.001)
+
+
+class TaggerPool(TaggerBackend):
+    """
+    Spread uploads over several wd14-tagger-server instances.
+
+    Each call goes to the healthy node with the least expected wait, its
+    in-flight count times its recent latency. A connection error, timeout or
+    5xx is retried on another node, and ``eject_after`` failures in a row eject
+    the node until the background check finds it answering again. When every
+    node is ejected they are all tried anyway, the check may be behind.
+
+    Offers the :class:`WdTaggerSDK` calls, so :class:`TagBatcher` and
+    ``pipeline_tag`` use it unchanged.
+    """
+
+    def __init__(
+        self,
+        sdks: List[WdTaggerSDK],
+        max_attempts: int = 3,
+        retry_backoff: float = 0.3,
+        eject_after: int = 3,
+        check_interval: float = 5,
+        check_timeout: float = 3,
+    ):
+        self.nodes = [_Node(sdk) for sdk in sdks]
+        self.max_attempts = max(max_attempts, 1)
+        self.retry_backoff = retry_backoff
+        self.eject_after = eject_after
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self._checker: Optional[asyncio.Task] = None
+
+    @property
+    def batch_supported(self) -> bool:
+        return any(node.sdk.batch_supported for node in self.nodes)
+
+    @property
+    def healthy(self) -> int:
+        return sum(1 for node in self.nodes if node.healthy)
+
+    def _pick(self, tried: List[_Node], batch: bool = False) -> Optional[_Node]:
+        nodes = [node for node in self.nodes if not batch or node.sdk.batch_supported]
+        nodes = [node for node in nodes if node.healthy] or nodes
+        fresh = [node for node in nodes if node not in tried] or nodes
+        if not fresh:
+            return None
+        # Idle nodes tie, do not always favour the first one
+        random.shuffle(fresh)
+        return min(fresh, key=lambda node: node.score)
+
+    def _succeeded(self, node: _Node, seconds: float):
+        node.latency = (
+            seconds if not node.latency else 0.8 * node.latency + 0.2 * seconds
+        )
+        node.failures = 0
+        if not node.healthy:
+            node.healthy = True
+            logger.success(f"Tagger node {node.url} re-admitted")
+
+    def _failed(self, node: _Node, error: Exception):
+        node.failures += 1
+        logger.warning(f"Tagger node {node.url} failed {error!r}")
+        if node.healthy and node.failures >= self.eject_after:
+            node.healthy = False
+            logger.warning(f"Tagger node {node.url} ejected")
+
+    async def _call(self, method: str, *args, batch: bool = False, **kwargs):
+        self._ensure_checker()
+        tried: List[_Node] = []
+        error: Optional[Exception] = None
+        for attempt in range(self.max_attempts):
+            node = self._pick(tried, batch=batch)
+            if node is None:
+                raise BatchUnsupported("no tagger node supports batch upload")
+            if node in tried:
+                # Out of other nodes, give this one a moment
+                await asyncio.sleep(
+                    random.uniform(0, self.retry_backoff * (2**attempt))
+                )
+            tried.append(node)
+            node.inflight += 1
+            started = time.perf_counter()
+            try:
+                result = await getattr(node.sdk, method)(*args, **kwargs)
+            except BatchUnsupported as e:
+                error = e
+                continue
+            except aiohttp.ClientResponseError as e:
+                if e.status < 500:
+                    raise
+                self._failed(node, e)
+                error = e
+                continue
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self._failed(node, e)
+                error = e
+                continue
+            finally:
+                node.inflight -= 1
+            self._succeeded(node, time.perf_counter() - started)
+            return result
+        raise error
+
+    async def upload(
+        self, file, token, general_threshold=0.35, character_threshold=0.85
+    ):
+        return await self._call(
+            "upload",
+            file,
+            token,
+            general_threshold=general_threshold,
+            character_threshold=character_threshold,
+        )
+
+    async def upload_batch(
+        self, files: list, token, general_threshold=0.35, character_threshold=0.85
+    ) -> list:
+        return await self._call(
+            "upload_batch",
+            files,
+            token,
+            batch=True,
+            general_threshold=general_threshold,
+            character_threshold=character_threshold,
+        )
+
+    def _ensure_checker(self):
+        if self._checker is None or self._checker.done():
+            self._checker = asyncio.create_task(self._check_loop())
+
+    async def _check(self, node: _Node):
+        try:
+            await probe_endpoint(node.url, self.check_timeout, node.sdk._get_session())
+        except Exception as e:
+            if node.healthy:
+                node.healthy = False
+                logger.warning(f"Tagger node {node.url} ejected, check failed {e!r}")
+            return
+        if not node.healthy:
+            node.healthy = True
+            node.failures = 0
+            logger.success(f"Tagger node {node.url} re-admitted")
+
+    async def _check_loop(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await asyncio.gather(*(self._check(node) for node in self.nodes))
+
+    async def close(self):
+        if self._checker is not None:
+            self._checker.cancel()
+            await asyncio.gather(self._checker, return_exceptions=True)
+            self._checker = None
+        await asyncio.gather(*(node.sdk.close() for node in self.nodes))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午5:10
+# @File    : preprocess.py
+# @Software: PyCharm
+"""
+Shrink images to what the tagger actually looks at before uploading them.
+
+wd14 models composite transparency on white, pad to a square and resize to
+448px, so a downscaled, flattened copy tags the same as the original while
+being a fraction of its size. Runs in image worker processes.
+"""
+
+from io import BytesIO
+from typing import Optional
+
+from PIL import Image
+from loguru import logger
+
+
+def flatten(img: Image.Image) -> Image.Image:
+    # Same white matte the tagger server applies
+    if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+        img = img.convert("RGBA")
+        canvas = Image.new("RGBA", img.size, (255, 255, 255, 255))
+        canvas.alpha_composite(img)
+        return canvas.convert("RGB")
+    return img.convert("RGB")
+
+
+def downscale_for_tagger(
+    file: BytesIO,
+    max_side: int = 1024,
+    image_format: str = "JPEG",
+    quality: int = 95,
+) -> Optional[bytes]:
+    """
+    Return a re-encoded copy no larger than ``max_side``, or None when the
+    original is already small enough or cannot be decoded, callers then
+    upload the original.
+    """
+    try:
+        file.seek(0)
+        with Image.open(file) as img:
+            width, height = img.size
+            if max(width, height) <= max_side and img.format == image_format:
+                return None
+            scale = max_side / max(width, height)
+            target = (
+                max(1, round(width * min(scale, 1))),
+                max(1, round(height * min(scale, 1))),
+            )
+            if img.format == "JPEG":
+                # DCT scaling, decodes at 1/2, 1/4 or 1/8 size directly
+                img.draft("RGB", target)
+            # reducing_gap lets Pillow box-reduce by an integer factor first
+            img.thumbnail(target, Image.Resampling.LANCZOS, reducing_gap=2.0)
+            img = flatten(img)
+            out = BytesIO()
+            if image_format == "PNG":
+                img.save(out, format="PNG", compress_level=1)
+            elif image_format == "WEBP":
+                img.save(out, format="WEBP", quality=quality, method=2)
+            else:
+                img.save(out, format="JPEG", quality=quality, subsampling=0)
+            return out.getvalue()
+    except Exception as e:
+        logger.debug(f"Downscale skipped {e}")
+        return None
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/19 上午12:10
+# @File    : profiler.py
+# @Software: PyCharm
+"""
+Slow job profiler, cheap enough to leave on in production.
+
+Every job records the stages it went through with their timings. A sampler
+thread keeps a rolling window of the stacks of all threads and a loop task
+measures event loop lag. When a job runs over the threshold, the stacks sampled
+while it ran are dumped as a JSON report, together with its stages, loop lag
+and input, into a directory keeping the newest reports.
+"""
+
+import asyncio
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Deque, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+
+class JobTrace(object):
+    __slots__ = ("trace_id", "kind", "inputs", "start", "stages")
+
+    def __init__(self, trace_id: str, kind: str, inputs: dict):
+        self.trace_id = trace_id
+        self.kind = kind
+        self.inputs = inputs
+        self.start = time.perf_counter()
+        self.stages: List[dict] = []
+
+
+_job: ContextVar[Optional[JobTrace]] = ContextVar("profiled_job", default=None)
+
+
+def record_stage(name: str, seconds: float, outcome: str):
+    """
+    Add a finished stage to the job profiled in the current context, if any
+    """
+    job = _job.get()
+    if job is None:
+        return
+    at = time.perf_counter() - seconds - job.start
+    job.stages.append(
+        {
+            "name": name,
+            "at": round(at, 4),
+            "seconds": round(seconds, 4),
+            "outcome": outcome,
+        }
+    )
+
+
+def annotate(**inputs):
+    """
+    Add what was learned along the way, like the downloaded size, to the input
+    of the current job
+    """
+    job = _job.get()
+    if job is not None:
+        job.inputs.update(inputs)
+
+
+def describe_file(file) -> dict:
+    # What Telegram tells about a file before it is downloaded
+    described = {"type": type(file).__name__}
+    for name in ("file_size", "width", "height", "mime_type", "file_name"):
+        value = getattr(file, name, None)
+        if value is not None:
+            described[name] = value
+    return described
+
+
+class profile_job(object):
+    """
+    Profile the block as one job, everything awaited in it, and tasks it
+    spawns, report their stages to it
+    """
+
+    def __init__(self, profiler: "SlowJobProfiler", trace_id: str, kind: str, inputs):
+        self.profiler = profiler
+        self.job = JobTrace(trace_id, kind, inputs)
+        self._token = None
+
+    def __enter__(self):
+        self._token = _job.set(self.job)
+        return self.job
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _job.reset(self._token)
+        if exc_type is asyncio.CancelledError:
+            outcome = "cancelled"
+        elif exc_type is not None:
+            outcome = "error"
+        else:
+            outcome = "ok"
+        self.profiler.finish(self.job, outcome)
+
+
+def _safe_name(trace_id: str) -> str:
+    return re.sub(r"[^\w.-]", "_", trace_id)[:64]
+
+
+class SlowJobProfiler(object):
+    """
+    :param threshold: seconds a job may take before it is dumped
+    :param sample_interval: seconds between stack samples
+    :param max_overhead: share of the time the sampler may take, counting its
+        wait for the GIL, the interval is stretched when a sample costs more
+    :param window: seconds of samples kept, longer jobs get their last window
+    :param cooldown: seconds between two dumps, so a stall that slows every job
+        down writes one report and not hundreds
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        threshold: float = 10.0,
+        keep: int = 50,
+        sample_interval: float = 0.01,
+        max_overhead: float = 0.01,
+        max_depth: int = 48,
+        window: float = 120.0,
+        lag_interval: float = 0.1,
+        cooldown: float = 10.0,
+    ):
+        self.directory = directory
+        self.threshold = threshold
+        self.keep = keep
+        self.sample_interval = sample_interval
+        self.max_overhead = max_overhead
+        self.max_depth = max_depth
+        self.window = window
+        self.lag_interval = lag_interval
+        self.cooldown = cooldown
+        self.lag = 0.0
+        self.dumped = 0
+        # (time, stacks of every thread), appended by the sampler thread
+        self._samples: Deque[Tuple[float, Tuple[str, ...]]] = deque(
+            maxlen=max(1, int(window / sample_interval))
+        )
+        self._lags: Deque[Tuple[float, float]] = deque(
+            maxlen=max(1, int(window / lag_interval))
+        )
+        self._lock = threading.Lock()
+        self._frames: Dict[object, str] = {}
+        self._threads: Dict[int, str] = {}
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._lag_task: Optional[asyncio.Task] = None
+        self._last_dump = 0.0
+        # Seconds the sampler spent walking stacks or waiting for the GIL
+        self.spent = 0.0
+        self.started = self.stopped = 0.0
+
+    def job(self, trace_id: str, kind: str, **inputs) -> profile_job:
+        return profile_job(self, trace_id, kind, inputs)
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._stop.clear()
+        self.started = time.perf_counter()
+        self.stopped = 0.0
+        self._sampler = threading.Thread(
+            target=self._sample_loop, name="profiler", daemon=True
+        )
+        self._sampler.start()
+        self._lag_task = asyncio.create_task(self._lag_loop())
+        logger.info(
+            f"Profiling jobs over {self.threshold}s into {self.directory}, "
+            f"sampling every {self.sample_interval * 1000:g}ms"
+        )
+
+    @property
+    def overhead(self) -> float:
+        """Share of the time since start the sampler has taken"""
+        elapsed = (self.stopped or time.perf_counter()) - self.started
+        return self.spent / elapsed if self.started and elapsed > 0 else 0.0
+
+    async def stop(self):
+        self._stop.set()
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._sampler is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._sampler.join)
+            self._sampler = None
+        self.stopped = time.perf_counter()
+
+    async def _lag_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            self.lag = max(0.0, loop.time() - start - self.lag_interval)
+            self._lags.append((time.perf_counter(), self.lag))
+
+    def _frame_name(self, code) -> str:
+        name = self._frames.get(code)
+        if name is None:
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            name = self._frames[code] = f"{module}:{code.co_name}"
+        return name
+
+    def _thread_name(self, ident: int) -> str:
+        name = self._threads.get(ident)
+        if name is None:
+            self._threads = {t.ident: t.name for t in threading.enumerate()}
+            name = self._threads.get(ident, str(ident))
+        return name
+
+    def _sample(self) -> Tuple[str, ...]:
+        own = threading.get_ident()
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            names = []
+            while frame is not None and len(names) < self.max_depth:
+                names.append(self._frame_name(frame.f_code))
+                frame = frame.f_back
+            names.append(self._thread_name(ident))
+            stacks.append(";".join(reversed(names)))
+        return tuple(stacks)
+
+    def _sample_loop(self):
+        interval = self.sample_interval
+        due = time.perf_counter()
+        while not self._stop.is_set():
+            began = time.perf_counter()
+            stacks = self._sample()
+            with self._lock:
+                self._samples.append((began, stacks))
+            # Waking up late is mostly waiting for the GIL, which forces the
+            # busy thread to hand it over, so that is charged too
+            cost = time.perf_counter() - began + max(0.0, began - due)
+            self.spent += cost
+            # Keep the share of the time the sampler takes under max_overhead
+            delay = max(interval, cost / self.max_overhead) - cost
+            due = time.perf_counter() + delay
+            self._stop.wait(delay)
+
+    def finish(self, job: JobTrace, outcome: str):
+        end = time.perf_counter()
+        seconds = end - job.start
+        if seconds < self.threshold:
+            return
+        if end - self._last_dump < self.cooldown:
+            logger.info(f"Slow job {job.trace_id} took {seconds:.1f}s, in cooldown")
+            return
+        self._last_dump = end
+        report = self._report(job, outcome, end)
+        logger.warning(
+            f"Slow job {job.trace_id} took {seconds:.1f}s, profiled "
+            f"{report['sampling']['samples']} samples"
+        )
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(report)
+        else:
+            loop.run_in_executor(None, self._write, report)
+
+    def _report(self, job: JobTrace, outcome: str, end: float) -> dict:
+        with self._lock:
+            samples = [item for item in self._samples if item[0] >= job.start]
+            oldest = self._samples[0][0] if self._samples else end
+        stacks = Counter(stack for _, sampled in samples for stack in sampled)
+        lags = [lag for at, lag in self._lags if at >= job.start]
+        seconds = end - job.start
+        return {
+            "trace_id": job.trace_id,
+            "kind": job.kind,
+            "started_at": datetime.fromtimestamp(
+                time.time() - seconds, tz=timezone.utc
+            ).isoformat(),
+            "seconds": round(seconds, 4),
+            "threshold": self.threshold,
+            "outcome": outcome,
+            "input": job.inputs,
+            "stages": job.stages,
+            "loop_lag": {
+                "max": round(max(lags, default=0.0), 4),
+                "mean": round(sum(lags) / len(lags), 4) if lags else 0.0,
+            },
+            "sampling": {
+                "samples": len(samples),
+                "interval": self.sample_interval,
+                # The job started before the oldest sample kept
+                "truncated": oldest > job.start,
+            },
+            # Folded stacks, ``jq -r '.stacks[]'`` feeds flamegraph tools
+            "stacks": [f"{stack} {count}" for stack, count in stacks.most_common()],
+        }
+
+    def _write(self, report: dict):
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        path = os.path.join(
+            self.directory, f"{stamp}-{_safe_name(report['trace_id'])}.json"
+        )
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=1, default=str)
+            self.dumped += 1
+            reports = sorted(
+                name for name in os.listdir(self.directory) if name.endswith(".json")
+            )
+            for name in reports[: max(0, len(reports) - self.keep)]:
+                os.remove(os.path.join(self.directory, name))
+        except OSError as e:
+            logger.error(f"Write profile {path} failed {e!r}")
@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午4:05
+# @File    : reader.py
+# @Software: PyCharm
+"""
+Metadata readers, kept free of bot and setting imports so process workers can
+load them cheaply.
+"""
+
+import json
+import time
+from io import BytesIO
+from typing import TYPE_CHECKING, List, Tuple
+
+import json_repair
+from PIL import Image
+from loguru import logger
+from telebot import formatting
+
+from app.a1111 import A1111Parameters, parse_parameters
+from app.metadata import ImageMeta, read_metadata
+
+if TYPE_CHECKING:
+    from novelai_python.tool.image_metadata import ImageMetadata
+
+
+def cite(
+    content: str,
+):
+    return f">{content}\n"
+
+
+def code(
+    content: str,
+    language: str,
+):
+    return f"```{language}\n{content}\n```"
+
+
+def mono(content: str):
+    return f"`{content}`"
+
+
+def _quote(text: str) -> str:
+    return "".join(cite(content=line) for line in text.splitlines() if line.strip())
+
+
+def _settings_lines(parameters: A1111Parameters) -> List[str]:
+    lines = []
+    if parameters.model:
+        lines.append(f"📦 Model: {mono(parameters.model)}")
+    parts = []
+    name = "/".join(filter(None, (parameters.sampler, parameters.scheduler)))
+    if name:
+        parts.append(mono(name))
+    if parameters.steps is not None:
+        parts.append(f"{parameters.steps} steps")
+    if parameters.cfg_scale is not None:
+        parts.append(f"CFG {parameters.cfg_scale:g}")
+    if parameters.seed is not None:
+        parts.append(f"seed {parameters.seed}")
+    if parameters.size:
+        parts.append("{}x{}".format(*parameters.size))
+    if parts:
+        lines.append(f"📦 Sampler: {', '.join(parts)}")
+    hires = parameters.hires
+    if "Hires upscale" in hires or "Hires upscaler" in hires:
+        detail = [
+            mono(hires.get("Hires upscaler", "upscale")),
+            f"x{hires['Hires upscale']}" if "Hires upscale" in hires else "",
+            f"{hires['Hires steps']} steps" if "Hires steps" in hires else "",
+            f"denoise {hires['Denoising strength']}"
+            if "Denoising strength" in hires
+            else "",
+        ]
+        lines.append(f"📦 Hires: {', '.join(filter(None, detail))}")
+    models = [
+        value
+        for key, value in parameters.adetailer.items()
+        if key.startswith("ADetailer model")
+    ]
+    if models:
+        lines.append(f"📦 ADetailer: {', '.join(mono(model) for model in models)}")
+    return lines
+
+
+def read_a111(meta: ImageMeta):
+    try:
+        parameter = meta.get("parameters")
+        if not parameter:
+            raise Exception("Empty Parameter")
+        parameters = parse_parameters(parameter)
+        if not parameters.prompt and not parameters.settings:
+            raise Exception("No prompt or settings")
+    except Exception as e:
+        logger.debug(f"Error {e}")
+        return []
+    message = [
+        formatting.mbold("📦 Prompt", escape=False),
+        code(content=parameters.prompt, language="txt"),
+    ]
+    if parameters.negative_prompt:
+        message.append(formatting.mbold("📦 Negative Prompt", escape=False))
+        message.append(_quote(parameters.negative_prompt))
+    message.extend(_settings_lines(parameters))
+    return message
+
+
+CHECKPOINT_INPUTS = ("ckpt_name", "unet_name", "model_name")
+SAMPLER_INPUTS = ("sampler_name", "scheduler", "steps", "cfg", "denoise")
+SEED_INPUTS = ("seed", "noise_seed")
+TEXT_INPUTS = ("text", "text_g", "text_l", "string", "value", "prompt")
+
+
+def load_comfyui_graph(parameter: str):
+    # ComfyUI writes valid JSON, the repairing parser is only for broken chunks
+    try:
+        return json.loads(parameter)
+    except ValueError:
+        return json_repair.loads(parameter)
+
+
+def _is_link(value) -> bool:
+    return (
+        isinstance(value, list)
+        and len(value) == 2
+        and isinstance(value[0], (str, int))
+        and isinstance(value[1], int)
+    )
+
+
+def _resolve(graph: dict, value, seen: set):
+    """
+    Follow a ``[node_id, slot]`` link to the literal a primitive node holds
+    """
+    while _is_link(value) and str(value[0]) not in seen:
+        seen.add(str(value[0]))
+        node = graph.get(str(value[0])) or {}
+        inputs = node.get("inputs") or {}
+        value = next(
+            (inputs[key] for key in TEXT_INPUTS + SEED_INPUTS if key in inputs), None
+        )
+    return None if _is_link(value) else value
+
+
+def _prompt_texts(graph: dict, link, seen: set) -> List[str]:
+    """
+    Prompt text that ends up in a conditioning input, through combine, concat
+    and area nodes
+    """
+    if not _is_link(link) or str(link[0]) in seen:
+        return []
+    seen.add(str(link[0]))
+    inputs = (graph.get(str(link[0])) or {}).get("inputs") or {}
+    texts = []
+    for key in TEXT_INPUTS:
+        text = _resolve(graph, inputs.get(key), set(seen))
+        if isinstance(text, str) and text.strip() and text not in texts:
+            texts.append(text.strip())
+    if texts:
+        return texts
+    for value in inputs.values():
+        texts.extend(_prompt_texts(graph, value, seen))
+    return texts
+
+
+class ComfyuiSummary(object):
+    """
+    The parts of a ComfyUI API graph people ask about
+    """
+
+    def __init__(self, graph: dict):
+        self.checkpoints: List[str] = []
+        self.loras: List[Tuple[str, list]] = []
+        self.samplers: List[dict] = []
+        self.positive: List[str] = []
+        self.negative: List[str] = []
+        nodes = [node for node in graph.values() if isinstance(node, dict)]
+        for node in nodes:
+            inputs = node.get("inputs") or {}
+            for key in CHECKPOINT_INPUTS:
+                name = inputs.get(key)
+                if isinstance(name, str) and name not in self.checkpoints:
+                    self.checkpoints.append(name)
+            self._read_loras(inputs)
+            is_sampler = "positive" in inputs or "Sampler" in str(
+                node.get("class_type", "")
+            )
+            if is_sampler and any(key in inputs for key in SAMPLER_INPUTS):
+                self._read_sampler(graph, inputs)
+        if not self.positive and not self.negative:
+            # No sampler to start from, list every text encoder instead
+            for node_id, node in graph.items():
+                if isinstance(node, dict) and "CLIPTextEncode" in str(
+                    node.get("class_type", "")
+                ):
+                    self.positive.extend(_prompt_texts(graph, [node_id, 0], set()))
+
+    def _read_loras(self, inputs: dict):
+        name = inputs.get("lora_name")
+        if isinstance(name, str):
+            strength = [
+                inputs[key]
+                for key in ("strength_model", "strength_clip")
+                if isinstance(inputs.get(key), (int, float))
+            ]
+            self.loras.append((name, strength))
+        # Stacker nodes keep one dict per slot
+        for value in inputs.values():
+            if isinstance(value, dict) and isinstance(value.get("lora"), str):
+                if value.get("on", True) and value["lora"] != "None":
+                    strength = value.get("strength")
+                    self.loras.append(
+                        (value["lora"], [strength] if strength is not None else [])
+                    )
+
+    def _read_sampler(self, graph: dict, inputs: dict):
+        sampler = {}
+        for key in SEED_INPUTS + SAMPLER_INPUTS:
+            value = _resolve(graph, inputs.get(key), set())
+            if value is not None:
+                sampler[key] = value
+        self.samplers.append(sampler)
+        for text in _prompt_texts(graph, inputs.get("positive"), set()):
+            if text not in self.positive:
+                self.positive.append(text)
+        for text in _prompt_texts(graph, inputs.get("negative"), set()):
+            if text not in self.negative:
+                self.negative.append(text)
+
+    def __bool__(self):
+        return bool(self.checkpoints or self.loras or self.samplers or self.positive)
+
+
+def _sampler_line(sampler: dict) -> str:
+    parts = []
+    name = "/".join(
+        str(sampler[key]) for key in ("sampler_name", "scheduler") if key in sampler
+    )
+    if name:
+        parts.append(mono(name))
+    if "steps" in sampler:
+        parts.append(f"{sampler['steps']} steps")
+    if "cfg" in sampler:
+        parts.append(f"CFG {sampler['cfg']}")
+    if sampler.get("denoise", 1) != 1:
+        parts.append(f"denoise {sampler['denoise']}")
+    for key in SEED_INPUTS:
+        if key in sampler:
+            parts.append(f"seed {sampler[key]}")
+    return f"📦 Sampler: {', '.join(parts)}"
+
+
+def read_comfyui(meta: ImageMeta, graph: bool = True):
+    """
+    Summary of a ComfyUI prompt graph. With ``graph`` the whole graph follows
+    as one code block, which goes out as a single document.
+    """
+    try:
+        parameter = meta.get("prompt")
+        if not parameter:
+            raise Exception("Empty Parameter")
+        decoded_object = load_comfyui_graph(parameter)
+        if not isinstance(decoded_object, dict):
+            raise Exception("Not a ComfyUI graph")
+        summary = ComfyuiSummary(decoded_object)
+    except Exception as e:
+        logger.debug(f"Error {e}")
+        return []
+    message = [formatting.mbold("📦 Comfyui", escape=False)]
+    for name in summary.checkpoints:
+        message.append(f"📦 Checkpoint: {mono(name)}")
+    for name, strength in summary.loras:
+        weight = "/".join(str(value) for value in strength)
+        message.append(f"📦 LoRA: {mono(name)} {weight}".rstrip())
+    for sampler in summary.samplers:
+        message.append(_sampler_line(sampler))
+    if summary.positive:
+        message.append(formatting.mbold("📦 Prompt", escape=False))
+        message.append(_quote("\n".join(summary.positive)))
+    if summary.negative:
+        message.append(formatting.mbold("📦 Negative Prompt", escape=False))
+        message.append(_quote("\n".join(summary.negative)))
+    if graph or not summary:
+        message.append(
+            code(
+                content=json.dumps(decoded_object, indent=1, ensure_ascii=False),
+                language="json",
+            )
+        )
+    return message
+
+
+def novelai_from_text(meta: ImageMeta) -> "ImageMetadata":
+    # novelai_python is heavy to import, only NovelAI images pay for it
+    from novelai_python.tool.image_metadata import CommentModel, ImageMetadata
+
+    comment = json.loads(meta.get("Comment", "{}"))
+    comment["prompt"] = comment.get("prompt", "")
+    return ImageMetadata.model_validate(
+        {
+            **meta.text,
+            "Comment": CommentModel.model_validate(comment).model_dump(mode="python"),
+        }
+    )
+
+
+def needs_pixels(meta: ImageMeta) -> bool:
+    """
+    Stealth metadata and the NovelAI signature live in the alpha channel LSB,
+    opaque images and ones already claimed by another tool never need a decode
+    """
+    if not meta.has_alpha:
+        return False
+    if "Comment" in meta.text:
+        return True
+    return not any(key in meta.text for key in ("parameters", "prompt", "workflow"))
+
+
+def read_novelai(file: BytesIO, meta: ImageMeta):
+    message = []
+    is_novelai, has_latent = False, False
+    try:
+        if needs_pixels(meta):
+            from novelai_python.tool.image_metadata import (
+                ImageMetadata,
+                ImageVerifier,
+            )
+
+            file.seek(0)
+            with Image.open(file) as img:
+                meta_data = ImageMetadata.load_image(img)
+                try:
+                    is_novelai, has_latent = ImageVerifier().verify(img)
+                except Exception:
+                    logger.debug("Not NovelAI")
+        elif "Comment" in meta.text:
+            meta_data = novelai_from_text(meta)
+        else:
+            return []
+        rq_type = meta_data.Comment.request_type
+        mode = ""
+        if rq_type == "PromptGenerateRequest":
+            mode += "Text2Image"
+        elif rq_type == "Img2ImgRequest":
+            mode += "Img2Img"
+        if meta_data.Comment.reference_strength:
+            mode += "+VibeTransfer"
+        if not meta_data.Comment.prompt:
+            return []
+    except Exception as e:
+        logger.debug(f"Empty metadata {e}")
+        return []
+
+    message.append(formatting.mbold("📦 NovelAI", escape=False))
+    message.append(f"📦 Mode: {mode}")
+    if meta_data.Comment.prompt:
+        message.append(code(content=meta_data.Comment.prompt, language="txt"))
+    if meta_data.Comment.negative_prompt:
+        message.append(
+            code(
+                content=meta_data.Comment.negative_prompt,
+                language="txt",
+            )
+        )
+    if meta_data.used_model:
+        model_tag = str(meta_data.used_model.value).replace("-", "_")
+        message.append(
+            formatting.mbold(f"📦 Model #{model_tag}", escape=False),
+        )
+    if meta_data.Source:
+        source_tag = meta_data.Source.lower().replace(" ", "_")
+        message.append(
+            formatting.mbold(f"📦 Source #{source_tag}", escape=False),
+        )
+    if is_novelai:
+        message.append(formatting.mbold("🧊 Signed by NovelAI", escape=False))
+    if has_latent:
+        message.append(formatting.mbold("🧊 Find Latent Space", escape=False))
+    message.append(
+        code(
+            content=meta_data.Comment.model_dump_json(indent=2),
+            language="json",
+        )
+    )
+    return message
+
+
+def _timed(timings: list, name: str, func, **kwargs):
+    start = time.perf_counter()
+    try:
+        result = func(**kwargs)
+    except Exception:
+        timings.append((name, time.perf_counter() - start, "error"))
+        raise
+    timings.append((name, time.perf_counter() - start, "ok" if result else "empty"))
+    return result
+
+
+def read_image_message_timed(
+    file: BytesIO, comfyui_graph: bool = True
+) -> Tuple[list, List[tuple]]:
+    """
+    :func:`read_image_message` plus ``(stage, seconds, outcome)`` per reader, for
+    the parent process to record since metrics cannot leave a worker
+    """
+    timings = []
+    meta = _timed(timings, "read_metadata", read_metadata, file=file)
+    novelai_message = _timed(
+        timings, "read_novelai", read_novelai, file=file, meta=meta
+    )
+    if novelai_message:
+        return novelai_message, timings
+    # 只能选一个有内容的
+    message = _timed(
+        timings, "read_comfyui", read_comfyui, meta=meta, graph=comfyui_graph
+    ) or _timed(timings, "read_a111", read_a111, meta=meta)
+    return message, timings
+
+
+def read_image_message(file: BytesIO) -> list:
+    """
+    Blocking, run it in an executor
+    """
+    return read_image_message_timed(file)[0]
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午6:10
+# @File    : scheduler.py
+# @Software: PyCharm
+import asyncio
+from collections import Counter, deque
+from typing import Any, Callable, Deque, Dict, Hashable, Optional, Set, Tuple
+
+
+class QueueFull(Exception):
+    pass
+
+
+class _Job(object):
+    __slots__ = ("chat_id", "func", "args", "future")
+
+    def __init__(self, chat_id, func, args, future):
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.future = future
+
+
+class FairScheduler(object):
+    """
+    Bounded job queue drained by at most ``workers`` concurrent jobs.
+
+    Every chat has its own FIFO and chats are served round-robin, so one chat
+    posting a hundred images delays others by at most one job per turn. A chat
+    never runs more than ``chat_concurrency`` jobs at once, and submissions
+    beyond ``max_pending`` overall or ``chat_pending`` per chat are refused
+    instead of queued.
+
+    Background jobs, like a backlog caught up on at startup, wait in one FIFO
+    that is only served when no chat has a job ready to start.
+    """
+
+    def __init__(
+        self,
+        workers: int = 8,
+        max_pending: int = 256,
+        chat_pending: int = 16,
+        chat_concurrency: int = 2,
+    ):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.chat_pending = chat_pending
+        self.chat_concurrency = chat_concurrency
+        self.pending = 0
+        self._queues: Dict[Hashable, Deque[_Job]] = {}
+        # Chats with queued jobs, in serving order
+        self._ring: Deque[Hashable] = deque()
+        self._background: Deque[_Job] = deque()
+        self._running: Counter = Counter()
+        self._active = 0
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def submit(
+        self, chat_id: Hashable, func: Callable, *args, background: bool = False
+    ) -> Tuple[asyncio.Future, int]:
+        """
+        Queue ``func(*args)`` for ``chat_id``, behind every other job when
+        ``background`` is set.
+
+        :return: future of the result and the queue position, 0 when the job
+            started right away
+        :raise QueueFull: the global or per-chat queue is at its limit
+        """
+        queue = self._queues.get(chat_id)
+        if self.pending >= self.max_pending:
+            raise QueueFull(f"{self.pending} jobs pending")
+        if queue is not None and len(queue) >= self.chat_pending:
+            raise QueueFull(f"{len(queue)} jobs pending for chat {chat_id}")
+        future = asyncio.get_running_loop().create_future()
+        if background:
+            job = _Job(chat_id, func, args, future)
+            self._background.append(job)
+            self.pending += 1
+            self._dispatch()
+            # Everything pending is ahead of the last background job
+            return future, self.pending if job in self._background else 0
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            self._ring.append(chat_id)
+        queue.append(_Job(chat_id, func, args, future))
+        self.pending += 1
+        self._dispatch()
+        if self._queues.get(chat_id) is not queue:
+            # Our job was the last of the chat, it only leaves the queue by starting
+            return future, 0
+        return future, self.position(chat_id, len(queue) - 1)
+
+    def position(self, chat_id: Hashable, index: int) -> int:
+        """
+        1-based place of the ``index``-th queued job of ``chat_id`` in the
+        round-robin order
+        """
+        ahead = index
+        before = True
+        for other in self._ring:
+            if other == chat_id:
+                before = False
+                continue
+            ahead += min(len(self._queues[other]), index + 1 if before else index)
+        return ahead + 1
+
+    def _next(self) -> Optional[_Job]:
+        for i, chat_id in enumerate(self._ring):
+            if self._running[chat_id] < self.chat_concurrency:
+                del self._ring[i]
+                queue = self._queues[chat_id]
+                job = queue.popleft()
+                if queue:
+                    self._ring.append(chat_id)
+                else:
+                    del self._queues[chat_id]
+                return job
+        # Every waiting chat is served or at its concurrency limit
+        for i, job in enumerate(self._background):
+            if self._running[job.chat_id] < self.chat_concurrency:
+                del self._background[i]
+                return job
+        return None
+
+    def _dispatch(self):
+        while self._active < self.workers:
+            job = self._next()
+            if job is None:
+                return
+            self.pending -= 1
+            if job.future.done():
+                # The caller gave up while waiting
+                continue
+            self._active += 1
+            self._running[job.chat_id] += 1
+            task = asyncio.create_task(self._run(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: _Job):
+        try:
+            result: Any = await job.func(*job.args)
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._active -= 1
+            self._running[job.chat_id] -= 1
+            if self._running[job.chat_id] <= 0:
+                del self._running[job.chat_id]
+            self._dispatch()
+
+    async def close(self):
+        for queue in [*self._queues.values(), self._background]:
+            for job in queue:
+                job.future.cancel()
+        self._queues.clear()
+        self._background.clear()
+        self._ring.clear()
+        self.pending = 0
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午8:50
+# @File    : sender.py
+# @Software: PyCharm
+import asyncio
+import random
+import time
+import weakref
+from typing import Awaitable, Callable, Dict
+
+import aiohttp
+from loguru import logger
+from telebot.asyncio_helper import ApiTelegramException, RequestTimeout
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.burst and now >= self.paused_until
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class OutboundSender(object):
+    """
+    Every Bot API send goes through here.
+
+    Calls wait for a token from their chat's bucket and from the global one,
+    sized after Telegram's limits: about 30 messages per second overall, one
+    per second in a private chat and 20 per minute in a group. A 429 pauses
+    the chat for ``retry_after`` and the call is retried, network errors and
+    5xx back off exponentially. Other API errors are raised to the caller.
+
+    Replies hold their chat's lock from :meth:`ordered` so their blocks are not
+    interleaved with another reply to the same chat, while different chats send
+    concurrently.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 25,
+        private_rate: float = 1,
+        private_burst: float = 3,
+        group_rate: float = 20 / 60,
+        group_burst: float = 3,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+    ):
+        self.global_bucket = TokenBucket(rate=global_rate, burst=global_rate)
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = (
+            weakref.WeakValueDictionary()
+        )
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > 4096:
+                # A full bucket behaves like a new one, forget those
+                for key in [k for k, v in self._buckets.items() if v.idle]:
+                    del self._buckets[key]
+            if chat_id < 0:
+                bucket = TokenBucket(rate=self.group_rate, burst=self.group_burst)
+            else:
+                bucket = TokenBucket(rate=self.private_rate, burst=self.private_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def ordered(self, chat_id: int) -> asyncio.Lock:
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        return lock
+
+    async def _backoff(self, attempt: int):
+        await asyncio.sleep(random.uniform(0, self.backoff * (2**attempt)))
+
+    async def call(self, chat_id: int, func: Callable[..., Awaitable], *args, **kwargs):
+        """
+        ``await func(*args, **kwargs)`` within the rate limits of ``chat_id``,
+        retried on flood waits and transient errors
+        """
+        bucket = self._bucket(chat_id)
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await func(*args, **kwargs)
+            except ApiTelegramException as e:
+                if attempt >= self.max_retries:
+                    raise
+                if e.error_code == 429:
+                    parameters = e.result_json.get("parameters") or {}
+                    retry_after = parameters.get("retry_after", 1)
+                    logger.warning(f"Flood wait {retry_after}s in chat {chat_id}")
+                    bucket.pause(retry_after)
+                elif e.error_code >= 500:
+                    await self._backoff(attempt)
+                else:
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError, RequestTimeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(f"Send failed {e!r}, retry {attempt + 1}")
+                await self._backoff(attempt)
+            attempt += 1
@@ -4,7 +4,13 @@
 # @File    : utils.py
 # @Software: PyCharm
 
+import asyncio
+import random
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
 import aiohttp
+from loguru import logger
 
 
 def parse_command(command):
@@ -25,26 +31,224 @@ def generate_uuid():
     return str(shortuuid.uuid())
 
 
-class WdTaggerSDK:
-    def __init__(self, base_url):
-        self.base_url = base_url
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls sharing a key into one in-flight task.
+
+    The work runs in its own task, so a waiter being cancelled does not cancel
+    it for the others; its result or exception is delivered to every waiter.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable], *args, **kwargs):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+        else:
+            logger.debug(f"Join in-flight call {key}")
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+
+def file_field(file):
+    """
+    Multipart value for an upload, buffers are streamed chunk by chunk
+    """
+    if hasattr(file, "iter_chunks"):
+        return file.iter_chunks()
+    return file
+
 
+class BatchUnsupported(Exception):
+    pass
+
+
+class TaggerBackend(ABC):
+    """
+    What ``pipeline_tag`` needs from a tagger.
+
+    ``upload`` answers like wd14-tagger-server, a dict with at least
+    ``sorted_general_strings`` and ``character_res``. Backends that can tag
+    several images in one go set ``batch_supported`` and implement
+    ``upload_batch``, :class:`TagBatcher` then groups queued images for them.
+    """
+
+    batch_supported = False
+
+    @abstractmethod
     async def upload(
         self, file, token, general_threshold=0.35, character_threshold=0.85
+    ) -> dict: ...
+
+    async def upload_batch(
+        self, files: list, token, general_threshold=0.35, character_threshold=0.85
+    ) -> list:
+        raise BatchUnsupported(f"{type(self).__name__} has no batch upload")
+
+    async def close(self):
+        pass
+
+
+class WdTaggerSDK(TaggerBackend):
+    """
+    Long-lived client for wd14-tagger-server.
+
+    One instance owns one pooled ``aiohttp.ClientSession`` so that consecutive
+    uploads reuse keep-alive connections instead of paying a fresh handshake.
+    The session is created lazily inside the running loop and must be released
+    with :meth:`close`.
+    """
+
+    RETRY_STATUS = (502, 503, 504)
+
+    def __init__(
+        self,
+        base_url,
+        *,
+        pool_size: int = 32,
+        keepalive_timeout: float = 30,
+        connect_timeout: float = 5,
+        read_timeout: float = 60,
+        max_retries: int = 2,
+        retry_backoff: float = 0.3,
+        batch_url: Optional[str] = None,
     ):
-        if not self.base_url.endswith("/"):
-            self.base_url += "/"
+        self.base_url = base_url
+        self.batch_url = batch_url
+        # Flipped off on the first 404/405 so we stop probing an old server
+        self.batch_supported = True
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=connect_timeout, sock_read=read_timeout
+        )
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def upload_url(self):
         url = self.base_url
-        if not self.base_url.endswith("upload/"):
-            url = f"{self.base_url}/upload/"
-        data = {
-            "token": token,
-            "file": file,
-            "general_threshold": str(general_threshold),
-            "character_threshold": str(character_threshold),
-        }
-        # print(data)
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, data=data) as response:
-                # response.raise_for_status()
-                return await response.json()
+        if not url.endswith("/"):
+            url += "/"
+        if not url.endswith("upload/"):
+            url = f"{url}upload/"
+        return url
+
+    @property
+    def upload_batch_url(self):
+        if self.batch_url:
+            return self.batch_url
+        return self.upload_url[: -len("upload/")] + "upload_batch/"
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout
+            )
+        return self._session
+
+    async def _backoff(self, attempt: int):
+        # Full jitter, so a burst of failed uploads does not retry in lockstep
+        delay = self.retry_backoff * (2**attempt)
+        await asyncio.sleep(random.uniform(0, delay))
+
+    async def _post(self, url, build_data: Callable):
+        # A multipart body is consumed once sent, so every attempt builds a new one
+        session = self._get_session()
+        attempt = 0
+        while True:
+            try:
+                async with session.post(url, data=build_data()) as response:
+                    if (
+                        response.status in self.RETRY_STATUS
+                        and attempt < self.max_retries
+                    ):
+                        logger.warning(
+                            f"Tagger server busy {response.status}, retry {attempt + 1}"
+                        )
+                    elif response.status in (404, 405) and url != self.upload_url:
+                        raise BatchUnsupported(f"{url} returned {response.status}")
+                    else:
+                        response.raise_for_status()
+                        return await response.json()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(f"Tagger upload failed {e!r}, retry {attempt + 1}")
+            await self._backoff(attempt)
+            attempt += 1
+
+    async def upload(
+        self, file, token, general_threshold=0.35, character_threshold=0.85
+    ):
+        def _build_form():
+            form = aiohttp.FormData()
+            form.add_field("token", token)
+            form.add_field("general_threshold", str(general_threshold))
+            form.add_field("character_threshold", str(character_threshold))
+            form.add_field("file", file_field(file), filename="file")
+            return form
+
+        return await self._post(self.upload_url, _build_form)
+
+    async def upload_batch(
+        self, files: list, token, general_threshold=0.35, character_threshold=0.85
+    ) -> list:
+        """
+        Tag several images with one request, results come back in input order.
+
+        :raise BatchUnsupported: the server has no batch endpoint
+        """
+        if not self.batch_supported:
+            raise BatchUnsupported("batch endpoint disabled")
+
+        def _build_form():
+            form = aiohttp.FormData()
+            form.add_field("token", token)
+            form.add_field("general_threshold", str(general_threshold))
+            form.add_field("character_threshold", str(character_threshold))
+            for index, file in enumerate(files):
+                form.add_field("files", file_field(file), filename=f"{index}")
+            return form
+
+        try:
+            result = await self._post(self.upload_batch_url, _build_form)
+        except BatchUnsupported:
+            self.batch_supported = False
+            logger.warning("Tagger server does not support batch upload")
+            raise
+        if isinstance(result, dict):
+            result = result.get("results", [])
+        if len(result) != len(files):
+            raise ValueError(f"Batch returned {len(result)} results for {len(files)}")
+        return result
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午5:40
+# @File    : webhook.py
+# @Software: PyCharm
+import asyncio
+import hmac
+import secrets
+from typing import List, Optional
+
+from aiohttp import web
+from loguru import logger
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer(object):
+    """
+    Receive updates over an embedded aiohttp server.
+
+    Telegram gets its 200 as soon as the update is queued; a fixed set of
+    consumers feeds the queue into the bot's handlers, so slow tagging never
+    holds an HTTP response open. A full queue answers 503 and Telegram retries
+    the delivery later.
+    """
+
+    def __init__(
+        self,
+        bot: AsyncTeleBot,
+        path: str = "/telegram/webhook",
+        host: str = "0.0.0.0",
+        port: int = 8080,
+        secret_token: Optional[str] = None,
+        queue_size: int = 1000,
+        workers: int = 16,
+    ):
+        self.bot = bot
+        self.path = path
+        self.host = host
+        self.port = port
+        self.secret_token = secret_token
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.workers = workers
+        self._consumers: List[asyncio.Task] = []
+        self._runner: Optional[web.AppRunner] = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get(SECRET_HEADER, "")
+        if not self.secret_token or not hmac.compare_digest(token, self.secret_token):
+            return web.Response(status=403)
+        try:
+            update = types.Update.de_json(await request.text())
+        except Exception as e:
+            logger.warning(f"Bad webhook payload {e}")
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logger.warning("Webhook queue full, asking Telegram to retry")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def _consume(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.bot.process_new_updates([update])
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._consumers = [
+            asyncio.create_task(self._consume()) for _ in range(self.workers)
+        ]
+        logger.info(f"Webhook listening on {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        for task in self._consumers:
+            task.cancel()
+        await asyncio.gather(*self._consumers, return_exceptions=True)
+        self._consumers = []
+
+    async def serve(
+        self,
+        url: Optional[str],
+        allowed_updates=None,
+        drop_pending_updates: bool = True,
+    ):
+        """
+        Start listening, register ``url`` with Telegram and block until
+        cancelled. Without ``url`` the webhook is assumed to be registered
+        elsewhere, e.g. behind a reverse proxy that is set up once, and the
+        secret it was registered with has to be given.
+
+        :raise ValueError: no ``url`` and no secret token
+        """
+        if url:
+            # Telegram learns a generated secret from set_webhook
+            self.secret_token = self.secret_token or secrets.token_urlsafe(32)
+        elif not self.secret_token:
+            raise ValueError(
+                "TELEGRAM_BOT_WEBHOOK_SECRET is required when the webhook is "
+                "registered elsewhere, updates could not be told from forgeries"
+            )
+        await self.start()
+        try:
+            if url:
+                await self.bot.set_webhook(
+                    url=url,
+                    secret_token=self.secret_token,
+                    allowed_updates=allowed_updates,
+                    drop_pending_updates=drop_pending_updates,
+                    max_connections=self.workers,
+                )
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
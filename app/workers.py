@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/19 上午2:30
+# @File    : workers.py
+# @Software: PyCharm
+"""
+Worker processes of the multi-process mode.
+
+The process started by ``main.py`` receives updates and queues tagging jobs
+in a :class:`JobQueue`. It also starts and supervises worker processes, which
+claim the jobs, tag the images and send the replies.
+"""
+
+import asyncio
+import multiprocessing
+import signal
+import sys
+from typing import Dict, List, Optional
+
+from loguru import logger
+from telebot import types
+
+# Telegram file types a job may carry
+FILE_TYPES = {"photo": types.PhotoSize, "document": types.Document}
+
+
+def file_payload(file) -> dict:
+    """
+    What a worker needs to download ``file`` again
+    """
+    kind = "photo" if isinstance(file, types.PhotoSize) else "document"
+    payload = {"type": kind}
+    for name in (
+        "file_id",
+        "file_unique_id",
+        "file_size",
+        "width",
+        "height",
+        "file_name",
+        "mime_type",
+    ):
+        value = getattr(file, name, None)
+        if value is not None:
+            payload[name] = value
+    return payload
+
+
+def file_from_payload(payload: dict):
+    payload = dict(payload)
+    return FILE_TYPES[payload.pop("type")].de_json(payload)
+
+
+def worker_main(index: int, level: str):
+    """
+    Entry point of a worker process
+    """
+    logger.remove()
+    logger.add(
+        sys.stderr,
+        level=level,
+        format=f"{{time}} - worker{index} - {{level}} - {{message}}",
+    )
+    from app.controller import BotRunner
+
+    async def run():
+        task = asyncio.current_task()
+        # Stopped by the supervisor, unfinished jobs are handed back
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+        await BotRunner(worker=index).run_worker()
+
+    try:
+        asyncio.run(run())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+class WorkerSupervisor(object):
+    """
+    Keep ``processes`` worker processes running, a dead one is started again
+    after ``restart_delay`` seconds
+    """
+
+    def __init__(self, processes: int, level: str = "INFO", restart_delay: float = 1.0):
+        self.processes = processes
+        self.level = level
+        self.restart_delay = restart_delay
+        self.restarts = 0
+        # Worker processes start their own image worker pools, so they are
+        # spawned clean and not daemonic
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: Dict[int, multiprocessing.Process] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pids(self) -> List[int]:
+        return [process.pid for process in self._workers.values()]
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=worker_main,
+            args=(index, self.level),
+            name=f"tagger-worker-{index}",
+        )
+        process.start()
+        self._workers[index] = process
+
+    async def start(self):
+        for index in range(self.processes):
+            self._spawn(index)
+        self._task = asyncio.create_task(self._watch())
+        logger.info(f"Started {self.processes} worker processes")
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.restart_delay)
+            for index, process in list(self._workers.items()):
+                if process.is_alive():
+                    continue
+                logger.warning(
+                    f"Worker {index} exited with {process.exitcode}, restarting"
+                )
+                process.close()
+                self.restarts += 1
+                self._spawn(index)
+
+    async def stop(self, timeout: float = 10):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for process in self._workers.values():
+            if process.is_alive():
+                process.terminate()
+        loop = asyncio.get_running_loop()
+        for process in self._workers.values():
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.kill()
+                await loop.run_in_executor(None, process.join)
+        self._workers.clear()
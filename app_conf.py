@@ -22,6 +22,103 @@ settings.validators.register(
     ),
 )
 
+settings.validators.register(
+    Validator("startup.probe_budget", default=5, gt=0),
+    Validator("startup.probe_timeout", default=3, gt=0),
+    Validator("startup.probe_interval", default=10, gt=0),
+)
+settings.validators.register(
+    Validator("cache.enable", default=True, cast=bool),
+    Validator("cache.memory_size", default=1024, gte=1),
+    Validator("cache.memory_ttl", default=3600, gt=0),
+    Validator("cache.persist_path", default="data/tag_cache.db"),
+    Validator("cache.persist_size", default=100000, gte=1),
+    Validator("cache.persist_ttl", default=2592000, gt=0),
+    Validator("cache.persist_cull", default=20, gte=1, lte=100),
+    Validator("cache.commit_interval", default=32, gte=1),
+    Validator("cache.near_duplicate", default=True, cast=bool),
+    Validator("cache.phash_radius", default=4, gte=0, lte=16),
+    Validator("cache.phash_path", default="data/phash_index.log"),
+)
+settings.validators.register(
+    Validator("executor.workers", default=-1, gte=-1),
+    Validator("executor.timeout", default=30, gt=0),
+)
+settings.validators.register(
+    Validator("download.max_size", default=20 * 1024 * 1024, gt=0),
+    Validator("download.spool_size", default=2 * 1024 * 1024, gte=0),
+    Validator("download.chunk_size", default=64 * 1024, gt=0),
+    Validator("download.photo_min_side", default=448, gt=0),
+)
+settings.validators.register(
+    Validator("reader.comfyui_graph", default=True, cast=bool),
+)
+settings.validators.register(
+    Validator("preprocess.enable", default=True, cast=bool),
+    Validator("preprocess.max_side", default=1024, gte=448),
+    Validator(
+        "preprocess.format",
+        default="jpeg",
+        condition=lambda v: v.upper() in ("JPEG", "WEBP", "PNG"),
+    ),
+    Validator("preprocess.quality", default=95, gte=1, lte=100),
+)
+settings.validators.register(
+    Validator("queue.workers", default=8, gte=1),
+    Validator("queue.max_pending", default=256, gte=1),
+    Validator("queue.chat_pending", default=16, gte=1),
+    Validator("queue.chat_concurrency", default=2, gte=1),
+)
+settings.validators.register(
+    Validator("workers.processes", default=0, gte=0),
+    Validator("workers.queue_path", default="data/jobs.db"),
+    Validator("workers.lease", default=60, gt=0),
+    Validator("workers.max_attempts", default=3, gte=1),
+    Validator("workers.poll_interval", default=0.05, gt=0),
+)
+settings.validators.register(
+    Validator("sender.global_rate", default=25, gt=0),
+    Validator("sender.private_rate", default=1, gt=0),
+    Validator("sender.private_burst", default=3, gte=1),
+    Validator("sender.group_rate", default=0.33, gt=0),
+    Validator("sender.group_burst", default=3, gte=1),
+    Validator("sender.max_retries", default=5, gte=0),
+    Validator("sender.backoff", default=0.5, gte=0),
+)
+settings.validators.register(
+    Validator("catchup.enable", default=True, cast=bool),
+    Validator("catchup.max_age", default=600, gt=0),
+    Validator("catchup.parallelism", default=2, gte=1),
+)
+settings.validators.register(
+    Validator("album.window", default=1.0, gt=0),
+    Validator("album.max_size", default=10, gte=1),
+)
+settings.validators.register(
+    Validator("metrics.enable", default=True, cast=bool),
+    Validator("metrics.host", default="0.0.0.0"),
+    Validator("metrics.port", default=9464, gt=0, lte=65535),
+)
+settings.validators.register(
+    Validator("profiler.enable", default=False, cast=bool),
+    Validator("profiler.threshold", default=10, gt=0),
+    Validator("profiler.directory", default="data/profiles"),
+    Validator("profiler.keep", default=50, gte=1),
+    Validator("profiler.sample_interval", default=0.01, gt=0),
+    Validator("profiler.max_overhead", default=0.01, gt=0, lte=1),
+    Validator("profiler.window", default=120, gt=0),
+    Validator("profiler.lag_interval", default=0.1, gt=0),
+    Validator("profiler.cooldown", default=10, gte=0),
+)
+settings.validators.register(
+    Validator("webhook.enable", default=False, cast=bool),
+    Validator("webhook.host", default="0.0.0.0"),
+    Validator("webhook.port", default=8080, gt=0, lte=65535),
+    Validator("webhook.path", default="/telegram/webhook"),
+    Validator("webhook.queue_size", default=1000, gte=1),
+    Validator("webhook.workers", default=16, gte=1),
+)
+
 # raises after all possible errors are evaluated
 try:
     settings.validators.validate_all()
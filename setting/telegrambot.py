@@ -19,10 +19,19 @@ class TelegramBot(BaseSettings):
     proxy_address: Optional[str] = Field(
         None, validation_alias="TELEGRAM_BOT_PROXY_ADDRESS"
     )  # "all://127.0.0.1:7890"
+    api_server: Optional[str] = Field(
+        None, validation_alias="TELEGRAM_BOT_API_SERVER"
+    )  # "http://127.0.0.1:8081"
     bot_link: Optional[str] = Field(None, validation_alias="TELEGRAM_BOT_LINK")
     bot_id: Optional[str] = Field(None, validation_alias="TELEGRAM_BOT_ID")
     bot_username: Optional[str] = Field(None, validation_alias="TELEGRAM_BOT_USERNAME")
     owner_id: Optional[str] = Field(None, validation_alias="TELEGRAM_BOT_OWNER_ID")
+    webhook_url: Optional[str] = Field(
+        None, validation_alias="TELEGRAM_BOT_WEBHOOK_URL"
+    )  # "https://example.com/telegram/webhook"
+    webhook_secret: Optional[str] = Field(
+        None, validation_alias="TELEGRAM_BOT_WEBHOOK_SECRET"
+    )
     model_config = SettingsConfigDict(
         env_file=".env", env_file_encoding="utf-8", extra="ignore"
     )
@@ -30,32 +39,14 @@ class TelegramBot(BaseSettings):
     @model_validator(mode="after")
     def bot_validator(self):
         if self.proxy_address:
+            # Resolve names through the proxy as well
+            if "socks5://" in self.proxy_address:
+                self.proxy_address = self.proxy_address.replace(
+                    "socks5://", "socks5h://"
+                )
             logger.success(f"TelegramBot proxy was set to {self.proxy_address}")
         if self.token is None:
             logger.info("\n🍀Check:Telegrambot token is empty")
-        if self.bot_id is None and self.token:
-            try:
-                from telebot import TeleBot
-
-                # 创建 Bot
-                if self.proxy_address is not None:
-                    from telebot import apihelper
-
-                    if "socks5://" in self.proxy_address:
-                        self.proxy_address = self.proxy_address.replace(
-                            "socks5://", "socks5h://"
-                        )
-                    apihelper.proxy = {"https": self.proxy_address}
-                _bot = TeleBot(token=self.token).get_me()
-                self.bot_id = str(_bot.id)
-                self.bot_username = _bot.username
-                self.bot_link = f"https://t.me/{self.bot_username}"
-            except Exception as e:
-                logger.error(f"\n🍀TelegramBot Token Not Set --error {e}")
-            else:
-                logger.success(
-                    f"🍀TelegramBot Init Connection Success --bot_name {self.bot_username} --bot_id {self.bot_id}"
-                )
         return self
 
     @property
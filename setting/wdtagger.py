@@ -4,10 +4,9 @@
 # @File    : wdtagger.py
 # @Software: PyCharm
 
-import requests
+from typing import List, Literal, Optional
+
 from dotenv import load_dotenv
-from loguru import logger
-from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -16,27 +15,36 @@ class WdTagger(BaseSettings):
     代理设置
     """
 
+    # http: wd14-tagger-server, onnx: run wd_model_path in process
+    wd_backend: Literal["http", "onnx"] = "http"
+    wd_model_path: Optional[str] = None
+    # Defaults to selected_tags.csv next to the model
+    wd_tags_path: Optional[str] = None
+    # 0 uses every core
+    wd_intra_threads: int = 0
+    wd_inter_threads: int = 1
+    # Comma separated for a pool of tagger servers
     wd_api_endpoint: str = "http://127.0.0.1:10011/upload"
+    wd_pool_size: int = 32
+    wd_keepalive_timeout: float = 30
+    wd_connect_timeout: float = 5
+    wd_read_timeout: float = 60
+    wd_max_retries: int = 2
+    wd_retry_backoff: float = 0.3
+    wd_batch_size: int = 1
+    # Images inferred at once by the onnx backend, memory grows with it
+    wd_onnx_batch_size: int = 8
+    wd_batch_max_delay_ms: float = 20
+    wd_batch_endpoint: Optional[str] = None
+    wd_health_interval: float = 5
+    wd_eject_after: int = 3
     model_config = SettingsConfigDict(
         env_file=".env", env_file_encoding="utf-8", extra="ignore"
     )
 
-    @model_validator(mode="after")
-    def bot_validator(self):
-        try:
-            resp = requests.head(self.wd_api_endpoint)
-            if resp.headers.get("server") != "uvicorn":
-                logger.warning(
-                    f"wd_api_endpoint {self.wd_api_endpoint} request success, but server is not uvicorn"
-                )
-            else:
-                logger.success(f"wd_api_endpoint {self.wd_api_endpoint} is available")
-        except Exception as e:
-            logger.warning(
-                f"wd_api_endpoint {self.wd_api_endpoint} is not available, please check the server is running {e}"
-            )
-            raise e
-        return self
+    @property
+    def endpoints(self) -> List[str]:
+        return [url.strip() for url in self.wd_api_endpoint.split(",") if url.strip()]
 
 
 load_dotenv()
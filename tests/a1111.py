@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午11:10
+# @File    : a1111.py
+# @Software: PyCharm
+"""
+Fuzz and micro-benchmark corpus of the A1111 parameters parser.
+
+    python -m tests.a1111
+    python -m tests.a1111 --fuzz 20000 --seed 7
+
+Known blocks are checked field by field, random and generated blocks must
+parse without raising and round-trip, and pathological inputs are timed at
+growing sizes to show the cost stays linear.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+from app.a1111 import MAX_PARAMETERS_SIZE, A1111Parameters, parse_parameters
+
+FORGE = (
+    "masterpiece, best quality, 1girl, (smile:1.2), <lora:add_detail:0.8>\n"
+    "outdoors, cherry blossoms\n"
+    "Negative prompt: lowres, bad anatomy, Steps: in the negative\n"
+    "Steps: 28, Sampler: DPM++ 2M, Schedule type: Karras, CFG scale: 6.5, "
+    "Seed: 3141592653, Size: 832x1216, Model hash: 1a2b3c4d5e, "
+    "Model: animagine-xl-3.1, Denoising strength: 0.4, Hires upscale: 1.5, "
+    "Hires steps: 12, Hires upscaler: 4x-UltraSharp, "
+    'ADetailer model: face_yolov8n.pt, ADetailer prompt: "detailed face, '
+    'blue eyes", ADetailer confidence: 0.3, Lora hashes: "add_detail: '
+    '7c6bad76eb54", TI hashes: "easynegative: c74b4e810b03", '
+    "Version: f2.0.1v1.10.1"
+)
+
+# name: (parameters, expected fields)
+CASES: Dict[str, Tuple[str, dict]] = {
+    "forge": (
+        FORGE,
+        {
+            "prompt": "masterpiece, best quality, 1girl, (smile:1.2), "
+            "<lora:add_detail:0.8>\noutdoors, cherry blossoms",
+            "negative_prompt": "lowres, bad anatomy, Steps: in the negative",
+            "steps": 28,
+            "sampler": "DPM++ 2M",
+            "scheduler": "Karras",
+            "cfg_scale": 6.5,
+            "seed": 3141592653,
+            "size": (832, 1216),
+            "model": "animagine-xl-3.1",
+            "settings.ADetailer prompt": "detailed face, blue eyes",
+            "settings.Lora hashes": "add_detail: 7c6bad76eb54",
+            "settings.Hires upscaler": "4x-UltraSharp",
+            "settings.Version": "f2.0.1v1.10.1",
+        },
+    ),
+    "no_negative": (
+        "1girl, solo\nSteps: 20, Sampler: Euler a, CFG scale: 7, Seed: 1",
+        {"prompt": "1girl, solo", "negative_prompt": "", "steps": 20, "seed": 1},
+    ),
+    "prompt_only": (
+        "a cat, sitting, on a mat",
+        {"prompt": "a cat, sitting, on a mat", "settings": {}},
+    ),
+    "multiline_negative": (
+        "a\n\n\nb\nNegative prompt: x\n\ny\nSteps: 5, Sampler: DDIM, Seed: 2",
+        {"prompt": "a\nb", "negative_prompt": "x\ny", "steps": 5},
+    ),
+    "escaped_quotes": (
+        'p\nSteps: 1, Sampler: A, Note: "say \\"hi\\", ok", Seed: 9',
+        {"settings.Note": 'say "hi", ok', "seed": 9},
+    ),
+    "unkeyed_piece": (
+        "p\nSteps: 1, Sampler: DPM++ 2M, Karras, CFG scale: 5",
+        {"sampler": "DPM++ 2M, Karras", "cfg_scale": 5.0},
+    ),
+    "unkeyed_piece_last": (
+        "p\nSteps: 20, Sampler: DPM++ 2M, Karras",
+        {
+            "sampler": "DPM++ 2M, Karras",
+            "settings": {"Steps": "20", "Sampler": "DPM++ 2M, Karras"},
+        },
+    ),
+    "weighted_prompt": (
+        "1girl, (smile:1.2), (hat:0.8), (red eyes:1.1), solo",
+        {
+            "prompt": "1girl, (smile:1.2), (hat:0.8), (red eyes:1.1), solo",
+            "settings": {},
+        },
+    ),
+    "weighted_negative": (
+        "1girl, solo\nNegative prompt: (worst quality:1.4), (low quality:1.4), "
+        "(blurry:1.2), (bad hands:1.3)",
+        {
+            "prompt": "1girl, solo",
+            "negative_prompt": "(worst quality:1.4), (low quality:1.4), "
+            "(blurry:1.2), (bad hands:1.3)",
+            "settings": {},
+        },
+    ),
+    "unclosed_quote": (
+        'p\nSteps: 1, Sampler: A, Broken: "no end, Seed: 4',
+        {"steps": 1, "settings.Broken": '"no end', "seed": 4},
+    ),
+    "settings_without_steps": (
+        "p\nSampler: Euler, CFG scale: 7, Seed: 5, Size: 512x512",
+        {"prompt": "p", "seed": 5, "size": (512, 512)},
+    ),
+    "template_after_settings": (
+        "p\nSteps: 10, Sampler: Euler, Seed: 6\nTemplate: {a|b}, Negative Template: c",
+        {"steps": 10, "settings.Template": "{a|b}"},
+    ),
+    "crlf": (
+        "p\r\nNegative prompt: n\r\nSteps: 3, Sampler: Euler, Seed: 7",
+        {"prompt": "p", "negative_prompt": "n", "steps": 3},
+    ),
+    "unicode": (
+        "少女, 笑顔 ✨\nNegative prompt: 低品質\nSteps: 8, Sampler: Euler, Seed: 8",
+        {"prompt": "少女, 笑顔 ✨", "negative_prompt": "低品質"},
+    ),
+}
+
+
+def field(parameters: A1111Parameters, name: str):
+    if name.startswith("settings."):
+        return parameters.settings.get(name[len("settings.") :])
+    return getattr(parameters, name)
+
+
+def check_cases() -> List[str]:
+    failures = []
+    for name, (text, expected) in CASES.items():
+        parameters = parse_parameters(text)
+        for key, value in expected.items():
+            got = field(parameters, key)
+            if got != value:
+                failures.append(f"{name}: {key} is {got!r}, expected {value!r}")
+    return failures
+
+
+ALPHABET = [
+    ",",
+    ", ",
+    ":",
+    ": ",
+    '"',
+    "\\",
+    '\\"',
+    "\n",
+    "\r\n",
+    " ",
+    "Negative prompt:",
+    "Steps:",
+    "Steps: 20",
+    "Sampler: Euler",
+    "1girl",
+    "(smile:1.2)",
+    "<lora:x:1>",
+    "少女",
+    "Seed",
+    "x",
+]
+
+
+def random_text(rng: random.Random, tokens: int) -> str:
+    return "".join(rng.choice(ALPHABET) for _ in range(tokens))
+
+
+def needs_quotes(value: str) -> bool:
+    return any(char in value for char in ',:"')
+
+
+def random_block(rng: random.Random) -> Tuple[str, dict]:
+    """
+    A well formed block and what it should parse back to
+    """
+    words = ["1girl", "solo", "smile", "(masterpiece:1.2)", "outdoors", "sky"]
+    prompt = ", ".join(rng.sample(words, rng.randint(1, len(words))))
+    negative = ", ".join(rng.sample(words, rng.randint(0, 3)))
+    settings = {
+        "Steps": str(rng.randint(1, 150)),
+        "Sampler": rng.choice(["Euler a", "DPM++ 2M", "DDIM"]),
+        "CFG scale": str(rng.choice([5, 6.5, 7])),
+        "Seed": str(rng.getrandbits(32)),
+    }
+    if rng.random() < 0.5:
+        settings["ADetailer prompt"] = 'a, "b": c'
+    if rng.random() < 0.5:
+        settings["Hires upscale"] = "2"
+    line = ", ".join(
+        f"{key}: {json.dumps(value) if needs_quotes(value) else value}"
+        for key, value in settings.items()
+    )
+    text = prompt
+    if negative:
+        text += f"\nNegative prompt: {negative}"
+    text += f"\n{line}"
+    return text, {"prompt": prompt, "negative_prompt": negative, "settings": settings}
+
+
+def fuzz(count: int, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    failures = []
+    for index in range(count):
+        text = random_text(rng, rng.randint(0, 200))
+        try:
+            parameters = parse_parameters(text)
+        except Exception as e:
+            failures.append(f"random #{index} raised {e!r} on {text!r}")
+            continue
+        if "\n\n" in parameters.prompt or "\n\n" in parameters.negative_prompt:
+            failures.append(f"random #{index} kept blank lines {text!r}")
+        text, expected = random_block(rng)
+        parameters = parse_parameters(text)
+        for key, value in expected.items():
+            if getattr(parameters, key) != value:
+                failures.append(
+                    f"block #{index} {key} is {getattr(parameters, key)!r}, "
+                    f"expected {value!r}"
+                )
+    return failures
+
+
+# name: builder of an input of about ``size`` characters
+PATHOLOGICAL: Dict[str, Callable[[int], str]] = {
+    "forge_repeated": lambda size: (
+        (FORGE.split("\nSteps:")[0] + ", ") * (size // 200)
+        + "\nSteps:"
+        + FORGE.split("\nSteps:")[1]
+    ),
+    "blank_lines": lambda size: "a" + "\n" * size + "Steps: 1, Seed: 2",
+    "commas_no_keys": lambda size: "p\nSteps: 1, " + "," * size,
+    "colons_no_commas": lambda size: "p\nSteps: 1, " + "k:" * (size // 2),
+    "unclosed_quotes": lambda size: "p\nSteps: 1, " + 'k: "x, ' * (size // 7),
+    "long_quoted": lambda size: 'p\nSteps: 1, k: "' + "\\," * (size // 2) + '"',
+    "settings_lines": lambda size: "Steps: 1, Seed: 2\n" * (size // 18),
+}
+
+
+def bench(sizes=(4096, 32768, 262144), repeat: int = 5) -> Dict[str, Dict[str, float]]:
+    """
+    Best of ``repeat`` parse times in microseconds, per input and size
+    """
+    report = {}
+    for name, build in PATHOLOGICAL.items():
+        report[name] = {}
+        for size in sizes:
+            text = build(size)
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                parse_parameters(text)
+                best = min(best, time.perf_counter() - start)
+            report[name][str(size)] = round(best * 1e6, 1)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--fuzz", type=int, default=5000, help="random inputs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-bench", action="store_true")
+    args = parser.parse_args(argv)
+
+    failures = check_cases() + fuzz(args.fuzz, args.seed)
+    report = {"cases": len(CASES), "fuzzed": args.fuzz, "failures": failures[:20]}
+    if not args.no_bench:
+        report["parse_us"] = bench()
+        report["max_input"] = MAX_PARAMETERS_SIZE
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午7:30
+# @File    : benchmark.py
+# @Software: PyCharm
+"""
+End to end benchmark of ``BotRunner`` against local stand-ins.
+
+    python -m tests.benchmark --images 240 --chats 8 --latency 0.05
+    python -m tests.benchmark --mode webhook --json bench.json
+    python -m tests.benchmark --processes 4 --kill-worker
+
+A stub wd14 server and a fake Bot API run in this process, the bot is driven
+with synthetic photo and document messages and every reply is timed from the
+moment its update was handed to the bot.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import signal
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import aiohttp
+from loguru import logger
+
+from tests.corpus import build_corpus, repost
+from tests.stubs import FakeBotApi, StubTagger, build_tiny_tagger
+
+WEBHOOK_SECRET = "bench-secret"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    parser.add_argument("--images", type=int, default=120, help="messages to send")
+    parser.add_argument("--unique", type=int, default=12, help="distinct images")
+    parser.add_argument("--side", type=int, default=1024, help="image long side")
+    parser.add_argument("--chats", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=0, help="messages/s, 0 burst")
+    parser.add_argument("--latency", type=float, default=0.05, help="wd14 seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--album", type=int, default=1, help="images per album")
+    parser.add_argument(
+        "--batch-size", type=int, default=None, help="images per tagger call"
+    )
+    parser.add_argument("--backend", choices=("http", "onnx"), default="http")
+    parser.add_argument(
+        "--model-side", type=int, default=448, help="input of the onnx test model"
+    )
+    parser.add_argument("--nodes", type=int, default=1, help="stub tagger servers")
+    parser.add_argument(
+        "--kill-node", action="store_true", help="stop one node halfway through"
+    )
+    parser.add_argument("--workers", type=int, default=None, help="queue workers")
+    parser.add_argument("--executor", type=int, default=None, help="image workers")
+    parser.add_argument("--cache", action="store_true", help="keep the tag cache")
+    parser.add_argument(
+        "--reposts", type=float, default=0.0, help="share of recompressed reposts"
+    )
+    parser.add_argument("--flood", type=float, default=0.0, help="share of 429s")
+    parser.add_argument(
+        "--real-limits", action="store_true", help="keep Telegram send rates"
+    )
+    parser.add_argument(
+        "--profile", type=float, default=None, help="profile jobs over N seconds"
+    )
+    parser.add_argument(
+        "--backlog", type=int, default=0, help="updates pending at startup"
+    )
+    parser.add_argument(
+        "--processes", type=int, default=0, help="worker processes, 0 in process"
+    )
+    parser.add_argument(
+        "--kill-worker", action="store_true", help="kill one worker halfway through"
+    )
+    parser.add_argument("--warmup", type=int, default=4, help="untimed messages")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--json", default=None, help="write the report here")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def percentile(values: List[float], q: float) -> float:
+    # Nearest rank
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def _peak_rss_mb(pid="self") -> float:
+    # VmHWM is the resident set high-water mark, Linux only
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid == "self":
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return 0.0
+
+
+def build_message(
+    sample, file_id: str, chat_id: int, message_id: int, date: Optional[int] = None
+) -> dict:
+    message = {
+        "message_id": message_id,
+        "date": date or int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+    }
+    if sample.photo_sizes:
+        message["photo"] = [
+            {
+                "file_id": f"{file_id}.{index}",
+                "file_unique_id": f"u{file_id}.{index}",
+                "width": min(side, sample.width),
+                "height": min(side, sample.height),
+                "file_size": len(data),
+            }
+            for index, (side, data) in enumerate(
+                zip((320, 800, 1280), sample.photo_sizes)
+            )
+        ]
+    else:
+        message["document"] = {
+            "file_id": file_id,
+            "file_unique_id": f"u{file_id}",
+            "file_name": f"{sample.name}.{sample.mime_type.split('/')[1]}",
+            "mime_type": sample.mime_type,
+            "file_size": len(sample.data),
+        }
+    return message
+
+
+def override(settings, key: str, value):
+    """
+    Set ``key`` here and for the worker processes, which load their settings
+    from scratch
+    """
+    settings.set(key, value)
+    name = "DYNACONF_" + key.upper().replace(".", "__")
+    os.environ[name] = value if isinstance(value, str) else json.dumps(value)
+
+
+def worker_processes() -> List[multiprocessing.Process]:
+    return [
+        child
+        for child in multiprocessing.active_children()
+        if child.name.startswith("tagger-worker-")
+    ]
+
+
+async def wait_for(predicate, timeout: float, interval: float = 0.01) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        await asyncio.sleep(interval)
+    return predicate()
+
+
+class Driver(object):
+    """
+    Hands messages to the bot and matches replies back to them
+    """
+
+    def __init__(self, api: FakeBotApi, mode: str, webhook_url: str):
+        self.api = api
+        self.mode = mode
+        self.webhook_url = webhook_url
+        self.session = aiohttp.ClientSession()
+        self.sent_at: Dict[Tuple[int, int], float] = {}
+        self.kinds: Dict[Tuple[int, int], str] = {}
+        self._next_id = 0
+
+    async def send(
+        self,
+        sample,
+        chat_id: int,
+        media_group_id=None,
+        track: bool = True,
+        file_id: Optional[str] = None,
+        date: Optional[int] = None,
+    ) -> Tuple[int, int]:
+        self._next_id += 1
+        message_id = self._next_id
+        # A reused file id is the same file sent again
+        file_id = file_id or f"{sample.name}-{message_id}"
+        if sample.photo_sizes:
+            for index, data in enumerate(sample.photo_sizes):
+                self.api.add_file(f"{file_id}.{index}", data)
+        else:
+            self.api.add_file(file_id, sample.data)
+        message = build_message(
+            sample, file_id, chat_id, message_id=message_id, date=date
+        )
+        if media_group_id:
+            message["media_group_id"] = media_group_id
+        key = (chat_id, message_id)
+        if track:
+            # Album members are answered together through the first one
+            self.kinds[key] = sample.kind
+            self.sent_at[key] = time.perf_counter()
+        if self.mode == "webhook":
+            async with self.session.post(
+                self.webhook_url,
+                json={"update_id": message_id, "message": message},
+                headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET},
+            ) as response:
+                if response.status != 200:
+                    logger.warning(f"Webhook answered {response.status}")
+        else:
+            self.api.push({"message": message})
+        return key
+
+    def answered(self, keys=None) -> Dict[Tuple[int, int], float]:
+        keys = self.sent_at if keys is None else keys
+        done = {}
+        for item in self.api.sent:
+            key = (item["chat_id"], item["reply_to"])
+            if item["parse_mode"] == "MarkdownV2" and key in keys:
+                done.setdefault(key, item["time"])
+        return done
+
+    async def close(self):
+        await self.session.close()
+
+
+async def push_backlog(
+    driver: Driver, corpus, count: int, chats: int, max_age: float
+) -> Tuple[Set[Tuple[int, int]], Set[Tuple[int, int]]]:
+    """
+    Updates waiting before the bot starts: a fifth too old to answer, a fifth
+    sending an image again to the same chat.
+
+    :return: messages that should be answered and those that should not
+    """
+    picker = random.Random(1)
+    stale = int(time.time() - 2 * max_age)
+    latest: Dict[Tuple[int, str], Tuple[int, int]] = {}
+    skipped: Set[Tuple[int, int]] = set()
+    for index in range(count):
+        chat_id = 1000 + index % chats
+        sample = corpus[index % len(corpus)]
+        roll = picker.random()
+        if roll < 0.2:
+            skipped.add(await driver.send(sample, chat_id, track=False, date=stale))
+            continue
+        earlier = [file_id for chat, file_id in latest if chat == chat_id]
+        if roll < 0.4 and earlier:
+            file_id = picker.choice(earlier)
+            sample = next(item for item in corpus if file_id.startswith(item.name))
+        else:
+            file_id = f"{sample.name}-backlog{index}"
+        key = await driver.send(sample, chat_id, track=False, file_id=file_id)
+        if (chat_id, file_id) in latest:
+            skipped.add(latest[(chat_id, file_id)])
+        latest[(chat_id, file_id)] = key
+    return set(latest.values()), skipped
+
+
+async def run(args) -> dict:
+    taggers = [
+        StubTagger(
+            port=18011 + 10 * index,
+            latency=args.latency,
+            jitter=args.jitter,
+            batch=True,
+        )
+        for index in range(max(args.nodes, 1))
+    ]
+    api = FakeBotApi(flood_rate=args.flood)
+    for tagger in taggers:
+        await tagger.start()
+    await api.start()
+
+    # Everything below reads its settings at import time
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("TELEGRAM_BOT_ID", "1")
+    os.environ["WD_API_ENDPOINT"] = ",".join(tagger.url for tagger in taggers)
+    os.environ["WD_HEALTH_INTERVAL"] = "0.5"
+    if args.batch_size is not None:
+        name = "WD_ONNX_BATCH_SIZE" if args.backend == "onnx" else "WD_BATCH_SIZE"
+        os.environ[name] = str(args.batch_size)
+    os.environ["WD_BACKEND"] = args.backend
+    os.environ["TELEGRAM_BOT_API_SERVER"] = api.server_url
+    scratch = tempfile.TemporaryDirectory()
+    if args.backend == "onnx":
+        # Generated model, tags are meaningless but the work per image is real
+        model_path, _ = build_tiny_tagger(scratch.name, size=args.model_side)
+        os.environ["WD_MODEL_PATH"] = model_path
+    from telebot import asyncio_helper
+
+    from app.controller import BotRunner
+    from app_conf import settings
+    from setting.telegrambot import BotSetting
+
+    override(settings, "cache.enable", args.cache)
+    # A fresh cache per run, results of the last one would skew it
+    override(settings, "cache.persist_path", os.path.join(scratch.name, "tag_cache.db"))
+    override(
+        settings, "cache.phash_path", os.path.join(scratch.name, "phash_index.log")
+    )
+    override(settings, "metrics.enable", False)
+    override(settings, "webhook.enable", args.mode == "webhook")
+    override(
+        settings, "queue.max_pending", max(settings.queue.max_pending, args.images)
+    )
+    override(
+        settings, "queue.chat_pending", max(settings.queue.chat_pending, args.images)
+    )
+    if not args.real_limits:
+        # The fake API has no limits, only flood waits asked for with --flood
+        for key in ("global_rate", "private_rate", "group_rate"):
+            override(settings, f"sender.{key}", 10000)
+    if args.workers is not None:
+        override(settings, "queue.workers", args.workers)
+    if args.executor is not None:
+        override(settings, "executor.workers", args.executor)
+    if args.profile is not None:
+        override(settings, "profiler.enable", True)
+        override(settings, "profiler.threshold", args.profile)
+        override(settings, "profiler.directory", os.path.join(scratch.name, "profiles"))
+    override(settings, "workers.processes", args.processes)
+    override(settings, "workers.queue_path", os.path.join(scratch.name, "jobs.db"))
+    if args.kill_worker:
+        # Jobs of the killed worker come back after the lease
+        override(settings, "workers.lease", 3)
+    BotSetting.webhook_url = None
+    BotSetting.webhook_secret = WEBHOOK_SECRET
+
+    corpus = build_corpus(args.unique, side=args.side)
+    reposts = [repost(sample) for sample in corpus] if args.reposts else []
+    picker = random.Random(0)
+    driver = Driver(
+        api,
+        mode=args.mode,
+        webhook_url=f"http://127.0.0.1:{settings.webhook.port}{settings.webhook.path}",
+    )
+    backlog, backlog_skipped = set(), set()
+    if args.backlog:
+        backlog, backlog_skipped = await push_backlog(
+            driver, corpus, args.backlog, args.chats, settings.catchup.max_age
+        )
+    bot_started = time.perf_counter()
+    runner = BotRunner()
+    bot_task = asyncio.create_task(runner.run())
+    await wait_for(lambda: api.calls.get("setMyCommands"), 30)
+    if args.mode == "webhook":
+        await asyncio.sleep(0.2)
+
+    # Worker processes and connection pools start on first use
+    warmup = [await driver.send(corpus[i % len(corpus)], 1) for i in range(args.warmup)]
+    await wait_for(lambda: all(key in driver.answered() for key in warmup), 60)
+    for key in warmup:
+        del driver.sent_at[key]
+    for tagger in taggers:
+        for key in list(tagger.stats):
+            tagger.stats[key] = 0
+    api.calls.clear()
+
+    started = time.perf_counter()
+    album = max(args.album, 1)
+    for i in range(args.images):
+        group, position = divmod(i, album)
+        sample = corpus[i % len(corpus)]
+        # Only images the bot has seen once can come back as reposts
+        if reposts and i >= len(corpus) and picker.random() < args.reposts:
+            sample = reposts[i % len(corpus)]
+        await driver.send(
+            sample,
+            chat_id=1000 + group % args.chats,
+            media_group_id=f"album{group}" if album > 1 else None,
+            track=position == 0,
+        )
+        if args.rate:
+            await asyncio.sleep(1 / args.rate)
+        if args.kill_node and len(taggers) > 1 and i == args.images // 2:
+            await taggers[-1].stop()
+        if args.kill_worker and i == args.images // 2:
+            workers = worker_processes()
+            if workers:
+                os.kill(workers[-1].pid, signal.SIGKILL)
+    expected = len(driver.sent_at)
+    finished = await wait_for(lambda: len(driver.answered()) >= expected, args.timeout)
+    elapsed = time.perf_counter() - started
+    done = driver.answered()
+    caught_up = await wait_for(
+        lambda: len(driver.answered(backlog)) >= len(backlog), args.timeout
+    )
+    backlog_done = driver.answered(backlog)
+    worker_rss = sum(
+        _peak_rss_mb(child.pid) for child in multiprocessing.active_children()
+    )
+
+    # Let trailing reply blocks drain before the fake API goes away, a flood
+    # wait pauses a chat for retry_after
+    quiet = 0.2 + (2 * api.retry_after if args.flood else 0)
+    sent = -1
+    while sent != len(api.sent):
+        sent = len(api.sent)
+        await asyncio.sleep(quiet)
+    jobs = {}
+    if runner.job_queue is not None:
+        jobs = {
+            "processes": args.processes,
+            "restarts": runner.supervisor.restarts if runner.supervisor else 0,
+            "left": runner.job_queue.counts(),
+        }
+    bot_task.cancel()
+    await asyncio.gather(bot_task, return_exceptions=True)
+    await driver.close()
+    await (await asyncio_helper.session_manager.get_session()).close()
+    await api.stop()
+    for tagger in taggers:
+        await tagger.stop()
+    profiles = []
+    if runner.profiler is not None:
+        await asyncio.sleep(0.2)
+        profiles = os.listdir(runner.profiler.directory)
+    scratch.cleanup()
+    backlog_report = {}
+    if args.backlog:
+        backlog_report = {
+            "pushed": args.backlog,
+            "expected": len(backlog),
+            "answered": len(backlog_done),
+            "answered_skipped": len(driver.answered(backlog_skipped)),
+            "caught_up": caught_up,
+            "caught_up_s": round(max(backlog_done.values()) - bot_started, 3)
+            if backlog_done
+            else None,
+        }
+
+    latencies = {key: done[key] - driver.sent_at[key] for key in done}
+    by_kind: Dict[str, List[float]] = {}
+    for key, value in latencies.items():
+        by_kind.setdefault(driver.kinds[key], []).append(value)
+    values = list(latencies.values())
+    return {
+        "mode": args.mode,
+        "backend": args.backend,
+        "images": args.images,
+        "replies_expected": expected,
+        "answered": len(done),
+        "complete": finished,
+        "busy_replies": sum(1 for item in api.sent if item["parse_mode"] is None),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(len(done) / elapsed, 2) if elapsed else 0.0,
+        "images_per_s": round(args.images / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            f"p{q}": round(percentile(values, q) * 1000, 1) for q in (50, 95, 99)
+        },
+        "latency_ms_p50_by_kind": {
+            kind: round(percentile(items, 50) * 1000, 1)
+            for kind, items in sorted(by_kind.items())
+        },
+        "tagger": {
+            key: sum(tagger.stats[key] for tagger in taggers)
+            for key in taggers[0].stats
+        },
+        "tagger_requests_by_node": [tagger.stats["requests"] for tagger in taggers],
+        "bot_api_calls": dict(sorted(api.calls.items())),
+        "messages_sent": len(api.sent),
+        "flood_waits": api.flood_waits,
+        "near_duplicate_hits": runner.tag_cache.stats.near_hits
+        if runner.tag_cache
+        else 0,
+        "backlog": backlog_report,
+        "jobs": jobs,
+        "slow_job_reports": len(profiles),
+        "profiler_overhead": round(runner.profiler.overhead, 4)
+        if runner.profiler
+        else 0.0,
+        # Includes the stand-ins, they share this process
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "worker_peak_rss_mb": round(worker_rss, 1),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG" if args.verbose else "WARNING")
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if not report["complete"] or report["backlog"].get("caught_up") is False:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
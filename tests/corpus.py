@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午7:20
+# @File    : corpus.py
+# @Software: PyCharm
+"""
+Synthetic images carrying the metadata each reader looks for.
+
+Generated on the fly and seeded, so every run sees the same bytes without
+shipping binary fixtures.
+"""
+
+import json
+import random
+from io import BytesIO
+from typing import List, Optional
+
+from PIL import Image, ImageDraw, PngImagePlugin
+from pydantic import BaseModel
+
+A1111_PARAMETERS = (
+    "masterpiece, best quality, 1girl, solo, long hair, looking at viewer\n"
+    "Negative prompt: lowres, bad anatomy, bad hands, text, error\n"
+    "Steps: 28, Sampler: Euler a, CFG scale: 7, Seed: {seed}, Size: {w}x{h}, "
+    "Model hash: 1a2b3c4d, Model: animagine-xl"
+)
+COMFYUI_PROMPT = {
+    "3": {
+        "class_type": "KSampler",
+        "inputs": {"seed": 0, "steps": 20, "cfg": 7, "model": ["4", 0]},
+    },
+    "4": {
+        "class_type": "CheckpointLoaderSimple",
+        "inputs": {"ckpt_name": "animagine-xl-3.1.safetensors"},
+    },
+    "6": {
+        "class_type": "CLIPTextEncode",
+        "inputs": {"text": "1girl, solo, smile", "clip": ["4", 1]},
+    },
+}
+
+
+class Sample(BaseModel):
+    name: str
+    kind: str
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    # Sent as a compressed photo, the bot then only sees the JPEG sizes
+    photo_sizes: Optional[List[bytes]] = None
+
+
+def _noise(rng: random.Random, size, mode: str = "RGB") -> Image.Image:
+    img = Image.effect_noise(size, rng.randint(20, 80)).convert(mode)
+    # Smooth gradient on top of the noise keeps file sizes realistic, the
+    # shapes give every image its own perceptual hash
+    overlay = Image.linear_gradient("L").resize(size).convert("RGB")
+    draw = ImageDraw.Draw(overlay)
+    for _ in range(8):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        w, h = (
+            rng.randrange(size[0] // 8, size[0] // 2),
+            rng.randrange(size[1] // 8, size[1] // 2),
+        )
+        shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+        shape((x, y, x + w, y + h), fill=tuple(rng.randrange(256) for _ in range(3)))
+    return Image.blend(img, overlay.convert(mode), 0.5)
+
+
+def _novelai_text(seed: int, w: int, h: int) -> dict:
+    comment = {
+        "prompt": "1girl, solo, cat ears, best quality, amazing quality",
+        "steps": 28,
+        "height": h,
+        "width": w,
+        "scale": 5.0,
+        "uncond_scale": 1.0,
+        "cfg_rescale": 0.0,
+        "seed": seed,
+        "n_samples": 1,
+        "noise_schedule": "native",
+        "sampler": "k_euler",
+        "uc": "lowres, bad anatomy",
+        "request_type": "PromptGenerateRequest",
+    }
+    return {
+        "Title": "NovelAI generated image",
+        "Description": comment["prompt"],
+        "Software": "NovelAI",
+        "Source": "Stable Diffusion XL C1E1DE52",
+        "Comment": json.dumps(comment),
+    }
+
+
+def _png(img: Image.Image, text: dict) -> bytes:
+    info = PngImagePlugin.PngInfo()
+    for key, value in text.items():
+        info.add_text(key, value)
+    out = BytesIO()
+    img.save(out, format="PNG", pnginfo=info)
+    return out.getvalue()
+
+
+def _with_exif(img: Image.Image, image_format: str, parameters: str) -> bytes:
+    exif = Image.Exif()
+    # UserComment, where A1111 writes its parameters for JPEG and WebP
+    exif.get_ifd(0x8769)[0x9286] = b"UNICODE\x00" + parameters.encode("utf-16-be")
+    out = BytesIO()
+    img.save(out, format=image_format, exif=exif, quality=90)
+    return out.getvalue()
+
+
+def _photo_sizes(img: Image.Image) -> List[bytes]:
+    sizes = []
+    for side in (320, 800, 1280):
+        copy = img.convert("RGB")
+        copy.thumbnail((side, side))
+        out = BytesIO()
+        copy.save(out, format="JPEG", quality=85)
+        sizes.append(out.getvalue())
+    return sizes
+
+
+KINDS = (
+    "novelai_png",
+    "comfyui_png",
+    "a1111_png",
+    "a1111_jpeg",
+    "a1111_webp",
+    "plain_photo",
+)
+
+
+def build_sample(kind: str, seed: int, side: int = 1024) -> Sample:
+    rng = random.Random(seed)
+    w, h = side, rng.choice((side, side * 3 // 4, side * 4 // 3))
+    img = _noise(rng, (w, h))
+    if kind == "novelai_png":
+        data, mime = _png(img, _novelai_text(seed, w, h)), "image/png"
+    elif kind == "comfyui_png":
+        prompt = json.loads(json.dumps(COMFYUI_PROMPT))
+        prompt["3"]["inputs"]["seed"] = seed
+        data = _png(img, {"prompt": json.dumps(prompt), "workflow": "{}"})
+        mime = "image/png"
+    elif kind == "a1111_png":
+        parameters = A1111_PARAMETERS.format(seed=seed, w=w, h=h)
+        data, mime = _png(img, {"parameters": parameters}), "image/png"
+    elif kind == "a1111_jpeg":
+        parameters = A1111_PARAMETERS.format(seed=seed, w=w, h=h)
+        data, mime = _with_exif(img, "JPEG", parameters), "image/jpeg"
+    elif kind == "a1111_webp":
+        parameters = A1111_PARAMETERS.format(seed=seed, w=w, h=h)
+        data, mime = _with_exif(img, "WEBP", parameters), "image/webp"
+    elif kind == "plain_photo":
+        sizes = _photo_sizes(img)
+        return Sample(
+            name=f"{kind}_{seed}",
+            kind=kind,
+            data=sizes[-1],
+            mime_type="image/jpeg",
+            width=w,
+            height=h,
+            photo_sizes=sizes,
+        )
+    else:
+        raise ValueError(f"Unknown sample kind {kind}")
+    return Sample(
+        name=f"{kind}_{seed}", kind=kind, data=data, mime_type=mime, width=w, height=h
+    )
+
+
+def repost(sample: Sample, scale: float = 0.8, quality: int = 75) -> Sample:
+    """
+    ``sample`` as it comes back forwarded: rescaled, recompressed and sent as
+    a photo, different bytes for the same picture
+    """
+    with Image.open(BytesIO(sample.data)) as img:
+        img = img.convert("RGB")
+    img = img.resize((round(img.width * scale), round(img.height * scale)))
+    out = BytesIO()
+    img.save(out, format="JPEG", quality=quality)
+    sizes = _photo_sizes(Image.open(BytesIO(out.getvalue())))
+    return Sample(
+        name=f"repost_{sample.name}",
+        kind="repost",
+        data=sizes[-1],
+        mime_type="image/jpeg",
+        width=img.width,
+        height=img.height,
+        photo_sizes=sizes,
+    )
+
+
+def build_corpus(count: int, seed: int = 0, side: int = 1024) -> List[Sample]:
+    """
+    ``count`` samples cycling through every kind
+    """
+    return [
+        build_sample(KINDS[i % len(KINDS)], seed=seed + i, side=side)
+        for i in range(count)
+    ]
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/19 上午5:00
+# @File    : jobqueue.py
+# @Software: PyCharm
+"""
+Behaviour checks of the job queue against a temporary SQLite file.
+
+    python -m tests.jobqueue
+    python -m tests.jobqueue --only lease
+
+Each JobQueue opens its own connection, so two of them on one file claim
+like two worker processes do. Every check returns its failures, the run exits
+non-zero when there are any.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from typing import Dict, List
+
+from tests.tagger import expect
+
+
+class Scratch(object):
+    """A queue file and the queues opened on it, closed on the way out"""
+
+    def __init__(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "jobs.sqlite3")
+        self.queues = []
+
+    def open(self, **options):
+        from app.jobqueue import JobQueue
+
+        queue = JobQueue(self.path, **options)
+        self.queues.append(queue)
+        return queue
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for queue in self.queues:
+            queue.close()
+        self.directory.cleanup()
+
+
+async def check_claimers() -> List[str]:
+    failures = []
+    with Scratch() as scratch:
+        first, second = scratch.open(), scratch.open()
+        for index in range(60):
+            await first.put(index % 20, "photo", {"index": index})
+        claimed: Dict[str, List[int]] = {"a": [], "b": []}
+
+        async def drain(queue, worker: str):
+            while True:
+                jobs = await queue.claim(worker, 3)
+                if not jobs:
+                    return
+                claimed[worker].extend(job.payload["index"] for job in jobs)
+                for job in jobs:
+                    await queue.complete(worker, job.id)
+
+        await asyncio.gather(drain(first, "a"), drain(second, "b"))
+        # Every job is run once, by one of the two
+        everything = claimed["a"] + claimed["b"]
+        expect(failures, "claimed", sorted(everything), list(range(60)))
+        if not claimed["a"] or not claimed["b"]:
+            failures.append(f"one claimer did all the work: {claimed}")
+        expect(failures, "left", first.counts(), {})
+    return failures
+
+
+async def check_idle() -> List[str]:
+    import sqlite3
+
+    failures = []
+    with Scratch() as scratch:
+        queue = scratch.open(chat_concurrency=1)
+        writer = sqlite3.connect(scratch.path, isolation_level=None)
+
+        async def idle_claim(name: str):
+            # Someone else is writing, a claim with nothing to take must not
+            # wait for them
+            writer.execute("BEGIN IMMEDIATE")
+            try:
+                jobs = await asyncio.wait_for(queue.claim("b"), 1)
+                expect(failures, name, jobs, [])
+            except asyncio.TimeoutError:
+                failures.append(f"{name}: claim waited for the write lock")
+            finally:
+                writer.execute("ROLLBACK")
+
+        try:
+            await idle_claim("nothing queued")
+            await queue.put(1, "photo", {"index": 0})
+            await queue.put(1, "photo", {"index": 1})
+            leased = await queue.claim("a")
+            await idle_claim("chat at its limit")
+            await queue.complete("a", leased[0].id)
+            expect(failures, "claimable", len(await queue.claim("b")), 1)
+        finally:
+            writer.close()
+    return failures
+
+
+async def check_chat_limit() -> List[str]:
+    failures = []
+    with Scratch() as scratch:
+        first = scratch.open(chat_concurrency=2)
+        second = scratch.open(chat_concurrency=2)
+        for index in range(6):
+            await first.put(1, "photo", {"index": index})
+        await first.put(2, "photo", {"index": 6})
+        a, b = await asyncio.gather(first.claim("a", 4), second.claim("b", 4))
+        jobs = a + b
+        # Two of chat 1 between both workers, and the other chat is not held up
+        expect(
+            failures,
+            "chat 1 leased",
+            len([job for job in jobs if job.chat_id == 1]),
+            2,
+        )
+        expect(
+            failures,
+            "chat 2 leased",
+            [job.payload["index"] for job in jobs if job.chat_id == 2],
+            [6],
+        )
+        expect(failures, "full chat", await first.claim("a", 4), [])
+        for queue, worker, leased in ((first, "a", a), (second, "b", b)):
+            for job in leased:
+                if job.payload["index"] == 0:
+                    await queue.complete(worker, job.id)
+        expect(
+            failures,
+            "after one is done",
+            [job.payload["index"] for job in await second.claim("b", 4)],
+            [2],
+        )
+    return failures
+
+
+async def check_lease() -> List[str]:
+    failures = []
+    with Scratch() as scratch:
+        first = scratch.open(lease=0.3)
+        second = scratch.open(lease=0.3)
+        await first.put(1, "photo", {"index": 0})
+        await first.put(2, "photo", {"index": 1})
+        kept, lost = await first.claim("a", 2)
+        # A renewed lease outlives its first term, the other one runs out
+        for _ in range(3):
+            await asyncio.sleep(0.15)
+            await first.renew("a", [kept.id])
+        recovered = await second.claim("b", 2)
+        expect(failures, "recovered", [job.id for job in recovered], [lost.id])
+        expect(failures, "recovered count", second.recovered, 1)
+        expect(failures, "recovered attempts", recovered[0].attempts, 2)
+        # The worker that lost the lease can no longer finish the job
+        await first.complete("a", lost.id)
+        expect(failures, "stale complete", first.counts(), {"leased": 2})
+        await second.complete("b", lost.id)
+        await first.complete("a", kept.id)
+        expect(failures, "left", first.counts(), {})
+    return failures
+
+
+async def check_failing() -> List[str]:
+    failures = []
+    with Scratch() as scratch:
+        first = scratch.open(max_attempts=3)
+        second = scratch.open(max_attempts=3)
+        await first.put(1, "photo", {"index": 0})
+        attempts = []
+        for attempt in range(5):
+            queue, worker = (first, "a") if attempt % 2 == 0 else (second, "b")
+            jobs = await queue.claim(worker)
+            if not jobs:
+                break
+            attempts.append(jobs[0].attempts)
+            await queue.fail(worker, jobs[0].id, f"boom {attempt}")
+        # Retried across workers, then parked
+        expect(failures, "attempts", attempts, [1, 2, 3])
+        expect(failures, "parked", second.counts(), {"failed": 1})
+        # A job that takes its worker down with it is parked the same way
+        crashing = scratch.open(max_attempts=2, lease=0.05)
+        await crashing.put(2, "photo", {"index": 1})
+        for _ in range(3):
+            await crashing.claim("a")
+            await asyncio.sleep(0.1)
+        expect(failures, "crashing", crashing.counts(), {"failed": 2})
+    return failures
+
+
+async def check_release() -> List[str]:
+    from app.scheduler import QueueFull
+
+    failures = []
+    with Scratch() as scratch:
+        first = scratch.open(max_attempts=1, max_pending=3, chat_pending=2)
+        second = scratch.open(max_attempts=1, max_pending=3, chat_pending=2)
+        ahead = [await first.put(1, "photo", {"index": 0})]
+        ahead.append(await second.put(2, "photo", {"index": 1}))
+        ahead.append(await first.put(1, "photo", {"index": 2}))
+        expect(failures, "ahead", ahead, [0, 1, 2])
+        for chat_id in (1, 3):
+            try:
+                await second.put(chat_id, "photo", {})
+                failures.append(f"put for chat {chat_id} was not refused")
+            except QueueFull:
+                pass
+        jobs = await first.claim("a", 3)
+        # Shutting down hands the jobs back without using up an attempt, even
+        # with a single one allowed
+        await first.release("a", [job.id for job in jobs])
+        expect(failures, "released", second.counts(), {"queued": 3})
+        again = await second.claim("b", 3)
+        expect(failures, "attempts", [job.attempts for job in again], [1, 1, 1])
+    return failures
+
+
+CHECKS = {
+    "claimers": check_claimers,
+    "idle": check_idle,
+    "chat_limit": check_chat_limit,
+    "lease": check_lease,
+    "failing": check_failing,
+    "release": check_release,
+}
+
+
+async def run(names: List[str]) -> Dict[str, List[str]]:
+    return {name: await CHECKS[name]() for name in names}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--only", choices=sorted(CHECKS), action="append")
+    args = parser.parse_args(argv)
+
+    failures = asyncio.run(run(args.only or list(CHECKS)))
+    print(json.dumps({"failures": failures}, indent=2))
+    if any(failures.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/19 上午6:00
+# @File    : metrics.py
+# @Software: PyCharm
+"""
+Behaviour checks of the metrics, read back from the Prometheus registry.
+
+    python -m tests.metrics
+
+Every check returns its failures, the run exits non-zero when there are any.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+from typing import Dict, List
+
+from tests.tagger import expect
+
+
+def stage_calls(name: str, outcome: str) -> float:
+    from prometheus_client import REGISTRY
+
+    labels = {"stage": name, "outcome": outcome, "content_type": "check"}
+    return REGISTRY.get_sample_value("tagger_bot_stage_calls_total", labels) or 0
+
+
+async def check_stage() -> List[str]:
+    from app.metrics import stage
+
+    failures = []
+
+    async def run(name: str, outcome=None, error=None):
+        with stage(name, content_type="check") as s:
+            if outcome is not None:
+                s.outcome = outcome
+            if error is not None:
+                raise error
+
+    await run("check_ok")
+    await run("check_set", outcome="skipped")
+    for name, outcome, error in (
+        ("check_error", None, ValueError("boom")),
+        ("check_kept", "too_large", ValueError("too large")),
+        ("check_cancelled", None, asyncio.CancelledError()),
+    ):
+        try:
+            await run(name, outcome=outcome, error=error)
+        except BaseException as e:
+            if e is not error:
+                raise
+    # An outcome set before the exception survives it
+    for name, outcome in (
+        ("check_ok", "ok"),
+        ("check_set", "skipped"),
+        ("check_error", "error"),
+        ("check_kept", "too_large"),
+        ("check_cancelled", "cancelled"),
+    ):
+        expect(failures, f"{name} {outcome}", stage_calls(name, outcome), 1)
+    expect(failures, "check_kept error", stage_calls("check_kept", "error"), 0)
+    return failures
+
+
+CHECKS = {
+    "stage": check_stage,
+}
+
+
+async def run(names: List[str]) -> Dict[str, List[str]]:
+    return {name: await CHECKS[name]() for name in names}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--only", choices=sorted(CHECKS), action="append")
+    args = parser.parse_args(argv)
+
+    failures = asyncio.run(run(args.only or list(CHECKS)))
+    print(json.dumps({"failures": failures}, indent=2))
+    if any(failures.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
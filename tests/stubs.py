@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 下午7:10
+# @File    : stubs.py
+# @Software: PyCharm
+"""
+Local stand-ins for wd14-tagger-server and the Telegram Bot API.
+"""
+
+import asyncio
+import itertools
+import json
+import random
+import time
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs
+
+from aiohttp import web
+
+
+async def _serve(app: web.Application, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+class StubTagger(object):
+    """
+    Answers ``/upload/`` like wd14-tagger-server after ``latency`` seconds
+    (plus up to ``jitter``). ``/upload_batch/`` is served when ``batch`` is on,
+    it costs ``latency`` once plus ``batch_item_latency`` per image, otherwise
+    it answers ``batch_status``.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 18011,
+        latency: float = 0.05,
+        jitter: float = 0.0,
+        batch: bool = False,
+        batch_item_latency: float = 0.005,
+        batch_status: int = 404,
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.batch = batch
+        self.batch_item_latency = batch_item_latency
+        self.batch_status = batch_status
+        self.stats = {"requests": 0, "images": 0, "bytes": 0, "peak_inflight": 0}
+        self._inflight = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/upload"
+
+    @staticmethod
+    def result(size: int) -> dict:
+        return {
+            "sorted_general_strings": f"1girl, solo, bytes_{size}",
+            "character_res": {"hatsune_miku": 0.92},
+        }
+
+    async def _sleep(self, extra: float = 0.0):
+        self._inflight += 1
+        self.stats["peak_inflight"] = max(self.stats["peak_inflight"], self._inflight)
+        try:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter) + extra)
+        finally:
+            self._inflight -= 1
+
+    @staticmethod
+    async def probe(request: web.Request) -> web.Response:
+        return web.Response()
+
+    async def upload(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        size = len(form["file"].file.read())
+        self.stats["requests"] += 1
+        self.stats["images"] += 1
+        self.stats["bytes"] += size
+        await self._sleep()
+        return web.json_response(self.result(size))
+
+    async def upload_batch(self, request: web.Request) -> web.Response:
+        if not self.batch:
+            return web.Response(status=self.batch_status)
+        form = await request.post()
+        sizes = [len(item.file.read()) for item in form.getall("files")]
+        self.stats["requests"] += 1
+        self.stats["images"] += len(sizes)
+        self.stats["bytes"] += sum(sizes)
+        await self._sleep(self.batch_item_latency * len(sizes))
+        return web.json_response({"results": [self.result(size) for size in sizes]})
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/upload/", self.upload)
+        app.router.add_post("/upload_batch/", self.upload_batch)
+        # Startup probe of setting.wdtagger
+        app.router.add_route("HEAD", "/upload", self.probe)
+        self._runner = await _serve(app, self.host, self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class FakeBotApi(object):
+    """
+    Just enough of the Bot API for ``BotRunner``: updates are queued with
+    :meth:`push`, files registered with :meth:`add_file` are served by
+    ``getFile`` and the file endpoint, and every outgoing message is recorded
+    with its arrival time.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 18012,
+        flood_rate: float = 0.0,
+        retry_after: int = 1,
+    ):
+        self.host = host
+        self.port = port
+        # Share of sends answered with a 429 flood wait
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.flood_waits = 0
+        self.files: Dict[str, bytes] = {}
+        self.updates: List[dict] = []
+        self.sent: List[dict] = []
+        self.calls: Dict[str, int] = {}
+        self._update_id = itertools.count(1)
+        self._message_id = itertools.count(1_000_000)
+        self._new_update = asyncio.Event()
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def server_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def api_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot{{0}}/{{1}}"
+
+    @property
+    def file_url(self) -> str:
+        return f"http://{self.host}:{self.port}/file/bot{{0}}/{{1}}"
+
+    def add_file(self, file_id: str, data: bytes):
+        self.files[file_id] = data
+
+    def push(self, update: dict) -> dict:
+        update = {"update_id": next(self._update_id), **update}
+        self.updates.append(update)
+        self._new_update.set()
+        return update
+
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    async def params(request: web.Request) -> dict:
+        data = dict(request.query)
+        if request.content_type.startswith("multipart/"):
+            form = await request.post()
+            data.update({k: v for k, v in form.items() if isinstance(v, str)})
+        else:
+            body = await request.text()
+            data.update({k: v[0] for k, v in parse_qs(body).items()})
+        return data
+
+    async def get_updates(self, data: dict):
+        offset = int(data.get("offset") or 0)
+        timeout = min(float(data.get("timeout") or 0), 1.0)
+        deadline = time.monotonic() + timeout
+        while True:
+            if offset < 0:
+                pending = self.updates[offset:]
+            else:
+                pending = [u for u in self.updates if u["update_id"] >= offset]
+            # Telegram forgets confirmed updates
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            remaining = deadline - time.monotonic()
+            if pending or remaining <= 0:
+                return pending[: int(data.get("limit") or 100)]
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def record(self, method: str, data: dict) -> dict:
+        chat_id = int(data.get("chat_id") or 0)
+        reply = data.get("reply_to_message_id")
+        if reply is None and data.get("reply_parameters"):
+            reply = json.loads(data["reply_parameters"]).get("message_id")
+        self.sent.append(
+            {
+                "method": method,
+                "chat_id": chat_id,
+                "reply_to": int(reply) if reply else None,
+                "parse_mode": data.get("parse_mode"),
+                "text": data.get("text") or data.get("caption") or "",
+                "time": time.perf_counter(),
+            }
+        )
+        return {
+            "message_id": next(self._message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": data.get("text", ""),
+        }
+
+    async def method(self, request: web.Request) -> web.Response:
+        name = request.match_info["method"]
+        self.calls[name] = self.calls.get(name, 0) + 1
+        data = await self.params(request)
+        if name == "getUpdates":
+            return self.ok(await self.get_updates(data))
+        if name == "getMe":
+            return self.ok(
+                {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench"}
+            )
+        if name == "getFile":
+            file_id = data["file_id"]
+            if file_id not in self.files:
+                return web.json_response(
+                    {"ok": False, "error_code": 400, "description": "file not found"},
+                    status=400,
+                )
+            return self.ok(
+                {
+                    "file_id": file_id,
+                    "file_unique_id": f"u{file_id}",
+                    "file_size": len(self.files[file_id]),
+                    "file_path": f"documents/{file_id}",
+                }
+            )
+        if name in ("sendMessage", "sendPhoto", "sendDocument"):
+            if self.flood_rate and random.random() < self.flood_rate:
+                self.flood_waits += 1
+                return web.json_response(
+                    {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": "Too Many Requests: retry later",
+                        "parameters": {"retry_after": self.retry_after},
+                    },
+                    status=429,
+                )
+            return self.ok(self.record(name, data))
+        # setMyCommands, deleteWebhook, setWebhook ...
+        return self.ok(True)
+
+    async def download(self, request: web.Request) -> web.Response:
+        data = self.files.get(request.match_info["name"])
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data)
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.method)
+        app.router.add_get("/file/bot{token}/documents/{name}", self.download)
+        self._runner = await _serve(app, self.host, self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+TINY_TAGS = (
+    [("general", 9), ("sensitive", 9), ("questionable", 9), ("explicit", 9)]
+    + [
+        (name, 0)
+        for name in (
+            "1girl",
+            "solo",
+            "long_hair",
+            "smile",
+            "looking_at_viewer",
+            "blue_eyes",
+            "white_background",
+            "simple_background",
+            "outdoors",
+            "sky",
+            "^_^",
+            "holding_(object)",
+        )
+    ]
+    + [("hatsune_miku", 4), ("hakurei_reimu", 4)]
+)
+
+
+def build_tiny_tagger(directory: str, size: int = 64, seed: int = 0):
+    """
+    Write a wd14 shaped ONNX model and its ``selected_tags.csv`` to
+    ``directory``: NHWC BGR input of ``size`` pixels, the channel means go
+    through a fixed random linear layer and a sigmoid, one output per tag.
+
+    :return: model path, tags path
+    """
+    import os
+
+    import numpy as np
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    rng = np.random.default_rng(seed)
+    weight = rng.normal(0, 4, (3, len(TINY_TAGS))).astype(np.float32)
+    bias = rng.normal(0, 1, len(TINY_TAGS)).astype(np.float32)
+    graph = helper.make_graph(
+        [
+            helper.make_node(
+                "ReduceMean", ["input_1:0"], ["mean"], axes=[1, 2], keepdims=0
+            ),
+            helper.make_node("Div", ["mean", "scale"], ["scaled"]),
+            helper.make_node("MatMul", ["scaled", "weight"], ["logits"]),
+            helper.make_node("Add", ["logits", "bias"], ["biased"]),
+            helper.make_node("Sigmoid", ["biased"], ["predictions_sigmoid"]),
+        ],
+        "tiny_tagger",
+        [
+            helper.make_tensor_value_info(
+                "input_1:0", TensorProto.FLOAT, ["batch", size, size, 3]
+            )
+        ],
+        [
+            helper.make_tensor_value_info(
+                "predictions_sigmoid",
+                TensorProto.FLOAT,
+                ["batch", len(TINY_TAGS)],
+            )
+        ],
+        initializer=[
+            numpy_helper.from_array(np.array([255.0], np.float32), "scale"),
+            numpy_helper.from_array(weight, "weight"),
+            numpy_helper.from_array(bias, "bias"),
+        ],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.checker.check_model(model)
+    model_path = os.path.join(directory, "model.onnx")
+    tags_path = os.path.join(directory, "selected_tags.csv")
+    onnx.save(model, model_path)
+    with open(tags_path, "w", encoding="utf-8") as f:
+        f.write("tag_id,name,category,count\n")
+        for index, (name, category) in enumerate(TINY_TAGS):
+            f.write(f"{index},{name},{category},0\n")
+    return model_path, tags_path
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/19 上午4:00
+# @File    : tagger.py
+# @Software: PyCharm
+"""
+Behaviour checks of the tagger backends against local stand-ins.
+
+    python -m tests.tagger
+    python -m tests.tagger --only batcher
+
+Every check returns its failures, the run exits non-zero when there are any.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+from io import BytesIO
+from typing import Dict, List
+
+from loguru import logger
+
+from tests.corpus import build_corpus
+from tests.stubs import StubTagger, build_tiny_tagger
+
+PORT = 18111
+# Numbers worth reading next to the failures, filled in by the checks
+MEASURED: Dict[str, dict] = {}
+
+
+def expect(failures: List[str], name: str, got, expected):
+    if got != expected:
+        failures.append(f"{name}: got {got!r}, expected {expected!r}")
+
+
+def tags(result) -> str:
+    if isinstance(result, BaseException):
+        return repr(result)
+    return result["sorted_general_strings"]
+
+
+async def check_batcher() -> List[str]:
+    from app.batcher import TagBatcher
+    from app.utils import WdTaggerSDK
+
+    failures = []
+    # Distinct sizes, the stub echoes the size so answers can be told apart
+    payloads = [b"x" * (100 + index) for index in range(12)]
+    for name, options in (
+        ("batch", {"batch": True}),
+        ("fallback_404", {"batch": False, "batch_status": 404}),
+        ("fallback_405", {"batch": False, "batch_status": 405}),
+        ("batch_error", {"batch": False, "batch_status": 500}),
+    ):
+        stub = StubTagger(port=PORT, latency=0.01, **options)
+        await stub.start()
+        sdk = WdTaggerSDK(stub.url, max_retries=0)
+        batcher = TagBatcher(sdk, max_batch=4, max_delay=0.05)
+        try:
+            results = await asyncio.gather(
+                *[batcher.upload(data, token="t") for data in payloads]
+            )
+            # Every caller gets the answer for its own image
+            expect(
+                failures,
+                f"{name} results",
+                [tags(result) for result in results],
+                [f"1girl, solo, bytes_{len(data)}" for data in payloads],
+            )
+            if name == "batch":
+                expect(failures, f"{name} requests", stub.stats["requests"], 3)
+            else:
+                expect(failures, f"{name} requests", stub.stats["requests"], 12)
+            # A server without the endpoint is not asked again, a failing
+            # one is
+            expect(
+                failures,
+                f"{name} batch_supported",
+                sdk.batch_supported,
+                name in ("batch", "batch_error"),
+            )
+        finally:
+            await batcher.close()
+            await stub.stop()
+    return failures
+
+
+async def check_pool() -> List[str]:
+    from app.pool import TaggerPool
+    from app.utils import WdTaggerSDK
+
+    failures = []
+    fast = StubTagger(port=PORT + 10, latency=0.02)
+    slow = StubTagger(port=PORT + 20, latency=0.2)
+    for stub in (fast, slow):
+        await stub.start()
+    pool = TaggerPool(
+        [WdTaggerSDK(stub.url, max_retries=0) for stub in (fast, slow)],
+        max_attempts=2,
+        retry_backoff=0.01,
+        eject_after=2,
+        check_interval=0.2,
+        check_timeout=0.5,
+    )
+    try:
+        # Both nodes get some traffic first, then the faster one most of it
+        await asyncio.gather(*[pool.upload(b"x", token="t") for _ in range(4)])
+        for stub in (fast, slow):
+            stub.stats["requests"] = 0
+        await asyncio.gather(*[pool.upload(b"x", token="t") for _ in range(40)])
+        MEASURED["pool"] = {
+            "fast_node": fast.stats["requests"],
+            "slow_node": slow.stats["requests"],
+        }
+        if fast.stats["requests"] <= 2 * slow.stats["requests"]:
+            failures.append(
+                f"routing: fast node took {fast.stats['requests']}, "
+                f"slow node {slow.stats['requests']}"
+            )
+        # A node going away costs no upload, they are retried on the other
+        await slow.stop()
+        results = await asyncio.gather(
+            *[pool.upload(b"x" * 10, token="t") for _ in range(20)],
+            return_exceptions=True,
+        )
+        expect(
+            failures,
+            "retry results",
+            [tags(result) for result in results],
+            ["1girl, solo, bytes_10"] * 20,
+        )
+        expect(
+            failures, "ejected", [node.healthy for node in pool.nodes], [True, False]
+        )
+        # Traffic comes back once the check finds it answering
+        await slow.start()
+        slow.stats["requests"] = 0
+        await asyncio.sleep(0.6)
+        expect(failures, "re-admitted", pool.healthy, 2)
+        await asyncio.gather(*[pool.upload(b"x", token="t") for _ in range(40)])
+        if not slow.stats["requests"]:
+            failures.append("re-admitted node got no uploads")
+    finally:
+        await pool.close()
+        for stub in (fast, slow):
+            await stub.stop()
+    return failures
+
+
+def solid(color, size=(200, 200)) -> bytes:
+    from PIL import Image
+
+    out = BytesIO()
+    Image.new("RGB", size, color).save(out, format="PNG")
+    return out.getvalue()
+
+
+async def check_onnx() -> List[str]:
+    import numpy as np
+    import onnx
+    from onnx import numpy_helper
+
+    from app.onnx_tagger import KAOMOJIS, OnnxTagger
+    from app.utils import TaggerBackend
+    from tests.stubs import TINY_TAGS
+
+    failures = []
+
+    class Incomplete(TaggerBackend):
+        pass
+
+    # A backend without upload fails when built, not on its first job
+    try:
+        Incomplete()
+        failures.append("TaggerBackend without upload was instantiated")
+    except TypeError:
+        pass
+    scratch = tempfile.TemporaryDirectory()
+    model_path, tags_path = build_tiny_tagger(scratch.name, size=64)
+    weights = {
+        item.name: numpy_helper.to_array(item)
+        for item in onnx.load(model_path).graph.initializer
+    }
+    names = [
+        name if name in KAOMOJIS else name.replace("_", " ") for name, _ in TINY_TAGS
+    ]
+    categories = [category for _, category in TINY_TAGS]
+    colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255), (0, 0, 0)]
+    colors += [(128, 64, 200), (30, 200, 90)]
+    tagger = OnnxTagger(model_path, tags_path, decode_workers=2)
+    try:
+        for general_threshold, character_threshold in ((0.6, 0.5), (0.35, 0.85)):
+            results = await tagger.upload_batch(
+                [solid(color) for color in colors],
+                token="t",
+                general_threshold=general_threshold,
+                character_threshold=character_threshold,
+            )
+            for color, result in zip(colors, results):
+                # A solid square reaches the model unchanged, so its channel
+                # means are the colour in BGR
+                means = np.array(color[::-1], np.float32) / 255
+                logits = means @ weights["weight"] + weights["bias"]
+                probs = 1 / (1 + np.exp(-logits))
+                general = sorted(
+                    (
+                        index
+                        for index, category in enumerate(categories)
+                        if category == 0 and probs[index] > general_threshold
+                    ),
+                    key=lambda index: -probs[index],
+                )
+                name = f"{color} at {general_threshold}/{character_threshold}"
+                expect(
+                    failures,
+                    f"{name} general",
+                    list(result["general_res"]),
+                    [names[index] for index in general],
+                )
+                expect(
+                    failures,
+                    f"{name} character",
+                    sorted(result["character_res"]),
+                    sorted(
+                        names[index]
+                        for index, category in enumerate(categories)
+                        if category == 4 and probs[index] > character_threshold
+                    ),
+                )
+                for index, category in enumerate(categories):
+                    if category != 9:
+                        continue
+                    got = result["rating"][names[index]]
+                    if abs(got - probs[index]) > 1e-4:
+                        failures.append(
+                            f"{name} rating {names[index]} is {got}, "
+                            f"expected {probs[index]}"
+                        )
+        # One image alone tags like it does within a batch
+        single = await tagger.upload(solid(colors[-1]), token="t")
+        expect(
+            failures,
+            "single general",
+            single["general_res"].keys(),
+            results[-1]["general_res"].keys(),
+        )
+    finally:
+        await tagger.close()
+        scratch.cleanup()
+    return failures
+
+
+async def check_downscale() -> List[str]:
+    from app.onnx_tagger import OnnxTagger
+    from app.preprocess import downscale_for_tagger
+
+    failures = []
+    scratch = tempfile.TemporaryDirectory()
+    model_path, tags_path = build_tiny_tagger(scratch.name, size=448)
+    tagger = OnnxTagger(model_path, tags_path, decode_workers=2)
+    full_bytes = sent_bytes = 0
+    drift = 0.0
+    try:
+        for sample in build_corpus(12, side=2048):
+            data = sample.photo_sizes[-1] if sample.photo_sizes else sample.data
+            small = downscale_for_tagger(BytesIO(data), max_side=1024) or data
+            full_bytes += len(data)
+            sent_bytes += len(small)
+            full, reduced = await tagger.upload_batch([data, small], token="t")
+            for key in ("general_res", "character_res"):
+                expect(
+                    failures,
+                    f"{sample.name} {key}",
+                    set(reduced[key]),
+                    set(full[key]),
+                )
+            # Rating scores are always returned, whatever the thresholds
+            for name, probability in full["rating"].items():
+                drift = max(drift, abs(reduced["rating"][name] - probability))
+    finally:
+        await tagger.close()
+        scratch.cleanup()
+    MEASURED["downscale"] = {
+        "original_bytes": full_bytes,
+        "uploaded_bytes": sent_bytes,
+        "ratio": round(full_bytes / max(sent_bytes, 1), 1),
+        "max_probability_drift": round(drift, 4),
+    }
+    return failures
+
+
+CHECKS = {
+    "batcher": check_batcher,
+    "pool": check_pool,
+    "onnx": check_onnx,
+    "downscale": check_downscale,
+}
+
+
+async def run(names: List[str]) -> Dict[str, List[str]]:
+    return {name: await CHECKS[name]() for name in names}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--only", choices=sorted(CHECKS), action="append")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG" if args.verbose else "ERROR")
+
+    failures = asyncio.run(run(args.only or list(CHECKS)))
+    print(json.dumps({"failures": failures, "measured": MEASURED}, indent=2))
+    if any(failures.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()